@@ -0,0 +1,31 @@
+"""Add media_cache table for Telegram file_id of merch photos
+
+Revision ID: 20261018_01
+Revises: 20250816_01
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_01'
+down_revision = '20250816_01'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # file_id, который Telegram вернул после первой загрузки фото (ключ: путь + sha256 содержимого)
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS media_cache (
+            path TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            created_at TEXT,
+            PRIMARY KEY (path, sha256)
+        )
+    """)
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS media_cache")
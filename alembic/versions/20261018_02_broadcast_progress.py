@@ -0,0 +1,33 @@
+"""Add status and checkpoint columns to broadcasts
+
+Revision ID: 20261018_02
+Revises: 20261018_01
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_02'
+down_revision = '20261018_01'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Старые черновики считаем уже отправленными, чтобы они не подхватились как незавершённые
+    op.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'draft'")
+    op.execute("UPDATE broadcasts SET status = 'done' WHERE status IS NULL OR status = 'draft'")
+    op.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS last_user_id BIGINT DEFAULT 0")
+    op.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS sent INTEGER DEFAULT 0")
+    op.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS failed INTEGER DEFAULT 0")
+    op.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS progress_message_id BIGINT")
+    op.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS started_at TEXT")
+    op.execute("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS finished_at TEXT")
+    op.execute("CREATE INDEX IF NOT EXISTS broadcasts_status_idx ON broadcasts (status)")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS broadcasts_status_idx")
+    for column in ("finished_at", "started_at", "progress_message_id", "failed", "sent", "last_user_id", "status"):
+        op.execute(f"ALTER TABLE broadcasts DROP COLUMN IF EXISTS {column}")
@@ -0,0 +1,30 @@
+"""Add sheets_outbox table for the background Google Sheets exporter
+
+Revision ID: 20261018_03
+Revises: 20261018_02
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_03'
+down_revision = '20261018_02'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Строки, ожидающие записи в Google Sheets (удаляются после успешного append_rows)
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS sheets_outbox (
+            id SERIAL PRIMARY KEY,
+            sheet TEXT NOT NULL,
+            row_json TEXT NOT NULL,
+            created_at TEXT
+        )
+    """)
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS sheets_outbox")
@@ -0,0 +1,28 @@
+"""Remove duplicate user_log rows and add unique (user_id, date) index
+
+Revision ID: 20261018_04
+Revises: 20261018_03
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_04'
+down_revision = '20261018_03'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Оставляем по одной записи на пользователя в день (с наименьшим id)
+    op.execute("""
+        DELETE FROM user_log a
+        USING user_log b
+        WHERE a.user_id = b.user_id AND a.date = b.date AND a.id > b.id
+    """)
+    op.execute("CREATE UNIQUE INDEX IF NOT EXISTS user_log_user_date_uidx ON user_log (user_id, date)")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS user_log_user_date_uidx")
@@ -0,0 +1,29 @@
+"""Add composite indexes for keyset pagination of merch_orders
+
+Revision ID: 20261018_05
+Revises: 20261018_04
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_05'
+down_revision = '20261018_04'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.execute("CREATE INDEX IF NOT EXISTS merch_orders_user_id_id_idx ON merch_orders (user_id, id DESC)")
+    op.execute("CREATE INDEX IF NOT EXISTS merch_orders_status_id_idx ON merch_orders (status, id DESC)")
+    # Одностолбцовые индексы покрываются составными (ведущий столбец тот же)
+    op.execute("DROP INDEX IF EXISTS merch_orders_user_id_idx")
+    op.execute("DROP INDEX IF EXISTS merch_orders_status_idx")
+
+
+def downgrade():
+    op.execute("CREATE INDEX IF NOT EXISTS merch_orders_user_id_idx ON merch_orders (user_id)")
+    op.execute("CREATE INDEX IF NOT EXISTS merch_orders_status_idx ON merch_orders (status)")
+    op.execute("DROP INDEX IF EXISTS merch_orders_status_id_idx")
+    op.execute("DROP INDEX IF EXISTS merch_orders_user_id_id_idx")
@@ -0,0 +1,26 @@
+"""Convert merch_pending.items_json from TEXT to JSONB
+
+Revision ID: 20261018_06
+Revises: 20261018_05
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_06'
+down_revision = '20261018_05'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Подтверждение заказа разворачивает позиции прямо в SQL (jsonb_array_elements)
+    op.execute("""
+        ALTER TABLE merch_pending
+        ALTER COLUMN items_json TYPE JSONB USING items_json::jsonb
+    """)
+
+
+def downgrade():
+    op.execute("ALTER TABLE merch_pending ALTER COLUMN items_json TYPE TEXT USING items_json::text")
@@ -0,0 +1,37 @@
+"""Add daily_activity rollup and activity_sketches
+
+Revision ID: 20261018_07
+Revises: 20261018_06
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_07'
+down_revision = '20261018_06'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Агрегаты по уже накопленному user_log строит при старте приложение (backfill_activity_job)
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS daily_activity (
+            day TEXT PRIMARY KEY,
+            active_users INTEGER NOT NULL DEFAULT 0,
+            hll BYTEA NOT NULL
+        )
+    """)
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS activity_sketches (
+            scope TEXT PRIMARY KEY,
+            hll BYTEA NOT NULL,
+            updated_at TEXT
+        )
+    """)
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS activity_sketches")
+    op.execute("DROP TABLE IF EXISTS daily_activity")
@@ -0,0 +1,31 @@
+"""Add conversation_state for cross-worker dialog steps
+
+Revision ID: 20261018_08
+Revises: 20261018_07
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_08'
+down_revision = '20261018_07'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Шаг сценария на чат вместо next-step замыканий в памяти воркера
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            chat_id BIGINT PRIMARY KEY,
+            state TEXT NOT NULL,
+            item TEXT,
+            expires_at DOUBLE PRECISION NOT NULL
+        )
+    """)
+    op.execute("CREATE INDEX IF NOT EXISTS conversation_state_expires_idx ON conversation_state (expires_at)")
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS conversation_state")
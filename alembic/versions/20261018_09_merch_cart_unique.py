@@ -0,0 +1,39 @@
+"""Merge duplicate merch_cart rows and key the cart by (user_id, item)
+
+Revision ID: 20261018_09
+Revises: 20261018_08
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_09'
+down_revision = '20261018_08'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Дубли одной позиции сливаются в самую раннюю строку: количество суммируется, цена — из последнего добавления
+    op.execute("""
+        UPDATE merch_cart c
+        SET quantity = s.quantity, price = s.price
+        FROM (
+            SELECT MIN(id) AS id, SUM(quantity) AS quantity, (ARRAY_AGG(price ORDER BY id DESC))[1] AS price
+            FROM merch_cart
+            GROUP BY user_id, item
+            HAVING COUNT(*) > 1
+        ) s
+        WHERE c.id = s.id
+    """)
+    op.execute("""
+        DELETE FROM merch_cart c
+        USING merch_cart d
+        WHERE c.user_id = d.user_id AND c.item = d.item AND c.id > d.id
+    """)
+    op.execute("CREATE UNIQUE INDEX IF NOT EXISTS merch_cart_user_item_uidx ON merch_cart (user_id, item)")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS merch_cart_user_item_uidx")
@@ -0,0 +1,45 @@
+"""Add job_leases and job_runs for the leader-elected job runner
+
+Revision ID: 20261018_10
+Revises: 20261018_09
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_10'
+down_revision = '20261018_09'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Аренда ведущего: периодические задачи выполняет один воркер, пока продлевает expires_at
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS job_leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at DOUBLE PRECISION NOT NULL,
+            acquired_at TEXT
+        )
+    """)
+    # История запусков задач ведущего (чистится задачей prune_job_runs)
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS job_runs (
+            id SERIAL PRIMARY KEY,
+            job TEXT NOT NULL,
+            holder TEXT,
+            started_at TEXT NOT NULL,
+            duration_ms INTEGER,
+            status TEXT NOT NULL,
+            error TEXT
+        )
+    """)
+    op.execute("CREATE INDEX IF NOT EXISTS job_runs_job_id_idx ON job_runs (job, id DESC)")
+    op.execute("CREATE INDEX IF NOT EXISTS job_runs_started_at_idx ON job_runs (started_at)")
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS job_runs")
+    op.execute("DROP TABLE IF EXISTS job_leases")
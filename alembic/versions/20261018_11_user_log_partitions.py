@@ -0,0 +1,91 @@
+"""Partition user_log by month and index rate_limits.last_ts for retention
+
+Revision ID: 20261018_11
+Revises: 20261018_10
+Create Date: 2026-10-18
+"""
+
+from datetime import date
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_11'
+down_revision = '20261018_10'
+branch_labels = None
+depends_on = None
+
+PARTITIONS_AHEAD = 3  # дальше партиции создаёт задача retention в main.py
+
+
+def _add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _create_partition(month):
+    op.execute(
+        f"CREATE TABLE IF NOT EXISTS user_log_p{month:%Y_%m} PARTITION OF user_log "
+        f"FOR VALUES FROM ('{month}') TO ('{_add_months(month, 1)}')"
+    )
+
+
+def upgrade():
+    conn = op.get_bind()
+    partitioned = conn.execute(sa.text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('user_log')"
+    )).scalar()
+    if not partitioned:
+        # Старая таблица уходит под другим именем вместе с индексами — имена освобождаются для новой
+        op.execute("ALTER TABLE user_log RENAME TO user_log_unpartitioned")
+        op.execute("ALTER INDEX IF EXISTS user_log_date_idx RENAME TO user_log_unpartitioned_date_idx")
+        op.execute("ALTER INDEX IF EXISTS user_log_user_date_uidx RENAME TO user_log_unpartitioned_user_date_uidx")
+        # Ключ партиционирования (date, тип DATE с миграции 20250816_01) входит в уникальный индекс —
+        # ON CONFLICT в flush_user_log работает как раньше
+        op.execute("""
+            CREATE TABLE user_log (
+                id BIGSERIAL,
+                user_id INTEGER NOT NULL,
+                date DATE NOT NULL
+            ) PARTITION BY RANGE (date)
+        """)
+        op.execute("CREATE UNIQUE INDEX user_log_user_date_uidx ON user_log (user_id, date)")
+        op.execute("CREATE INDEX user_log_date_idx ON user_log (date)")
+        # строки с датой вне созданных партиций попадают сюда и не теряются
+        op.execute("CREATE TABLE user_log_default PARTITION OF user_log DEFAULT")
+        first = conn.execute(sa.text("SELECT MIN(date) FROM user_log_unpartitioned")).scalar()
+        this_month = date.today().replace(day=1)
+        month = min(first.replace(day=1), this_month) if first else this_month
+        while month <= _add_months(this_month, PARTITIONS_AHEAD):
+            _create_partition(month)
+            month = _add_months(month, 1)
+        op.execute("""
+            INSERT INTO user_log (user_id, date)
+            SELECT user_id, date FROM user_log_unpartitioned
+            WHERE user_id IS NOT NULL AND date IS NOT NULL
+            ORDER BY id
+            ON CONFLICT DO NOTHING
+        """)
+        op.execute("DROP TABLE user_log_unpartitioned")
+    # Очистка rate_limits по last_ts идёт пачками по индексу
+    op.execute("CREATE INDEX IF NOT EXISTS rate_limits_last_ts_idx ON rate_limits (last_ts)")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS rate_limits_last_ts_idx")
+    op.execute("ALTER TABLE user_log RENAME TO user_log_partitioned")
+    op.execute("ALTER INDEX IF EXISTS user_log_date_idx RENAME TO user_log_partitioned_date_idx")
+    op.execute("ALTER INDEX IF EXISTS user_log_user_date_uidx RENAME TO user_log_partitioned_user_date_uidx")
+    op.execute("""
+        CREATE TABLE user_log (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER,
+            date DATE
+        )
+    """)
+    op.execute("INSERT INTO user_log (user_id, date) SELECT user_id, date FROM user_log_partitioned ORDER BY date, id")
+    op.execute("CREATE INDEX IF NOT EXISTS user_log_date_idx ON user_log (date)")
+    op.execute("CREATE UNIQUE INDEX IF NOT EXISTS user_log_user_date_uidx ON user_log (user_id, date)")
+    # партиции удаляются вместе с родительской таблицей
+    op.execute("DROP TABLE user_log_partitioned")
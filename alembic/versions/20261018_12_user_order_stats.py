@@ -0,0 +1,43 @@
+"""Per-user order totals by status and a covering index for the purchase summary
+
+Revision ID: 20261018_12
+Revises: 20261018_11
+Create Date: 2026-10-18
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_12'
+down_revision = '20261018_11'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Сводка по пользователю (число заказов и сумма по статусам) считается только по индексу
+    op.execute("CREATE INDEX IF NOT EXISTS merch_orders_user_status_total_idx ON merch_orders (user_id, status, total)")
+    # Итоги пользователя по статусам; main.py пересчитывает их при подтверждении, смене статуса и удалении заказа
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS user_order_stats (
+            user_id BIGINT NOT NULL,
+            status TEXT NOT NULL,
+            orders INTEGER NOT NULL DEFAULT 0,
+            spent BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, status)
+        )
+    """)
+    op.execute("""
+        INSERT INTO user_order_stats (user_id, status, orders, spent)
+        SELECT user_id, COALESCE(status, ''), COUNT(*), COALESCE(SUM(total), 0)
+        FROM merch_orders
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id, COALESCE(status, '')
+        ON CONFLICT (user_id, status) DO UPDATE SET orders = EXCLUDED.orders, spent = EXCLUDED.spent
+    """)
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS user_order_stats")
+    op.execute("DROP INDEX IF EXISTS merch_orders_user_status_total_idx")
@@ -0,0 +1,117 @@
+"""
+Микробенчмарк выбора обработчика для текстового сообщения.
+
+before — обработчики кнопок как раньше: по одному @message_handler(func=lambda m: m.text == ...)
+на текст, telebot перебирает их по порядку; after — text_handler (один поиск в dict).
+Оба бота — InstrumentedTeleBot из main.py с пустыми обработчиками, поэтому разница — только в поиске.
+
+main.py импортируется с заглушкой Bot API и временной SQLite-базой:
+    python bench/dispatch_bench.py --iterations 200000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from fake_telegram import FakeTelegram  # noqa: E402
+
+BENCH_TOKEN = "123456:bench-token"
+
+
+def noop(message):
+    pass
+
+
+def build_before(main, texts):
+    bot = main.InstrumentedTeleBot(BENCH_TOKEN, threaded=False)
+    bot.message_handler(commands=["start"])(noop)
+    merch_registered = False
+    for text in texts:
+        if text in main.MERCH_ITEMS:
+            # раньше все товары проверялись одним фильтром m.text in MERCH_ITEMS
+            if not merch_registered:
+                bot.message_handler(func=lambda m: m.text in main.MERCH_ITEMS)(noop)
+                merch_registered = True
+            continue
+        bot.message_handler(func=lambda m, t=text: m.text == t)(noop)
+    bot.message_handler(commands=["admin"])(noop)
+    return bot
+
+
+def build_after(main, texts):
+    bot = main.InstrumentedTeleBot(BENCH_TOKEN, threaded=False)
+    bot.message_handler(commands=["start"])(noop)
+    for text in texts:
+        bot.text_handler(text)(noop)
+    bot.message_handler(commands=["admin"])(noop)
+    return bot
+
+
+def make_messages(types, texts, count):
+    pool = texts + ["/start", "/admin", "просто текст"]
+    messages = []
+    for i in range(count):
+        messages.append(types.Message.de_json({
+            "message_id": i, "date": 0, "text": random.choice(pool),
+            "chat": {"id": 1000 + i % 50, "type": "private"},
+            "from": {"id": 1000 + i % 50, "is_bot": False, "first_name": "Bench"},
+        }))
+    return messages
+
+
+def measure(bot, messages):
+    started = time.perf_counter()
+    for message in messages:
+        bot.process_new_messages([message])
+    return (time.perf_counter() - started) / len(messages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение линейной и dict-маршрутизации текстов")
+    parser.add_argument("--iterations", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    fake = FakeTelegram().start()
+    db_dir = tempfile.mkdtemp(prefix="dispatch-bench-")
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": BENCH_TOKEN,
+        "OWNER_TELEGRAM_ID": "1",
+        "DATABASE_URL": f"sqlite:///{os.path.join(db_dir, 'bench.db')}",
+        "TELEGRAM_API_URL": fake.url,
+        "RENDER_URL": "http://127.0.0.1:9",
+    })
+    os.chdir(REPO_DIR)
+    import main as bot_main
+    from telebot import types
+
+    texts = list(bot_main.bot._text_routes)
+    before = build_before(bot_main, texts)
+    after = build_after(bot_main, texts)
+    messages = make_messages(types, texts, args.iterations)
+    last_button = [types.Message.de_json({
+        "message_id": 0, "date": 0, "text": texts[-1],
+        "chat": {"id": 1, "type": "private"}, "from": {"id": 1, "is_bot": False, "first_name": "Bench"},
+    })] * max(1, args.iterations // 10)
+
+    measure(before, messages[:1000])  # прогрев
+    measure(after, messages[:1000])
+    print(f"Текстов кнопок: {len(texts)}, сообщений: {len(messages)}")
+    for name, bot in (("before", before), ("after", after)):
+        mixed = measure(bot, messages)
+        worst = measure(bot, last_button)
+        print(f"{name:>6}: {mixed:7.2f} мкс/update (смесь), {worst:7.2f} мкс/update (последняя кнопка)")
+    bot_main.job_runner.stop()
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Локальная заглушка Telegram Bot API для бенчмарков.
+
+Отвечает на методы, которые вызывает бот (sendMessage, sendPhoto, sendMediaGroup, answerCallbackQuery,
+setWebhook, ...), правдоподобными объектами и записывает каждый вызов. Умеет добавлять задержку
+и отвечать 429 (Too Many Requests) с заданной вероятностью.
+
+Отдельный запуск:
+    python bench/fake_telegram.py --port 8081 --latency-ms 30 --rate-429 0.01
+и в окружении бота: TELEGRAM_API_URL=http://127.0.0.1:8081
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+class FakeTelegram:
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=0.0, rate_429=0.0, retry_after=1):
+        self.latency = latency_ms / 1000.0
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.calls = []  # (время, метод, параметры)
+        self.webhook_url = ""  # запоминается setWebhook — как у настоящего API между рестартами бота
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="fake-telegram", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def reset(self):
+        with self._lock:
+            self.calls = []
+
+    def calls_by_method(self):
+        counts = {}
+        with self._lock:
+            for _, method, _ in self.calls:
+                counts[method] = counts.get(method, 0) + 1
+        return counts
+
+    def find_calls(self, method, chat_id=None):
+        with self._lock:
+            return [params for _, m, params in self.calls
+                    if m == method and (chat_id is None or str(params.get("chat_id")) == str(chat_id))]
+
+    # --- ответы ---
+    def _message(self, params, **extra):
+        chat_id = params.get("chat_id", 0)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"},
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        message.update(extra)
+        return message
+
+    def _photo(self):
+        n = next(self._message_ids)
+        return [{"file_id": f"fake-photo-{n}", "file_unique_id": f"u{n}", "width": 800, "height": 800}]
+
+    def respond(self, method, params):
+        if method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            return self._message(params)
+        if method == "sendPhoto":
+            return self._message(params, photo=self._photo(), caption=params.get("caption", ""))
+        if method == "sendDocument":
+            n = next(self._message_ids)
+            return self._message(params, document={"file_id": f"fake-doc-{n}", "file_unique_id": f"d{n}"})
+        if method == "sendMediaGroup":
+            try:
+                count = len(json.loads(params.get("media", "[]")))
+            except ValueError:
+                count = 1
+            return [self._message(params, photo=self._photo()) for _ in range(max(1, count))]
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        if method == "getWebhookInfo":
+            return {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "setWebhook":
+            self.webhook_url = params.get("url", "")
+        if method == "deleteWebhook":
+            self.webhook_url = ""
+        return True
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                parts = urlsplit(self.path)
+                method = parts.path.rstrip("/").rsplit("/", 1)[-1]
+                params = dict(parse_qsl(parts.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                content_type = self.headers.get("Content-Type", "")
+                # multipart (загрузка фото) не разбираем: chat_id и прочие поля telebot передаёт в query
+                if body and content_type.startswith("application/x-www-form-urlencoded"):
+                    params.update(parse_qsl(body.decode("utf-8", "replace")))
+                elif body and content_type.startswith("application/json"):
+                    params.update(json.loads(body))
+                with fake._lock:
+                    fake.calls.append((time.monotonic(), method, params))
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake.rate_429 and random.random() < fake.rate_429:
+                    status, payload = 429, {
+                        "ok": False, "error_code": 429,
+                        "description": f"Too Many Requests: retry after {fake.retry_after}",
+                        "parameters": {"retry_after": fake.retry_after},
+                    }
+                else:
+                    status, payload = 200, {"ok": True, "result": fake.respond(method, params)}
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _handle
+            do_POST = _handle
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429 (0..1)")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+    fake = FakeTelegram(args.host, args.port, args.latency_ms, args.rate_429, args.retry_after)
+    print(f"Fake Bot API: {fake.url}")
+    try:
+        fake._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
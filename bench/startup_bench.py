@@ -0,0 +1,140 @@
+"""
+Бенчмарк старта воркера: сколько времени проходит от запуска процесса до готовности принимать update.
+
+Каждый прогон — отдельный процесс python, который импортирует main.py (с заглушкой Bot API) и ждёт,
+пока планировщик задач (job_runner) выберет ведущего. Первый прогон на новой базе холодный (init_db, setWebhook),
+следующие — тёплые, как рестарт воркера при деплое. Печатаются время импорта, время готовности
+(BOOT_SECONDS из main.py), время до запуска задач ведущего, число SQL-запросов и вызовы Bot API.
+
+    python bench/startup_bench.py --runs 5
+    python bench/startup_bench.py --database-url postgresql://localhost/bot_bench --schema-mode auto
+    python bench/startup_bench.py --importtime   # самые долгие импорты (python -X importtime)
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+BENCH_TOKEN = "123456:bench-token"
+
+
+def child(timeout):
+    """Выполняется в дочернем процессе: импорт main.py и ожидание ведущего"""
+    started = time.perf_counter()
+    import sqlalchemy
+    from sqlalchemy.engine import Engine
+    queries = [0]
+
+    def count_query(*args, **kwargs):
+        queries[0] += 1
+    # слушатель на классе Engine видит и движок, который main.py создаёт при импорте
+    sqlalchemy.event.listen(Engine, "before_cursor_execute", count_query)
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(REPO_DIR)
+    import main as bot_main
+    imported = time.perf_counter() - started
+    import_queries = queries[0]
+    deadline = time.monotonic() + timeout
+    while not bot_main.job_runner.is_leader and time.monotonic() < deadline:
+        time.sleep(0.005)
+    background = time.perf_counter() - started if bot_main.job_runner.is_leader else None
+    bot_main.job_runner.stop()
+    print(json.dumps({
+        "import": imported, "boot": bot_main.BOOT_SECONDS, "background": background,
+        "import_queries": import_queries, "background_queries": queries[0] - import_queries,
+    }))
+
+
+def run_child(env, timeout, importtime=False):
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else []) + [
+        os.path.abspath(__file__), "--child", "--timeout", str(timeout)]
+    started = time.perf_counter()
+    proc = subprocess.run(cmd, env=env, capture_output=True, text=True, timeout=timeout + 60)
+    wall = time.perf_counter() - started
+    if proc.returncode != 0:
+        raise RuntimeError(f"прогон завершился с кодом {proc.returncode}:\n{proc.stderr[-2000:]}")
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["process"] = wall
+    return result, proc.stderr
+
+
+def top_imports(stderr, limit):
+    """Модули верхнего уровня с наибольшим суммарным временем импорта"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        # "import time: self | cumulative | <два пробела на уровень вложенности>имя"
+        _, cumulative_us, name = line.split("|", 2)
+        if not name.startswith("  "):
+            rows.append((int(cumulative_us), name.strip()))
+    return sorted(rows, reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время импорта и готовности воркера main.py")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"),
+                        help="по умолчанию — новый файл SQLite")
+    parser.add_argument("--schema-mode", default="auto", choices=["auto", "verify", "init"])
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="задержка ответа заглушки Bot API")
+    parser.add_argument("--timeout", type=float, default=30.0, help="ожидание ведущего, с")
+    parser.add_argument("--importtime", action="store_true", help="показать самые долгие импорты")
+    args = parser.parse_args()
+    if args.child:
+        child(args.timeout)
+        return
+
+    from fake_telegram import FakeTelegram
+    fake = FakeTelegram(latency_ms=args.latency_ms).start()
+    database_url = args.database_url
+    if not database_url:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='startup-bench-'), 'bench.db')}"
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_BOT_TOKEN": BENCH_TOKEN,
+        "OWNER_TELEGRAM_ID": "1",
+        "DATABASE_URL": database_url,
+        "TELEGRAM_API_URL": fake.url,
+        "RENDER_URL": "http://127.0.0.1:9",
+        "DB_SCHEMA_MODE": args.schema_mode,
+    })
+    env.pop("GOOGLE_SHEETS_CREDENTIALS_PATH", None)
+
+    results = []
+    try:
+        print(f"{'прогон':>6} {'процесс':>8} {'импорт':>8} {'готов':>8} {'фон':>8} {'SQL':>5} {'SQL фон':>8}  Bot API")
+        for i in range(args.runs):
+            before = fake.calls_by_method()
+            result, _ = run_child(env, args.timeout)
+            after = fake.calls_by_method()
+            api = {m: after[m] - before.get(m, 0) for m in after if after[m] != before.get(m, 0)}
+            results.append(result)
+            background = f"{result['background']:.3f}" if result["background"] is not None else "—"
+            print(f"{i + 1:>6} {result['process']:>8.3f} {result['import']:>8.3f} {result['boot']:>8.3f} "
+                  f"{background:>8} {result['import_queries']:>5} {result['background_queries']:>8}  "
+                  f"{json.dumps(api, sort_keys=True)}")
+        warm = results[1:] or results
+        print(f"\nтёплый старт (медиана, с): процесс {statistics.median(r['process'] for r in warm):.3f}, "
+              f"импорт {statistics.median(r['import'] for r in warm):.3f}, "
+              f"готов {statistics.median(r['boot'] for r in warm):.3f}")
+        if args.importtime:
+            _, stderr = run_child(env, args.timeout, importtime=True)
+            print("\nсамые долгие импорты верхнего уровня (мс, суммарно):")
+            for cumulative_us, name in top_imports(stderr, 15):
+                print(f"  {cumulative_us / 1000:8.1f}  {name}")
+    finally:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
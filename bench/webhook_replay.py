@@ -0,0 +1,288 @@
+"""
+Сквозной бенчмарк вебхука: поднимает Flask-приложение из main.py на локальном порту, подменяет
+api.telegram.org заглушкой (fake_telegram.py) и прогоняет синтетические потоки update через /<TOKEN>.
+
+Сценарии:
+    referral — всплеск /start по одной реферальной ссылке;
+    funnel   — /start → Мерч → товар → Заказать → количество → Корзина → Оформить заказ;
+    admin    — владелец подтверждает заказы из funnel и листает список заказов по кнопке «Ещё».
+
+Для каждого сценария печатаются пропускная способность, p50/p95/p99 задержки (от POST до конца
+обработки update), число SQL-запросов и вызовов Bot API на update.
+
+Нужна отдельная БД (сценарии создают пользователей и заказы) — PostgreSQL или файл SQLite:
+    BENCH_DATABASE_URL=postgresql://localhost/bot_bench python bench/webhook_replay.py --users 200
+    python bench/webhook_replay.py --database-url sqlite:////tmp/bot_bench.db
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from fake_telegram import FakeTelegram  # noqa: E402
+
+BENCH_TOKEN = "123456:bench-token"
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))]
+
+
+class Tracker:
+    """Время завершения и счётчики SQL/Bot API для каждого update (по update_id)"""
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._events = {}
+        self.sent = {}
+        self.results = {}  # update_id -> (задержка, SQL-запросов, вызовов API)
+
+    def expect(self, update_id):
+        event = threading.Event()
+        with self._lock:
+            self._events[update_id] = event
+            self.sent[update_id] = time.perf_counter()
+        return event
+
+    def count_query(self, *args, **kwargs):
+        if getattr(self._local, "active", False):
+            self._local.queries += 1
+
+    def wrap_api(self, make_request):
+        def counted(*args, **kwargs):
+            if getattr(self._local, "active", False):
+                self._local.api_calls += 1
+            return make_request(*args, **kwargs)
+        return counted
+
+    def wrap_handler(self, handler):
+        def tracked(payload):
+            self._local.active = True
+            self._local.queries = 0
+            self._local.api_calls = 0
+            try:
+                handler(payload)
+            finally:
+                self._local.active = False
+                update_id = payload.get("update_id")
+                with self._lock:
+                    started = self.sent.get(update_id)
+                    if started is not None:
+                        self.results[update_id] = (time.perf_counter() - started,
+                                                   self._local.queries, self._local.api_calls)
+                    event = self._events.pop(update_id, None)
+                if event:
+                    event.set()
+        return tracked
+
+    def take(self, update_ids):
+        with self._lock:
+            return [self.results[u] for u in update_ids if u in self.results]
+
+
+class Replayer:
+    def __init__(self, base_url, tracker, timeout, think):
+        import requests
+        self._requests = requests
+        self._local = threading.local()
+        self.url = f"{base_url}/{BENCH_TOKEN}"
+        self.tracker = tracker
+        self.timeout = timeout
+        self.think = think
+        self.secret = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+        self._update_ids = itertools.count(random.randrange(10 ** 8, 10 ** 9))
+        self._message_ids = itertools.count(1)
+        self.http_errors = {}
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        return session
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"Bench{user_id}", "username": f"bench{user_id}"}
+
+    def message(self, user_id, text):
+        return {"update_id": next(self._update_ids), "message": {
+            "message_id": next(self._message_ids), "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), "text": text,
+        }}
+
+    def callback(self, user_id, data):
+        return {"update_id": next(self._update_ids), "callback_query": {
+            "id": str(next(self._message_ids)), "from": self._user(user_id), "chat_instance": "bench",
+            "data": data, "message": {
+                "message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"}, "text": "bench",
+            },
+        }}
+
+    def send(self, update):
+        """POST в вебхук и ожидание конца обработки — как пользователь, который ждёт ответа бота"""
+        update_id = update["update_id"]
+        event = self.tracker.expect(update_id)
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret} if self.secret else {}
+        response = self._session().post(self.url, json=update, headers=headers, timeout=self.timeout)
+        if response.status_code != 200:
+            self.http_errors[response.status_code] = self.http_errors.get(response.status_code, 0) + 1
+            return update_id
+        if not event.wait(self.timeout):
+            self.http_errors["timeout"] = self.http_errors.get("timeout", 0) + 1
+        if self.think:
+            time.sleep(self.think)
+        return update_id
+
+    def run_scripts(self, scripts, concurrency):
+        """Каждый скрипт — последовательность update одного пользователя; скрипты идут параллельно"""
+        def run(script):
+            return [self.send(update) for update in script]
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return [u for ids in pool.map(run, scripts) for u in ids]
+
+
+def callback_buttons(fake, chat_id, prefix):
+    """callback_data кнопок из сообщений, отправленных ботом в чат"""
+    found = []
+    for params in fake.find_calls("sendMessage", chat_id):
+        markup = params.get("reply_markup")
+        if not markup:
+            continue
+        try:
+            rows = json.loads(markup).get("inline_keyboard", [])
+        except (ValueError, AttributeError):
+            continue
+        found += [b.get("callback_data", "") for row in rows for b in row if b.get("callback_data", "").startswith(prefix)]
+    return found
+
+
+def scenario_referral(main, replayer, fake, args, user_base):
+    referrer = user_base
+    replayer.send(replayer.message(referrer, "/start"))
+    code = main.encode_referral_code(referrer)
+    scripts = [[replayer.message(user_base + 1 + i, f"/start {code}")] for i in range(args.users)]
+    return replayer.run_scripts(scripts, args.concurrency)
+
+
+def scenario_funnel(main, replayer, fake, args, user_base):
+    item = next(name for name in main.MERCH_ITEMS if not isinstance(main.MERCH_ITEMS[name][1], list))
+    steps = ["/start", "🛍 Мерч", item, "✅ Заказать", "2", "🛍️ Корзина", "✅ Оформить заказ"]
+    scripts = [[replayer.message(user_base + i, text) for text in steps] for i in range(args.users)]
+    return replayer.run_scripts(scripts, args.concurrency)
+
+
+def scenario_admin(main, replayer, fake, args, user_base):
+    owner = main.OWNER_ID
+    ids = []
+    for data in callback_buttons(fake, owner, "confirm_pending:"):
+        ids.append(replayer.send(replayer.callback(owner, data)))
+    # листаем все заказы, каждый раз переходя по кнопке «Ещё» из последнего ответа
+    data = "admin_orders:all:"
+    seen = set()
+    while data and data not in seen:
+        seen.add(data)
+        ids.append(replayer.send(replayer.callback(owner, data)))
+        more = [d for d in callback_buttons(fake, owner, "admin_orders:all:b") if d not in seen]
+        data = more[-1] if more else None
+    return ids
+
+
+SCENARIOS = {"referral": scenario_referral, "funnel": scenario_funnel, "admin": scenario_admin}
+
+
+def report(name, wall, results, fake_calls, http_errors):
+    latencies = [r[0] * 1000 for r in results]
+    queries = [r[1] for r in results]
+    api_calls = [r[2] for r in results]
+    n = len(results)
+    print(f"\n== {name}: {n} update за {wall:.2f} с — {n / wall if wall else 0:.1f} update/с")
+    print(f"   задержка, мс: p50 {percentile(latencies, 50):.1f}  p95 {percentile(latencies, 95):.1f}  "
+          f"p99 {percentile(latencies, 99):.1f}  max {max(latencies, default=0):.1f}")
+    if n:
+        print(f"   SQL на update: среднее {sum(queries) / n:.2f}, p95 {percentile(queries, 95)}")
+        print(f"   Bot API на update: среднее {sum(api_calls) / n:.2f}, p95 {percentile(api_calls, 95)}")
+    print(f"   Bot API по методам: {json.dumps(fake_calls, ensure_ascii=False, sort_keys=True)}")
+    if http_errors:
+        print(f"   ошибки вебхука: {http_errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк вебхука с заглушкой Telegram Bot API")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"))
+    parser.add_argument("--scenarios", default="referral,funnel,admin")
+    parser.add_argument("--users", type=int, default=100, help="пользователей в сценарии")
+    parser.add_argument("--concurrency", type=int, default=16, help="одновременно активных пользователей")
+    parser.add_argument("--owner-id", type=int, default=int(os.getenv("BENCH_OWNER_ID", "1")))
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="задержка ответа заглушки Bot API")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429 от заглушки")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="пауза пользователя между шагами")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("нужен --database-url или BENCH_DATABASE_URL (отдельная БД, не боевая)")
+
+    fake = FakeTelegram(latency_ms=args.latency_ms, rate_429=args.rate_429).start()
+    from werkzeug.serving import make_server
+    # порт занимаем заранее: RENDER_URL (вебхук и самопинг) должен указывать на локальный сервер
+    import socket
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": BENCH_TOKEN,
+        "OWNER_TELEGRAM_ID": str(args.owner_id),
+        "DATABASE_URL": args.database_url,
+        "TELEGRAM_API_URL": fake.url,
+        "RENDER_URL": f"http://127.0.0.1:{port}",
+    })
+    os.environ.pop("GOOGLE_SHEETS_CREDENTIALS_PATH", None)
+    os.chdir(REPO_DIR)  # photos/ ищется относительно рабочего каталога
+
+    started = time.perf_counter()
+    import main as bot_main
+    print(f"main.py импортирован за {time.perf_counter() - started:.2f} с")
+    import sqlalchemy
+    import telebot
+
+    tracker = Tracker()
+    sqlalchemy.event.listen(bot_main.engine, "before_cursor_execute", tracker.count_query)
+    telebot.apihelper._make_request = tracker.wrap_api(telebot.apihelper._make_request)
+    bot_main.update_queue._handler = tracker.wrap_handler(bot_main.update_queue._handler)
+
+    server = make_server("127.0.0.1", port, bot_main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-http", daemon=True).start()
+    replayer = Replayer(f"http://127.0.0.1:{port}", tracker, args.timeout, args.think_ms / 1000.0)
+
+    user_base = random.randrange(1_000_000_000, 2_000_000_000 - 10 * args.users)
+    try:
+        for i, name in enumerate(s.strip() for s in args.scenarios.split(",") if s.strip()):
+            scenario = SCENARIOS[name]
+            before = fake.calls_by_method()
+            replayer.http_errors = {}
+            t0 = time.perf_counter()
+            update_ids = scenario(bot_main, replayer, fake, args, user_base + i * 2 * args.users)
+            wall = time.perf_counter() - t0
+            after = fake.calls_by_method()
+            delta = {m: after[m] - before.get(m, 0) for m in after if after[m] != before.get(m, 0)}
+            report(name, wall, tracker.take(update_ids), delta, replayer.http_errors)
+    finally:
+        server.shutdown()
+        fake.stop()
+        bot_main.job_runner.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,26 +2,120 @@ import os
 import logging
 import threading
 import time
+_BOOT_STARTED = time.perf_counter()  # отсчёт готовности воркера (см. BOOT_SECONDS в конце файла)
 import requests
 import json
+import hashlib
+import math
+import bisect
+import re
+import queue
+import select
+import functools
+import atexit
+import socket
+import uuid
+import importlib.util
+import sys
+import argparse
+import csv
+import gzip
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
 from io import BytesIO
 from flask import Flask, request
 import telebot
 from telebot import types
-from datetime import datetime, date
+from telebot.apihelper import ApiTelegramException
+from datetime import datetime, date, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import sqlalchemy
 from sqlalchemy import create_engine
 # --- ИСПРАВЛЕНО: переименовали импорт text в sql_text для избежания конфликта имен ---
 from sqlalchemy import text as sql_text
-from sqlalchemy.exc import OperationalError, IntegrityError
-from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
 # --- Настройка логирования ---
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# --- Метрики (текстовый формат Prometheus, отдаются на /metrics) ---
+# Наблюдение — поиск корзины и инкремент под коротким локом, поэтому инструментирование можно держать включённым.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_label_value(v)}"' for n, v in zip(names, values)) + "}"
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, values)} {value}")
+        return lines
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # значения меток -> [счётчики по корзинам (+Inf последней), сумма, количество]
+        self._lock = threading.Lock()
+    def observe(self, value, *label_values):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((values, (list(s[0]), s[1], s[2])) for values, s in self._series.items())
+        names = self.labels + ("le",)
+        for values, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(names, values + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, values)} {total:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, values)} {count}")
+        return lines
+
+handler_latency = Histogram("bot_handler_seconds", "Время выполнения обработчика update", ("handler",))
+handler_errors = Counter("bot_handler_errors_total", "Исключения в обработчиках", ("handler",))
+telegram_api_latency = Histogram("telegram_api_request_seconds", "Время запроса к Telegram Bot API", ("method",))
+telegram_api_calls = Counter("telegram_api_requests_total", "Запросы к Telegram Bot API", ("method", "status"))
+db_checkout_latency = Histogram("db_pool_checkout_seconds", "Ожидание соединения из пула SQLAlchemy",
+                                buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0))
+http_request_latency = Histogram("http_request_seconds", "Время ответа Flask", ("endpoint", "status"))
+METRICS = [handler_latency, handler_errors, telegram_api_latency, telegram_api_calls,
+           db_checkout_latency, http_request_latency]
 # --- Константы (из Environment Variables) ---
+# python main.py <команда> — разовая команда (см. cli() в конце файла): фоновые задачи не запускаются
+CLI_MODE = __name__ == "__main__" and len(sys.argv) > 1
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not TOKEN:
     logger.error("Переменная TELEGRAM_BOT_TOKEN не установлена")
@@ -40,40 +134,251 @@ if not RENDER_URL or "your-app.onrender.com" in RENDER_URL:
     logger.warning("RENDER_URL не установлен или является плейсхолдером — проверьте ENV")
 WEBHOOK_URL = f"{RENDER_URL}/{TOKEN}"
 WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
-# --- Настройка PostgreSQL ---
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))  # потоков-обработчиков update на процесс
+# --- Хранилище: PostgreSQL или встроенный SQLite ---
+# DATABASE_URL вида sqlite:///path/bot.db включает SQLite (WAL) для одиночного инстанса и бенчмарков;
+# всё остальное — PostgreSQL. Хелперы пишут переносимый SQL, а диалектные различия (DDL, блокировки,
+# GREATEST, JSONB, изменяющие CTE) берут из объекта storage.
 DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(WEBHOOK_WORKERS + 4)))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "4"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+class PostgresStorage:
+    name = "PostgreSQL"
+    serial_pk = "SERIAL PRIMARY KEY"
+    json_type = "JSONB"
+    blob_type = "BYTEA"
+    writable_cte = True  # DELETE/INSERT ... RETURNING внутри WITH
+    row_locks = True  # FOR UPDATE блокирует строки, а не всю базу
+    transaction_per_update = True  # один unit_of_work на update (см. process_update_payload)
+    multi_process = True  # несколько воркеров gunicorn: кэши инвалидируются через LISTEN/NOTIFY
+    def engine_options(self):
+        # Пул рассчитан на параллельность процесса: по соединению на поток обработки update
+        # плюс фоновые задачи (планировщик, рассылка, экспорт в Google Sheets)
+        return dict(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+            connect_args={"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+        )
+    def setup_engine(self, engine):
+        pass
+    def prepare_ddl(self, conn):
+        # DDL может идти дольше обычного statement_timeout
+        conn.execute(sql_text("SET LOCAL statement_timeout = 0"))
+    def add_column(self, conn, table, column, ddl):
+        conn.execute(sql_text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {ddl}"))
+    def for_update(self, skip_locked=False):
+        return "FOR UPDATE SKIP LOCKED" if skip_locked else "FOR UPDATE"
+    def greatest(self, a, b):
+        return f"GREATEST({a}, {b})"
+    def json_param(self, name):
+        return f"CAST(:{name} AS JSONB)"
+    def try_lock(self, conn, *key):
+        """Неблокирующий advisory lock сессии (один или два int-ключа)"""
+        args = ", ".join(f":k{i}" for i in range(len(key)))
+        return conn.execute(sql_text(f"SELECT pg_try_advisory_lock({args})"),
+                            {f"k{i}": k for i, k in enumerate(key)}).scalar()
+    def unlock(self, conn, *key):
+        args = ", ".join(f":k{i}" for i in range(len(key)))
+        conn.execute(sql_text(f"SELECT pg_advisory_unlock({args})"), {f"k{i}": k for i, k in enumerate(key)})
+    def notify(self, conn, channel, payload):
+        # доставляется слушателям после коммита транзакции conn
+        conn.execute(sql_text("SELECT pg_notify(:channel, :payload)"), {"channel": channel, "payload": payload})
+    def list_partitions(self, conn, table):
+        """Имена партиций таблицы или None, если таблица не партиционирована"""
+        partitioned = conn.execute(sql_text(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)"
+        ), {"table": table}).scalar()
+        if not partitioned:
+            return None
+        return {row[0] for row in conn.execute(sql_text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(:table)"
+        ), {"table": table})}
+
+class SqliteStorage:
+    """
+    Встроенный SQLite в режиме WAL. Рассчитан на один процесс (gunicorn -w 1): блокировки задач
+    держатся в памяти процесса. Запись в SQLite одна на всю базу, поэтому транзакции начинаются с
+    BEGIN IMMEDIATE (вместо FOR UPDATE) и должны быть короткими.
+    """
+    name = "SQLite"
+    serial_pk = "INTEGER PRIMARY KEY AUTOINCREMENT"
+    json_type = "TEXT"
+    blob_type = "BLOB"
+    writable_cte = False
+    row_locks = False
+    # единственную блокировку записи нельзя держать на время запросов к Bot API:
+    # у каждого db_conn() своя короткая транзакция
+    transaction_per_update = False
+    multi_process = False
+    def __init__(self):
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+    def engine_options(self):
+        import sqlite3
+        if sqlite3.sqlite_version_info < (3, 35):
+            raise RuntimeError(f"Нужен SQLite >= 3.35 (RETURNING), установлен {sqlite3.sqlite_version}")
+        return dict(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+        )
+    def setup_engine(self, engine):
+        @sqlalchemy.event.listens_for(engine, "connect")
+        def _on_connect(dbapi_conn, _record):
+            # транзакциями управляет SQLAlchemy (событие begin ниже), а не модуль sqlite3
+            dbapi_conn.isolation_level = None
+            cursor = dbapi_conn.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+            cursor.close()
+        @sqlalchemy.event.listens_for(engine, "begin")
+        def _on_begin(conn):
+            # потоковое чтение (yield_per) идёт по снимку WAL и не должно держать блокировку записи
+            mode = "DEFERRED" if "yield_per" in conn.get_execution_options() else "IMMEDIATE"
+            conn.exec_driver_sql(f"BEGIN {mode}")
+    def prepare_ddl(self, conn):
+        pass
+    def add_column(self, conn, table, column, ddl):
+        columns = {row[1] for row in conn.execute(sql_text(f"PRAGMA table_info({table})"))}
+        if column not in columns:
+            conn.execute(sql_text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    def for_update(self, skip_locked=False):
+        return ""  # транзакция уже держит блокировку записи (BEGIN IMMEDIATE)
+    def greatest(self, a, b):
+        return f"MAX({a}, {b})"
+    def json_param(self, name):
+        return f":{name}"
+    def try_lock(self, conn, *key):
+        with self._locks_guard:
+            lock = self._locks.setdefault(key, threading.Lock())
+        return lock.acquire(blocking=False)
+    def unlock(self, conn, *key):
+        lock = self._locks.get(key)
+        if lock is not None and lock.locked():
+            lock.release()
+    def notify(self, conn, channel, payload):
+        pass  # один процесс — инвалидировать чужие кэши не нужно
+    def list_partitions(self, conn, table):
+        return None  # партиций нет: старые строки удаляются пачками
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool, который замеряет ожидание соединения (db_pool_checkout_seconds) на любом пути: unit_of_work,
+    engine.connect()/begin() в задачах, выгрузках и рассылке. События пула (checkout) приходят уже после
+    выдачи соединения, поэтому время ожидания снимается вокруг _do_get — взятия из очереди или создания нового.
+    """
+    def _do_get(self):
+        with db_checkout_latency.time():
+            return super()._do_get()
 if DATABASE_URL:
     # Заменяем префикс для SQLAlchemy
     if DATABASE_URL.startswith("postgres://"):
         DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+    if DATABASE_URL.startswith("sqlite"):
+        if ":memory:" in DATABASE_URL or DATABASE_URL.rstrip("/") in ("sqlite:", "sqlite+pysqlite:"):
+            raise RuntimeError("Для SQLite нужен файл базы: sqlite:///path/bot.db")
+        storage = SqliteStorage()
+    else:
+        storage = PostgresStorage()
     try:
-        engine = create_engine(DATABASE_URL)
-        # Проверяем подключение
-        with engine.connect() as conn:
-            conn.execute(sql_text("SELECT 1"))
-        logger.info("Успешное подключение к PostgreSQL")
+        engine = create_engine(DATABASE_URL, poolclass=TimedQueuePool, **storage.engine_options())
+        storage.setup_engine(engine)
+        # подключение проверяет ensure_schema() — первым же запросом
     except Exception as e:
-        logger.error(f"Ошибка подключения к PostgreSQL: {e}")
+        logger.error(f"Ошибка подключения к {storage.name}: {e}")
         raise
 else:
     logger.warning("Переменная DATABASE_URL не установлена. Бот может не работать корректно.")
+# --- Единица работы: одно соединение и одна транзакция на обрабатываемый update ---
+# Все DB-хелперы берут соединение через db_conn(): внутри unit_of_work() это общее соединение
+# (коммит один раз в конце), вне его — своё соединение и транзакция на время блока.
+_db_local = threading.local()
+
+class UnitOfWork:
+    def __init__(self):
+        self.conn = None
+        self.callbacks = []  # выполняются после успешного коммита
+    def connection(self):
+        # соединение берётся из пула лениво — update без обращений к БД пул не трогает
+        if self.conn is None:
+            self.conn = engine.connect()
+        return self.conn
+@contextmanager
+def unit_of_work():
+    """Открывает единицу работы; вложенный вызов присоединяется к уже открытой"""
+    current = getattr(_db_local, "uow", None)
+    if current is not None:
+        yield current
+        return
+    uow = UnitOfWork()
+    _db_local.uow = uow
+    try:
+        yield uow
+        if uow.conn is not None:
+            uow.conn.commit()
+    except Exception:
+        if uow.conn is not None:
+            uow.conn.rollback()
+        raise
+    finally:
+        _db_local.uow = None
+        if uow.conn is not None:
+            uow.conn.close()
+    for fn, args, kwargs in uow.callbacks:
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"Ошибка в действии после коммита: {e}")
+@contextmanager
+def db_conn():
+    with unit_of_work() as uow:
+        yield uow.connection()
+@contextmanager
+def db_savepoint():
+    """
+    db_conn() для хелперов, которые ловят ошибку БД, пишут её в лог и продолжают: внутри чужой единицы
+    работы блок выполняется в SAVEPOINT. Ошибка откатывает только его, и общая транзакция update
+    на PostgreSQL не остаётся прерванной (InFailedSqlTransaction) для остальных запросов.
+    """
+    if getattr(_db_local, "uow", None) is None:
+        with db_conn() as conn:
+            yield conn
+        return
+    with db_conn() as conn, conn.begin_nested():
+        yield conn
+def after_commit(fn, *args, **kwargs):
+    """Выполняет fn после коммита текущей единицы работы (или сразу, если её нет)"""
+    uow = getattr(_db_local, "uow", None)
+    if uow is None:
+        fn(*args, **kwargs)
+    else:
+        uow.callbacks.append((fn, args, kwargs))
 # --- Импорт для Google Sheets ---
-try:
-    import gspread
-    GOOGLE_SHEETS_ENABLED = True
+# gspread вместе с google-auth импортируется долго: при старте только проверяем, что он установлен,
+# а импорт и авторизация происходят при первой выгрузке (get_gs_client)
+GOOGLE_SHEETS_ENABLED = importlib.util.find_spec("gspread") is not None
+if GOOGLE_SHEETS_ENABLED:
     logger.info("gspread установлен. Интеграция с Google Sheets доступна.")
-except ImportError:
-    gspread = None  # type: ignore
-    GOOGLE_SHEETS_ENABLED = False
+else:
     logger.warning("gspread не установлен. Интеграция с Google Sheets отключена.")
 # --- Инициализация БД ---
 def init_db():
     try:
         with engine.connect() as conn:
+            storage.prepare_ddl(conn)
             # корзина (с ценой)
-            conn.execute(sql_text('''
+            conn.execute(sql_text(f'''
                 CREATE TABLE IF NOT EXISTS merch_cart (
-                    id SERIAL PRIMARY KEY,
+                    id {storage.serial_pk},
                     user_id INTEGER,
                     item TEXT,
                     quantity INTEGER,
@@ -81,17 +386,17 @@ def init_db():
                 )
             '''))
             # лог уникальных пользователей
-            conn.execute(sql_text('''
+            conn.execute(sql_text(f'''
                 CREATE TABLE IF NOT EXISTS user_log (
-                    id SERIAL PRIMARY KEY,
+                    id {storage.serial_pk},
                     user_id INTEGER,
                     date TEXT
                 )
             '''))
             # таблица заказов с статусами
-            conn.execute(sql_text('''
+            conn.execute(sql_text(f'''
                 CREATE TABLE IF NOT EXISTS merch_orders (
-                    id SERIAL PRIMARY KEY,
+                    id {storage.serial_pk},
                     user_id INTEGER,
                     username TEXT,
                     item TEXT,
@@ -103,12 +408,12 @@ def init_db():
                 )
             '''))
             # таблица отложенных (pending) заказов, ожидающих подтверждения владельца
-            conn.execute(sql_text('''
+            conn.execute(sql_text(f'''
                 CREATE TABLE IF NOT EXISTS merch_pending (
-                    id SERIAL PRIMARY KEY,
+                    id {storage.serial_pk},
                     user_id INTEGER,
                     username TEXT,
-                    items_json TEXT,
+                    items_json {storage.json_type},
                     total INTEGER,
                     date TEXT
                 )
@@ -122,9 +427,9 @@ def init_db():
                 )
             '''))
             # таблица отписчиков
-            conn.execute(sql_text('''
+            conn.execute(sql_text(f'''
                 CREATE TABLE IF NOT EXISTS unsubscriptions (
-                    id SERIAL PRIMARY KEY,
+                    id {storage.serial_pk},
                     user_id INTEGER,
                     date_unsubscribed TEXT,
                     username TEXT
@@ -152,70 +457,293 @@ def init_db():
             '''))
             # Индексы для ускорения запросов
             conn.execute(sql_text("CREATE INDEX IF NOT EXISTS user_log_date_idx ON user_log (date)"))
-            conn.execute(sql_text("CREATE INDEX IF NOT EXISTS merch_orders_user_id_idx ON merch_orders (user_id)"))
-            conn.execute(sql_text("CREATE INDEX IF NOT EXISTS merch_orders_status_idx ON merch_orders (status)"))
+            # Уникальность (user_id, date); на старой БД с дублями сначала нужна миграция Alembic, которая их удалит
+            try:
+                with conn.begin_nested():
+                    conn.execute(sql_text("CREATE UNIQUE INDEX IF NOT EXISTS user_log_user_date_uidx ON user_log (user_id, date)"))
+            except Exception as e:
+                logger.warning(f"Уникальный индекс user_log не создан (выполните alembic upgrade head): {e}")
+            # корзина: одна строка на (user_id, item); индекс заодно служит поиску по user_id
+            try:
+                with conn.begin_nested():
+                    conn.execute(sql_text("CREATE UNIQUE INDEX IF NOT EXISTS merch_cart_user_item_uidx ON merch_cart (user_id, item)"))
+            except Exception as e:
+                logger.warning(f"Уникальный индекс merch_cart не создан (выполните alembic upgrade head): {e}")
+            # составные индексы под keyset-пагинацию (ORDER BY id DESC)
+            conn.execute(sql_text("CREATE INDEX IF NOT EXISTS merch_orders_user_id_id_idx ON merch_orders (user_id, id DESC)"))
+            conn.execute(sql_text("CREATE INDEX IF NOT EXISTS merch_orders_status_id_idx ON merch_orders (status, id DESC)"))
+            # покрывающий индекс: сводка пользователя по статусам считается без чтения таблицы
+            conn.execute(sql_text("CREATE INDEX IF NOT EXISTS merch_orders_user_status_total_idx ON merch_orders (user_id, status, total)"))
             conn.execute(sql_text("CREATE INDEX IF NOT EXISTS unsubscriptions_date_idx ON unsubscriptions (date_unsubscribed)"))
             # таблица для черновиков/текстов рассылки (для безопасного подтверждения)
-            conn.execute(sql_text('''
+            conn.execute(sql_text(f'''
                 CREATE TABLE IF NOT EXISTS broadcasts (
-                    id SERIAL PRIMARY KEY,
+                    id {storage.serial_pk},
                     text TEXT NOT NULL,
                     created_at TEXT
                 )
             '''))
+            # прогресс рассылки: статус и чекпоинт (последний обработанный user_id) для продолжения после рестарта
+            storage.add_column(conn, "broadcasts", "status", "TEXT DEFAULT 'draft'")
+            storage.add_column(conn, "broadcasts", "last_user_id", "BIGINT DEFAULT 0")
+            storage.add_column(conn, "broadcasts", "sent", "INTEGER DEFAULT 0")
+            storage.add_column(conn, "broadcasts", "failed", "INTEGER DEFAULT 0")
+            storage.add_column(conn, "broadcasts", "progress_message_id", "BIGINT")
+            storage.add_column(conn, "broadcasts", "started_at", "TEXT")
+            storage.add_column(conn, "broadcasts", "finished_at", "TEXT")
+            # очередь строк для Google Sheets (отправляются фоновым экспортёром)
+            conn.execute(sql_text(f'''
+                CREATE TABLE IF NOT EXISTS sheets_outbox (
+                    id {storage.serial_pk},
+                    sheet TEXT NOT NULL,
+                    row_json TEXT NOT NULL,
+                    created_at TEXT
+                )
+            '''))
+            # кэш file_id Telegram для фото мерча (путь + хэш содержимого)
+            conn.execute(sql_text('''
+                CREATE TABLE IF NOT EXISTS media_cache (
+                    path TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    file_id TEXT NOT NULL,
+                    created_at TEXT,
+                    PRIMARY KEY (path, sha256)
+                )
+            '''))
+            # состояние диалогов (шаг сценария на чат) — общее для всех воркеров
+            conn.execute(sql_text('''
+                CREATE TABLE IF NOT EXISTS conversation_state (
+                    chat_id BIGINT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    item TEXT,
+                    expires_at DOUBLE PRECISION NOT NULL
+                )
+            '''))
+            conn.execute(sql_text("CREATE INDEX IF NOT EXISTS conversation_state_expires_idx ON conversation_state (expires_at)"))
+            # дневные агрегаты активности: точное число + HyperLogLog-скетч id пользователей
+            conn.execute(sql_text(f'''
+                CREATE TABLE IF NOT EXISTS daily_activity (
+                    day TEXT PRIMARY KEY,
+                    active_users INTEGER NOT NULL DEFAULT 0,
+                    hll {storage.blob_type} NOT NULL
+                )
+            '''))
+            conn.execute(sql_text(f'''
+                CREATE TABLE IF NOT EXISTS activity_sketches (
+                    scope TEXT PRIMARY KEY,
+                    hll {storage.blob_type} NOT NULL,
+                    updated_at TEXT
+                )
+            '''))
+            # аренда ведущего планировщика и история запусков фоновых задач
+            conn.execute(sql_text('''
+                CREATE TABLE IF NOT EXISTS job_leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    expires_at DOUBLE PRECISION NOT NULL,
+                    acquired_at TEXT
+                )
+            '''))
+            conn.execute(sql_text(f'''
+                CREATE TABLE IF NOT EXISTS job_runs (
+                    id {storage.serial_pk},
+                    job TEXT NOT NULL,
+                    holder TEXT,
+                    started_at TEXT NOT NULL,
+                    duration_ms INTEGER,
+                    status TEXT NOT NULL,
+                    error TEXT
+                )
+            '''))
+            conn.execute(sql_text("CREATE INDEX IF NOT EXISTS job_runs_job_id_idx ON job_runs (job, id DESC)"))
+            conn.execute(sql_text("CREATE INDEX IF NOT EXISTS job_runs_started_at_idx ON job_runs (started_at)"))
+            # очистка устаревших строк rate_limits идёт по индексу
+            conn.execute(sql_text("CREATE INDEX IF NOT EXISTS rate_limits_last_ts_idx ON rate_limits (last_ts)"))
+            # итоги заказов пользователя по статусам (см. refresh_order_stats); на пустой таблице — заполняем из merch_orders
+            conn.execute(sql_text('''
+                CREATE TABLE IF NOT EXISTS user_order_stats (
+                    user_id BIGINT NOT NULL,
+                    status TEXT NOT NULL,
+                    orders INTEGER NOT NULL DEFAULT 0,
+                    spent BIGINT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, status)
+                )
+            '''))
+            conn.execute(sql_text('''
+                INSERT INTO user_order_stats (user_id, status, orders, spent)
+                SELECT user_id, COALESCE(status, ''), COUNT(*), COALESCE(SUM(total), 0)
+                FROM merch_orders
+                WHERE user_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM user_order_stats)
+                GROUP BY user_id, COALESCE(status, '')
+            '''))
             conn.commit()
     except Exception as e:
         logger.error(f"Ошибка инициализации базы данных: {e}")
         raise
-init_db()
-# --- Интеграция с Google Sheets ---
-if GOOGLE_SHEETS_ENABLED:
-    def init_gspread():
+# Схема сверяется с ревизией Alembic: если база уже на SCHEMA_REVISION, DDL из init_db не выполняется.
+# DB_SCHEMA_MODE: auto — при несовпадении (или без Alembic, например SQLite) выполнить init_db;
+# verify — не запускать воркер, пока не выполнен alembic upgrade head; init — всегда init_db (как раньше).
+SCHEMA_REVISION = "20261018_12"  # голова alembic/versions — обновляется вместе с новой миграцией
+DB_SCHEMA_MODE = os.getenv("DB_SCHEMA_MODE", "auto").lower()
+
+def get_schema_revision(conn):
+    if not sqlalchemy.inspect(conn).has_table("alembic_version"):
+        return None
+    return conn.execute(sql_text("SELECT version_num FROM alembic_version")).scalar()
+def ensure_schema():
+    if DB_SCHEMA_MODE != "init":
         try:
-            credentials_path = os.getenv("GOOGLE_SHEETS_CREDENTIALS_PATH")
-            if not credentials_path:
-                logger.error("GOOGLE_SHEETS_CREDENTIALS_PATH не установлен")
-                return None
-            # gspread удобный хелпер для сервисного аккаунта
-            client = gspread.service_account(filename=credentials_path)
-            return client
+            with engine.connect() as conn:
+                revision = get_schema_revision(conn)
         except Exception as e:
-            logger.error(f"Ошибка инициализации Google Sheets: {e}")
-            return None
-    gs_client = init_gspread()
-    SPREADSHEET_ID = os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID")
+            logger.error(f"Ошибка подключения к {storage.name}: {e}")
+            raise
+        if revision == SCHEMA_REVISION:
+            logger.info(f"Успешное подключение к {storage.name}, схема на ревизии {revision}")
+            return
+        if DB_SCHEMA_MODE == "verify":
+            raise RuntimeError(f"Схема БД на ревизии {revision}, ожидается {SCHEMA_REVISION}: выполните alembic upgrade head")
+        logger.info(f"Ревизия схемы {revision} (ожидается {SCHEMA_REVISION}) — выполняем init_db")
+    init_db()
+    logger.info(f"Успешное подключение к {storage.name}")
+ensure_schema()
+# --- Интеграция с Google Sheets ---
+GOOGLE_SHEETS_CREDENTIALS_PATH = os.getenv("GOOGLE_SHEETS_CREDENTIALS_PATH")
+SPREADSHEET_ID = os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID")
+if GOOGLE_SHEETS_ENABLED:
+    if not GOOGLE_SHEETS_CREDENTIALS_PATH:
+        logger.error("GOOGLE_SHEETS_CREDENTIALS_PATH не установлен")
     if not SPREADSHEET_ID:
         logger.warning("GOOGLE_SHEETS_SPREADSHEET_ID не установлен")
-def log_order_to_google_sheets(order_id, user_id, username, item, quantity, price, total, date, status):
-    """Записывает информацию о заказе в Google Таблицу"""
-    if not GOOGLE_SHEETS_ENABLED or not gs_client or not SPREADSHEET_ID:
+_gs_client = None
+_gs_client_lock = threading.Lock()
+
+def get_gs_client():
+    """Клиент gspread: импорт и авторизация сервисного аккаунта при первом обращении"""
+    global _gs_client
+    with _gs_client_lock:
+        if _gs_client is None:
+            import gspread
+            # gspread удобный хелпер для сервисного аккаунта
+            _gs_client = gspread.service_account(filename=GOOGLE_SHEETS_CREDENTIALS_PATH)
+    return _gs_client
+# --- Фоновый экспорт в Google Sheets ---
+# Строки не пишутся в таблицу на пути запроса: они сохраняются в sheets_outbox (переживает рестарт),
+# а фоновый поток отправляет их пачками через append_rows — по размеру пачки или по таймеру.
+SHEETS_BATCH_SIZE = int(os.getenv("SHEETS_BATCH_SIZE", "50"))
+SHEETS_FLUSH_SECONDS = float(os.getenv("SHEETS_FLUSH_SECONDS", "10"))
+SHEETS_MAX_BACKOFF = 300  # секунд между повторами при ошибках API
+
+class SheetsExporter:
+    def __init__(self):
+        self._spreadsheet = None
+        self._worksheets = {}  # название листа -> Worksheet
+        self._wake = threading.Event()
+        self._pending = 0
+        self._backoff = 0
+        self._retry_at = 0.0
+        self._started = False
+    def start(self):
+        if self._started:
+            return  # воркер снова стал ведущим — поток уже работает
+        self._started = True
+        threading.Thread(target=self._run, name="sheets-exporter", daemon=True).start()
+    def enqueue(self, sheet, row):
+        """Ставит строку в очередь (в транзакции текущего update — вместе с основными данными)"""
+        self.enqueue_many(sheet, [row])
+    def enqueue_many(self, sheet, rows):
+        created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with db_conn() as conn:
+            bulk_insert(conn, "INSERT INTO sheets_outbox (sheet, row_json, created_at)", [
+                (sheet, json.dumps(row, ensure_ascii=False, default=str), created_at) for row in rows
+            ])
+        self._pending += len(rows)
+        if self._pending >= SHEETS_BATCH_SIZE:
+            self._wake.set()
+    def _worksheet(self, name):
+        ws = self._worksheets.get(name)
+        if ws is None:
+            if self._spreadsheet is None:
+                self._spreadsheet = get_gs_client().open_by_key(SPREADSHEET_ID)
+            ws = self._spreadsheet.worksheet(name)
+            self._worksheets[name] = ws
+        return ws
+    def flush(self):
+        """Отправляет все накопленные строки. Возвращает False, если API вернул ошибку."""
+        while True:
+            with engine.connect() as conn:
+                # SKIP LOCKED: несколько воркеров могут сбрасывать очередь одновременно без дублей
+                rows = conn.execute(sql_text(
+                    f"SELECT id, sheet, row_json FROM sheets_outbox ORDER BY id LIMIT :limit {storage.for_update(skip_locked=True)}"
+                ), {"limit": SHEETS_BATCH_SIZE * 10}).fetchall()
+                if not rows or not storage.row_locks:
+                    # SQLite: не держим блокировку записи на время запроса к API (экспортёр в процессе один)
+                    conn.commit()
+                if not rows:
+                    return True
+                by_sheet = {}
+                for row_id, sheet, row_json in rows:
+                    ids, values = by_sheet.setdefault(sheet, ([], []))
+                    ids.append(row_id)
+                    values.append(json.loads(row_json))
+                ok = True
+                for sheet, (ids, values) in by_sheet.items():
+                    try:
+                        self._worksheet(sheet).append_rows(values)
+                    except Exception as e:
+                        logger.error(f"Ошибка записи в Google Sheets (лист {sheet}): {e}")
+                        # дескрипторы могли устареть — откроем заново при следующей попытке
+                        self._spreadsheet = None
+                        self._worksheets.clear()
+                        ok = False
+                        break
+                    conn.execute(sql_text("DELETE FROM sheets_outbox WHERE id = :id"), [{"id": i} for i in ids])
+                conn.commit()
+            if not ok:
+                return False
+    def _run(self):
+        while True:
+            self._wake.wait(timeout=self._backoff or SHEETS_FLUSH_SECONDS)
+            self._wake.clear()
+            if time.monotonic() < self._retry_at:
+                continue
+            if not job_runner.is_leader:
+                continue  # ведущим стал другой воркер — очередь выгружает он
+            self._pending = 0
+            try:
+                ok = self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка выгрузки в Google Sheets: {e}")
+                ok = False
+            if ok:
+                self._backoff = 0
+            else:
+                self._backoff = min(SHEETS_MAX_BACKOFF, max(5, self._backoff * 2))
+                self._retry_at = time.monotonic() + self._backoff
+
+def _sheets_ready():
+    return bool(GOOGLE_SHEETS_ENABLED and GOOGLE_SHEETS_CREDENTIALS_PATH and SPREADSHEET_ID)
+sheets_exporter = SheetsExporter()  # поток запускает ведущий воркер (BackgroundServices)
+def log_orders_to_google_sheets(orders):
+    """Ставит заказы (строки merch_orders: id, user_id, username, item, quantity, price, total, date, status) в очередь Google Таблицы"""
+    if not _sheets_ready():
         return False
     try:
-        sheet = gs_client.open_by_key(SPREADSHEET_ID).worksheet("Заказы")
-        # Добавляем новую строку
-        sheet.append_row([
-            order_id,
-            user_id,
-            username or f"ID:{user_id}",
-            item,
-            quantity,
-            price,
-            total,
-            date,
-            status,
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S")  # Время записи
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")  # Время записи
+        sheets_exporter.enqueue_many("Заказы", [
+            [order_id, user_id, username or f"ID:{user_id}", item, quantity, price, total, order_date, status, now]
+            for order_id, user_id, username, item, quantity, price, total, order_date, status in orders
         ])
         return True
     except Exception as e:
         logger.error(f"Ошибка записи заказа в Google Sheets: {e}")
         return False
 def log_subscription_to_google_sheets(user_id, date_subscribed, username):
-    """Записывает информацию о подписке в Google Таблицу"""
-    if not GOOGLE_SHEETS_ENABLED or not gs_client or not SPREADSHEET_ID:
+    """Ставит информацию о подписке в очередь на запись в Google Таблицу"""
+    if not _sheets_ready():
         return False
     try:
-        sheet = gs_client.open_by_key(SPREADSHEET_ID).worksheet("Подписчики")
-        sheet.append_row([
+        sheets_exporter.enqueue("Подписчики", [
             user_id,
             username or f"ID:{user_id}",
             date_subscribed,
@@ -226,12 +754,11 @@ def log_subscription_to_google_sheets(user_id, date_subscribed, username):
         logger.error(f"Ошибка записи подписки в Google Sheets: {e}")
         return False
 def log_unsubscription_to_google_sheets(user_id, date_unsubscribed, username):
-    """Записывает информацию об отписке в Google Таблицу"""
-    if not GOOGLE_SHEETS_ENABLED or not gs_client or not SPREADSHEET_ID:
+    """Ставит информацию об отписке в очередь на запись в Google Таблицу"""
+    if not _sheets_ready():
         return False
     try:
-        sheet = gs_client.open_by_key(SPREADSHEET_ID).worksheet("Отписчики")
-        sheet.append_row([
+        sheets_exporter.enqueue("Отписчики", [
             user_id,
             username or f"ID:{user_id}",
             date_unsubscribed,
@@ -242,12 +769,11 @@ def log_unsubscription_to_google_sheets(user_id, date_unsubscribed, username):
         logger.error(f"Ошибка записи отписки в Google Sheets: {e}")
         return False
 def log_user_to_google_sheets(user_id, date_registered, username):
-    """Записывает информацию о новом пользователе в Google Таблицу"""
-    if not GOOGLE_SHEETS_ENABLED or not gs_client or not SPREADSHEET_ID:
+    """Ставит информацию о новом пользователе в очередь на запись в Google Таблицу"""
+    if not _sheets_ready():
         return False
     try:
-        sheet = gs_client.open_by_key(SPREADSHEET_ID).worksheet("Пользователи")
-        sheet.append_row([
+        sheets_exporter.enqueue("Пользователи", [
             user_id,
             username or f"ID:{user_id}",
             date_registered,
@@ -258,12 +784,11 @@ def log_user_to_google_sheets(user_id, date_registered, username):
         logger.error(f"Ошибка записи пользователя в Google Sheets: {e}")
         return False
 def log_referral_to_google_sheets(user_id, referrer_id, referral_code, date_registered, username):
-    """Записывает информацию о реферале в Google Таблицу"""
-    if not GOOGLE_SHEETS_ENABLED or not gs_client or not SPREADSHEET_ID:
+    """Ставит информацию о реферале в очередь на запись в Google Таблицу"""
+    if not _sheets_ready():
         return False
     try:
-        sheet = gs_client.open_by_key(SPREADSHEET_ID).worksheet("Рефералы")
-        sheet.append_row([
+        sheets_exporter.enqueue("Рефералы", [
             user_id,
             username or f"ID:{user_id}",
             referrer_id or "Нет",
@@ -275,93 +800,1025 @@ def log_referral_to_google_sheets(user_id, referrer_id, referral_code, date_regi
     except Exception as e:
         logger.error(f"Ошибка записи реферала в Google Sheets: {e}")
         return False
+# --- Планировщик задач с выбором ведущего ---
+# Периодические задачи развёртывания (статистика, очистка, рассылки, автопинг) выполняет один воркер —
+# владелец аренды 'scheduler' в job_leases. Ведущий продлевает аренду каждые JOB_LEASE_SECONDS / 3;
+# если он завис или умер, аренда истекает и её забирает любой другой воркер (на любом инстансе).
+# Время аренды — часы приложения (time.time()), поэтому часы инстансов должны быть синхронизированы.
+# Каждый запуск задачи ведущего записывается в job_runs (длительность, результат).
+# Задачи над памятью процесса (сброс буферов rate limit и user_log) выполняются в каждом воркере —
+# у каждого свой буфер; для них только метрики, без истории в БД.
+JOB_LEASE_NAME = "scheduler"
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "30"))
+JOB_RUNS_RETENTION_DAYS = int(os.getenv("JOB_RUNS_RETENTION_DAYS", "14"))
+job_duration = Histogram("job_duration_seconds", "Время выполнения фоновой задачи", ("job",))
+job_runs_total = Counter("job_runs_total", "Запуски фоновых задач по результату", ("job", "status"))
+METRICS += [job_duration, job_runs_total]
+
+class JobRunner:
+    def __init__(self, lease_name=JOB_LEASE_NAME, lease_seconds=JOB_LEASE_SECONDS):
+        self.lease_name = lease_name
+        self.lease_seconds = lease_seconds
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self._jobs = []  # (func, trigger, run_at_start, kwargs) для планировщика ведущего
+        self._local_jobs = []  # (func, интервал в секундах) — в каждом воркере
+        self._lease_expires = 0.0
+        self._stop = threading.Event()
+        self.scheduler = None
+    def add_job(self, func, trigger=None, run_at_start=False, **kwargs):
+        """
+        Задача ведущего; аргументы — как у APScheduler add_job, id обязателен (имя в job_runs).
+        run_at_start — первый запуск сразу, как только воркер станет ведущим (в том числе после failover).
+        """
+        name = kwargs["id"]
+        self._jobs.append((self._leader_only(name, func), trigger, run_at_start, kwargs))
+    def add_local_job(self, func, seconds):
+        self._local_jobs.append((func, seconds))
+    @property
+    def is_leader(self):
+        return self.scheduler is not None
+    def holds_lease(self):
+        return self.is_leader and time.time() < self._lease_expires
+    def start(self):
+        threading.Thread(target=self._run, name="job-runner", daemon=True).start()
+    def stop(self):
+        """Останавливает задачи и освобождает аренду — другой воркер подхватит её сразу, не дожидаясь истечения"""
+        self._stop.set()
+        was_leader = self.is_leader
+        self._resign()
+        if was_leader:
+            try:
+                with db_conn() as conn:
+                    conn.execute(sql_text(
+                        "UPDATE job_leases SET expires_at = 0 WHERE name = :name AND holder = :holder"
+                    ), {"name": self.lease_name, "holder": self.holder})
+            except Exception as e:
+                logger.error(f"Ошибка освобождения аренды {self.lease_name}: {e}")
+    def _run(self):
+        now = time.monotonic()
+        due = [now + seconds for _, seconds in self._local_jobs]
+        next_lease = now
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now >= next_lease:
+                next_lease = now + self.lease_seconds / 3
+                self._refresh_lease()
+            for i, (func, seconds) in enumerate(self._local_jobs):
+                if now >= due[i]:
+                    due[i] = now + seconds
+                    self._execute(func.__name__, func, record=False)
+            self._stop.wait(max(0.05, min(due + [next_lease]) - time.monotonic()))
+    def _refresh_lease(self):
+        now = time.time()
+        try:
+            with db_conn() as conn:
+                # захват истёкшей аренды или продление своей — одной командой, без гонки между воркерами
+                holder = conn.execute(sql_text('''
+                    INSERT INTO job_leases (name, holder, expires_at, acquired_at)
+                    VALUES (:name, :holder, :expires, :acquired_at)
+                    ON CONFLICT (name) DO UPDATE SET
+                        holder = EXCLUDED.holder,
+                        expires_at = EXCLUDED.expires_at,
+                        acquired_at = CASE WHEN job_leases.holder = EXCLUDED.holder
+                                           THEN job_leases.acquired_at ELSE EXCLUDED.acquired_at END
+                    WHERE job_leases.holder = EXCLUDED.holder OR job_leases.expires_at < :now
+                    RETURNING holder
+                '''), {"name": self.lease_name, "holder": self.holder, "expires": now + self.lease_seconds,
+                       "acquired_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "now": now}).scalar()
+        except Exception as e:
+            logger.error(f"Ошибка продления аренды {self.lease_name}: {e}")
+            if self.is_leader and not self.holds_lease():
+                self._resign()  # аренда истекла, пока БД недоступна, — её мог забрать другой воркер
+            return
+        if holder != self.holder:
+            if self.is_leader:
+                logger.warning(f"Аренда {self.lease_name} перешла другому воркеру")
+                self._resign()
+            return
+        self._lease_expires = now + self.lease_seconds
+        if not self.is_leader:
+            try:
+                self._lead()
+            except Exception as e:
+                logger.error(f"Ошибка запуска задач ведущего: {e}")
+                self._resign()
+    def _lead(self):
+        from apscheduler.schedulers.background import BackgroundScheduler  # тяжёлый импорт — только у ведущего
+        sync_webhook()
+        scheduler = BackgroundScheduler()
+        for func, trigger, run_at_start, kwargs in self._jobs:
+            if run_at_start:
+                kwargs = dict(kwargs, next_run_time=datetime.now())
+            scheduler.add_job(func, trigger, **kwargs)
+        scheduler.start()
+        self.scheduler = scheduler
+        if _sheets_ready():
+            sheets_exporter.start()
+        logger.info(f"Воркер {self.holder} стал ведущим: задач {len(self._jobs)}")
+    def _resign(self):
+        scheduler, self.scheduler = self.scheduler, None
+        self._lease_expires = 0.0
+        if scheduler is not None:
+            try:
+                scheduler.shutdown(wait=False)
+            except Exception:
+                pass
+    def _leader_only(self, name, func):
+        @functools.wraps(func)
+        def run():
+            if not self.holds_lease():
+                return  # аренда потеряна после планирования запуска — задачу выполнит новый ведущий
+            self._execute(name, func, record=True)
+        return run
+    def _execute(self, name, func, record):
+        started_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        started = time.perf_counter()
+        status, error = "ok", None
+        try:
+            func()
+        except Exception as e:
+            status, error = "error", str(e)[:500]
+            logger.error(f"Ошибка фоновой задачи {name}: {e}")
+        duration = time.perf_counter() - started
+        job_duration.observe(duration, name)
+        job_runs_total.inc(name, status)
+        if not record:
+            return
+        try:
+            with db_conn() as conn:
+                conn.execute(sql_text('''
+                    INSERT INTO job_runs (job, holder, started_at, duration_ms, status, error)
+                    VALUES (:job, :holder, :started_at, :duration_ms, :status, :error)
+                '''), {"job": name, "holder": self.holder, "started_at": started_at,
+                       "duration_ms": int(duration * 1000), "status": status, "error": error})
+        except Exception as e:
+            logger.error(f"Ошибка записи истории задачи {name}: {e}")
+    def prune_history(self):
+        cutoff = (datetime.now() - timedelta(days=JOB_RUNS_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        with db_conn() as conn:
+            conn.execute(sql_text("DELETE FROM job_runs WHERE started_at < :cutoff"), {"cutoff": cutoff})
+job_runner = JobRunner()
+atexit.register(job_runner.stop)
+# --- Инвалидация кэшей между воркерами ---
+# Писатель публикует "topic:key" в канал PostgreSQL (в своей транзакции), остальные воркеры
+# получают уведомление после коммита и выбрасывают ключ из своего кэша.
+INVALIDATION_CHANNEL = "cache_invalidation"
+
+class InvalidationBus:
+    def __init__(self):
+        self._topics = {}  # topic -> (invalidate(key), reset())
+        # PID не уникален между контейнерами (часто 1) — чужое уведомление приняли бы за своё;
+        # без ":" — это разделитель полей в payload
+        self._source = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex}".replace(":", "-")
+    def subscribe(self, topic, invalidate, reset):
+        self._topics[topic] = (invalidate, reset)
+    def publish(self, conn, topic, key):
+        storage.notify(conn, INVALIDATION_CHANNEL, f"{self._source}:{topic}:{key}")
+    def start(self):
+        if storage.multi_process:
+            threading.Thread(target=self._listen, name="cache-invalidation", daemon=True).start()
+    def _reset_all(self):
+        for _, reset in self._topics.values():
+            reset()
+    def _dispatch(self, payload):
+        source, topic, key = payload.split(":", 2)
+        if source == self._source:
+            return  # свой кэш писатель уже обновил
+        handlers = self._topics.get(topic)
+        if handlers:
+            handlers[0](key)
+    def _listen(self):
+        while True:
+            raw = None
+            try:
+                # отдельное соединение вне пула: LISTEN держит его всё время жизни процесса
+                raw = engine.raw_connection()
+                raw.detach()
+                dbapi_conn = raw.driver_connection
+                dbapi_conn.autocommit = True
+                with dbapi_conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {INVALIDATION_CHANNEL}")
+                # пока слушателя не было, уведомления могли потеряться
+                self._reset_all()
+                while True:
+                    if select.select([dbapi_conn], [], [], 60) == ([], [], []):
+                        continue
+                    dbapi_conn.poll()
+                    while dbapi_conn.notifies:
+                        self._dispatch(dbapi_conn.notifies.pop(0).payload)
+            except Exception as e:
+                logger.error(f"Ошибка слушателя инвалидаций: {e}")
+                self._reset_all()
+                time.sleep(5)
+            finally:
+                if raw is not None:
+                    try:
+                        raw.close()
+                    except Exception:
+                        pass
+invalidation_bus = InvalidationBus()
+
+_MISSING = object()
+class LRUCache:
+    """Потокобезопасный LRU-кэш ограниченного размера"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    def get(self, key, default=_MISSING):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    def prune(self, predicate):
+        """Удаляет записи, для которых predicate(value) истинно"""
+        with self._lock:
+            for key, value in list(self._data.items()):
+                if predicate(value):
+                    del self._data[key]
+# --- Состояние диалогов ---
+# Вместо замыканий register_next_step_handler (живут в памяти одного воркера и не истекают)
+# шаг сценария хранится в conversation_state: (state, item, expires_at) на чат.
+# Чтение идёт из LRU-кэша процесса, включая отрицательные записи («чат не в сценарии»).
+CONVERSATION_TTL_SECONDS = int(os.getenv("CONVERSATION_TTL_SECONDS", "900"))
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "10000"))
+
+class ConversationStore:
+    def __init__(self, ttl, cache_size):
+        self.ttl = ttl
+        self._cache = LRUCache(cache_size)  # chat_id -> (state, item, expires_at) или None
+        self._local = threading.local()  # чаты, которым текущий шаг назначил следующий
+        invalidation_bus.subscribe("conversation", lambda key: self._cache.pop(int(key)), self._cache.clear)
+    def get(self, chat_id):
+        """(state, item, expires_at) или None, если чат не в сценарии или шаг истёк"""
+        entry = self._cache.get(chat_id)
+        if entry is _MISSING:
+            try:
+                with db_savepoint() as conn:
+                    row = conn.execute(sql_text(
+                        "SELECT state, item, expires_at FROM conversation_state WHERE chat_id = :chat_id"
+                    ), {"chat_id": chat_id}).fetchone()
+            except Exception as e:
+                logger.error(f"Ошибка чтения состояния диалога {chat_id}: {e}")
+                return None
+            entry = tuple(row) if row else None
+            self._cache.put(chat_id, entry)
+        if entry and entry[2] < time.time():
+            return None
+        return entry
+    def set(self, chat_id, state, item=None):
+        """Назначает чату следующий шаг (аналог register_next_step_handler)"""
+        entry = (state, item, time.time() + self.ttl)
+        with db_conn() as conn:
+            conn.execute(sql_text(
+                "INSERT INTO conversation_state (chat_id, state, item, expires_at) VALUES (:chat_id, :state, :item, :expires_at) "
+                "ON CONFLICT (chat_id) DO UPDATE SET state = EXCLUDED.state, item = EXCLUDED.item, expires_at = EXCLUDED.expires_at"
+            ), {"chat_id": chat_id, "state": state, "item": item, "expires_at": entry[2]})
+            invalidation_bus.publish(conn, "conversation", chat_id)
+        getattr(self._local, "stepped", set()).add(chat_id)
+        after_commit(self._cache.put, chat_id, entry)
+    def clear(self, chat_id):
+        with db_conn() as conn:
+            conn.execute(sql_text("DELETE FROM conversation_state WHERE chat_id = :chat_id"), {"chat_id": chat_id})
+            invalidation_bus.publish(conn, "conversation", chat_id)
+        after_commit(self._cache.put, chat_id, None)
+    @contextmanager
+    def step(self, chat_id):
+        """Шаг сценария: если обработчик не назначил следующий шаг, состояние снимается"""
+        self._local.stepped = set()
+        try:
+            yield
+        finally:
+            stepped, self._local.stepped = self._local.stepped, set()
+            if chat_id not in stepped:
+                try:
+                    self.clear(chat_id)
+                except Exception as e:
+                    logger.error(f"Ошибка сброса состояния диалога {chat_id}: {e}")
+    def prune_job(self):
+        """Удаляет истёкшие шаги из БД и кэша"""
+        now = time.time()
+        try:
+            with db_conn() as conn:
+                conn.execute(sql_text("DELETE FROM conversation_state WHERE expires_at < :now"), {"now": now})
+        except Exception as e:
+            logger.error(f"Ошибка очистки состояний диалогов: {e}")
+        self._cache.prune(lambda entry: entry is not None and entry[2] < now)
+conversations = ConversationStore(CONVERSATION_TTL_SECONDS, CONVERSATION_CACHE_SIZE)
 # --- Инициализация бота и Flask ---
 app = Flask(__name__)
-bot = telebot.TeleBot(TOKEN)
-bot.remove_webhook()
-# Устанавливаем вебхук с secret_token, если библиотека поддерживает и секрет задан
-try:
-    if WEBHOOK_SECRET:
-        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
-    else:
-        bot.set_webhook(url=WEBHOOK_URL)
-except TypeError:
-    # Для старых версий pyTelegramBotAPI без secret_token параметра
-    bot.set_webhook(url=WEBHOOK_URL)
+# threaded=False: обработчики выполняются в потоках очереди вебхука (см. UpdateQueue), где сохраняется порядок по чату
+def _instrument_handler(fn, name=None):
+    """Оборачивает обработчик: время выполнения и исключения по имени функции"""
+    label = name or getattr(fn, "__name__", "handler")
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(label)
+            raise
+        finally:
+            handler_latency.observe(time.perf_counter() - started, label)
+    return wrapper
+class InstrumentedTeleBot(telebot.TeleBot):
+    """
+    TeleBot, который оборачивает обработчики при регистрации — сами обработчики не меняются.
+    Кнопки с точным текстом регистрируются через text_handler и находятся одним поиском в dict
+    вместо перебора всех func=lambda m: m.text == ...; команды, next-step и прочие фильтры
+    обрабатываются штатной цепочкой telebot.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._text_routes = {}  # текст кнопки -> обработчик
+        self._state_handlers = {}  # шаг сценария (conversation_state.state) -> обработчик
+        # сначала шаг сценария (как раньше next-step), затем кнопки; остальное — штатная цепочка telebot
+        super().add_message_handler(self._build_handler_dict(
+            self._dispatch_state, content_types=["text"], func=self._has_state
+        ))
+        super().add_message_handler(self._build_handler_dict(
+            self._dispatch_text, content_types=["text"], func=self._has_text_route
+        ))
+    def _has_state(self, message):
+        # шаг без обработчика сообщений (например, выбор заказов кнопками) текст не перехватывает
+        entry = conversations.get(message.chat.id)
+        return entry is not None and entry[0] in self._state_handlers
+    def _dispatch_state(self, message):
+        entry = conversations.get(message.chat.id)
+        if entry is None:
+            return  # шаг истёк между проверкой и вызовом
+        state, item, _ = entry
+        handler = self._state_handlers.get(state)
+        with conversations.step(message.chat.id):
+            if handler is None:
+                logger.warning(f"Нет обработчика для шага {state!r}")
+            elif item is None:
+                handler(message)
+            else:
+                handler(message, item)
+    def _has_text_route(self, message):
+        return message.text in self._text_routes
+    def _dispatch_text(self, message):
+        return self._text_routes[message.text](message)
+    def state_handler(self, state):
+        """Обработчик шага сценария; назначается через conversations.set(chat_id, state, item)"""
+        def decorator(fn):
+            self._state_handlers[state] = _instrument_handler(fn)
+            return fn
+        return decorator
+    def text_handler(self, *texts):
+        """Аналог @message_handler(func=lambda m: m.text == text) для одного или нескольких текстов"""
+        def decorator(fn):
+            wrapped = _instrument_handler(fn)
+            for text in texts:
+                if text in self._text_routes:
+                    # как и в цепочке telebot, срабатывает первый зарегистрированный обработчик
+                    logger.warning(f"Текст {text!r} уже обрабатывает другой обработчик")
+                    continue
+                self._text_routes[text] = wrapped
+            return fn
+        return decorator
+    def add_message_handler(self, handler_dict):
+        handler_dict["function"] = _instrument_handler(handler_dict["function"])
+        return super().add_message_handler(handler_dict)
+    def add_callback_query_handler(self, handler_dict):
+        handler_dict["function"] = _instrument_handler(handler_dict["function"])
+        return super().add_callback_query_handler(handler_dict)
+
+# Все запросы к Bot API проходят через apihelper._make_request: считаем их по методу (sendMessage -> send_message)
+_api_method_labels = {}
+_original_make_request = telebot.apihelper._make_request
+def _timed_make_request(token, method_name, *args, **kwargs):
+    label = _api_method_labels.get(method_name)
+    if label is None:
+        label = _api_method_labels[method_name] = re.sub(r"(?<!^)(?=[A-Z])", "_", method_name).lower()
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        return _original_make_request(token, method_name, *args, **kwargs)
+    except ApiTelegramException as e:
+        status = str(e.error_code)
+        raise
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        telegram_api_latency.observe(time.perf_counter() - started, label)
+        telegram_api_calls.inc(label, status)
+telebot.apihelper._make_request = _timed_make_request
+# Другой адрес Bot API: локальный telegram-bot-api или заглушка из bench/fake_telegram.py
+TELEGRAM_API_URL = _normalize_base_url(os.getenv("TELEGRAM_API_URL", ""))
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+bot = InstrumentedTeleBot(TOKEN, threaded=False)
+# setWebhook заменяет прежний адрес сам, remove_webhook перед ним не нужен. Telegram не возвращает
+# secret_token в getWebhookInfo — после смены TELEGRAM_WEBHOOK_SECRET задайте WEBHOOK_FORCE_SET=1.
+WEBHOOK_FORCE_SET = os.getenv("WEBHOOK_FORCE_SET", "0") == "1"
+
+def sync_webhook():
+    """Регистрирует вебхук, только если Telegram знает другой адрес (вызывает ведущий воркер)"""
+    try:
+        info = bot.get_webhook_info()
+        if info.url == WEBHOOK_URL and not WEBHOOK_FORCE_SET:
+            logger.info("Вебхук уже установлен")
+            return
+        # Устанавливаем вебхук с secret_token, если библиотека поддерживает и секрет задан
+        try:
+            if WEBHOOK_SECRET:
+                bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+            else:
+                bot.set_webhook(url=WEBHOOK_URL)
+        except TypeError:
+            # Для старых версий pyTelegramBotAPI без secret_token параметра
+            bot.set_webhook(url=WEBHOOK_URL)
+        logger.info("Вебхук установлен")
+    except Exception as e:
+        logger.error(f"Ошибка установки вебхука: {e}")
 # --- Словарь товаров мерча (название: (цена, файл фото или список фото)) ---
 MERCH_ITEMS = {
     "👜 Сумка Шоппер":   (500, ["shopper.jpg", "shopper1.jpg"]),
     "☕ Кружки":    (300, "mug.jpg"),
     "👕 Футболки":  (800, "tshirt.jpg")
 }
-# --- Rate limiting на PostgreSQL ---
+# --- Кэш file_id для фото мерча ---
+# После первой загрузки Telegram возвращает file_id — дальше отправляем по нему, без повторной загрузки файла.
+# Ключ: (путь, sha256 содержимого), чтобы замена фото в photos/ автоматически приводила к новой загрузке.
+_media_cache = {}    # (path, sha256) -> file_id
+_media_digests = {}  # path -> (mtime_ns, size, sha256)
+
+def _media_digest(file_path):
+    """sha256 файла; пересчитывается только если файл изменился (mtime/размер)"""
+    st = os.stat(file_path)
+    cached = _media_digests.get(file_path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    with open(file_path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    _media_digests[file_path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+def get_cached_file_id(file_path, digest):
+    key = (file_path, digest)
+    file_id = _media_cache.get(key)
+    if file_id:
+        return file_id
+    try:
+        with db_savepoint() as conn:
+            row = conn.execute(sql_text(
+                "SELECT file_id FROM media_cache WHERE path = :path AND sha256 = :sha256"
+            ), {"path": file_path, "sha256": digest}).fetchone()
+        if row:
+            _media_cache[key] = row[0]
+            return row[0]
+    except Exception as e:
+        logger.error(f"Ошибка чтения кэша медиа: {e}")
+    return None
+def remember_file_id(file_path, digest, file_id):
+    _media_cache[(file_path, digest)] = file_id
+    try:
+        with db_savepoint() as conn:
+            conn.execute(sql_text(
+                "INSERT INTO media_cache (path, sha256, file_id, created_at) VALUES (:path, :sha256, :file_id, :created_at) "
+                "ON CONFLICT (path, sha256) DO UPDATE SET file_id = EXCLUDED.file_id, created_at = EXCLUDED.created_at"
+            ), {
+                "path": file_path,
+                "sha256": digest,
+                "file_id": file_id,
+                "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            })
+    except Exception as e:
+        logger.error(f"Ошибка записи кэша медиа: {e}")
+def forget_file_id(file_path, digest):
+    _media_cache.pop((file_path, digest), None)
+    try:
+        with db_savepoint() as conn:
+            conn.execute(sql_text(
+                "DELETE FROM media_cache WHERE path = :path AND sha256 = :sha256"
+            ), {"path": file_path, "sha256": digest})
+    except Exception as e:
+        logger.error(f"Ошибка очистки кэша медиа: {e}")
+def _is_stale_file_id_error(e):
+    """400 Bad Request про file_id: фото не дошло, и сохранённый идентификатор больше не годится"""
+    if not isinstance(e, ApiTelegramException) or e.error_code != 400:
+        return False
+    description = (e.description or "").lower()
+    return "file identifier" in description or "file_id" in description or "file reference" in description
+def send_merch_photos(chat_id, file_paths, caption):
+    """
+    Отправляет одно фото или альбом. Закэшированные фото отправляются по file_id,
+    остальные загружаются, и их file_id сохраняется. Возвращает True при успехе.
+    """
+    entries = []  # (path, digest, file_id или None)
+    for file_path in file_paths:
+        try:
+            digest = _media_digest(file_path)
+        except OSError as e:
+            logger.error(f"Ошибка при загрузке фото {file_path}: {e}")
+            continue
+        entries.append((file_path, digest, get_cached_file_id(file_path, digest)))
+    if not entries:
+        return False
+    try:
+        if len(entries) == 1:
+            file_path, digest, file_id = entries[0]
+            if file_id:
+                bot.send_photo(chat_id, file_id, caption=caption)
+                return True
+            with open(file_path, "rb") as photo:
+                msg = bot.send_photo(chat_id, photo, caption=caption)
+            remember_file_id(file_path, digest, msg.photo[-1].file_id)
+            return True
+        media = []
+        for i, (file_path, digest, file_id) in enumerate(entries):
+            if file_id:
+                source = file_id
+            else:
+                with open(file_path, "rb") as f:
+                    source = BytesIO(f.read())
+                source.name = os.path.basename(file_path)
+            # Для первого фото добавляем описание и цену
+            media.append(types.InputMediaPhoto(source, caption=caption if i == 0 else None))
+        msgs = bot.send_media_group(chat_id, media)
+        for (file_path, digest, file_id), msg in zip(entries, msgs):
+            if not file_id and msg.photo:
+                remember_file_id(file_path, digest, msg.photo[-1].file_id)
+        return True
+    except ApiTelegramException as e:
+        # file_id мог стать недействительным (например, сменился бот) — сбрасываем кэш и пробуем загрузить заново.
+        # 429, 5xx и таймауты пробрасываются: кэш цел, а альбом мог уже дойти — повтор отправил бы его дважды
+        stale = [(p, d) for p, d, file_id in entries if file_id]
+        if not stale or not _is_stale_file_id_error(e):
+            raise
+        logger.warning(f"Отправка по file_id не удалась, загружаем фото заново: {e}")
+        for file_path, digest in stale:
+            forget_file_id(file_path, digest)
+        return send_merch_photos(chat_id, file_paths, caption)
+# --- Каталог статических ответов ---
+# Тексты и клавиатуры собираются один раз при старте: JSON клавиатур сериализуется заранее,
+# обработчики отправляют готовые объекты. Каталог пересобирается, только если изменились
+# MERCH_ITEMS, TEXTS или раскладки клавиатур (refresh_response_catalog).
+TEXTS = {
+    "welcome": "👋 Добро пожаловать!\n"
+                "👥 Команда — узнайте о наших преподавателях и их опыте\n"
+                "🌍 Путешествия — эксклюзивные туры и духовные ретриты\n"
+                "🧘 Кундалини-йога — онлайн и офлайн занятия для трансформации\n"
+                "📸 Медиа — фото и видео с наших мероприятий и путешествий\n"
+                "🛍 Мерч — одежда и аксессуары для поддержки ScanDream\n"
+                "🎁 Доп. услуги — можете подписаться на события, что бы узнать первыми о наших будущих поездках!",
+    "cabinet": "👤 Ваш личный кабинет",
+    "back_to_cabinet": "Нажмите 'Личный кабинет' для возврата",
+    "travels": "✈️ Путешествия: архив и текущее местоположение.",
+    "yoga": "🧘 Кундалини-йога: офлайн, онлайн и ближайшие события.",
+    "online_yoga": """Это уникальная возможность быть в поле мастера онлайн. Практики диктуемые эпохой Водолея. Медитации. Работа в малых группах.
+Занятия проходят каждый вт и чт в 05:00 по мск. Все записи хранятся в канале группы.
+Ценность: 2500 рублей месяц, продление - 2300 руб.
+Хотите посмотреть пробный класс?""",
+    "online_yoga_trial_link": "https://disk.yandex.ru/i/nCQFa8edIspzNA  ",
+    "online_yoga_trial": "Если вам понравилось и вы хотели бы дополнительно узнать больше о онлайн занятии, нажмите кнопку приобрести подписку и мы обязательно свяжемся с вами!",
+    "subscription_thanks": "Спасибо, что выбрали нас, мы скоро свяжемся с вами! 😊",
+    "upcoming_events": """- 10 августа мы отправляемся в «Большой Волжский Путь», путешествие на автодоме из Карелии на фестиваль кундалини-йоги в Волгоград:
+7 августа - Тольятти - <a href="https://t.me/+PosQ9pcHMIk4NjQ6  ">Большой класс и саундхидинг</a>
+9 августа - Волгоград - <a href="https://t.me/+ii8MpmrGhMo2YTVi  ">Большой класс и саундхилинг</a>
+10 августа - площадка 17 фестиваля кундалини-йоги - Большой класс.
+11 - 19 августа фестиваль кундалини-йоги (Волгоград)""",
+    "youtube": "https://www.youtube.com/@ScanDreamChannel  ",
+    "media": "🎥 Медиа: наши видео на YouTube.",
+    "services": "🔧 Дополнительные услуги: детали по запросу.",
+    "team": """Нас зовут Алексей Бабенко — учитель кундалини-йоги, визионер, путешественник, кинематографист, медиа-продюсер.
+Более 20 лет личной практики, 18 лет преподавания. Преподаватель тренинга школы Амрит Нам Саровар (Франция) в России.
+Создатель йога-кемпа и ретритов по Карелии, Северной Осетии, Грузии, Армении и Турции.
+И Анастасия Голик — сертифицированный инструктор хатха-йоги, аромапрактик, вдохновитель и заботливая спутница ретритов.""",
+    "about_brand": """ScanDream - https://t.me/scandream   - зарегистрированный товарный знак, основная идея которого осознанные творческие коммуникации. ScanDream - это место, где мы пересобираем конструкт Мира, рассматривая и восхищаясь его строением. Быть #scandream - это сканировать свое жизненное предназначение действием и мечтой. В реальности оставаться активным, осознанным и логичным, а мечтать широко, мощно, свободно и не ощущая предела. 
+Проект йога-кемп - это творческая интеграция опыта и пользы. Пользы через новые знания и умения. Умения через новые формы.""",
+    "official_sources": """ОФИЦИАЛЬНЫЕ ИСТОЧНИКИ взаимодействия с командой ScanDream:
+1. Личная страница в ВК Алексея - https://vk.ru/scandream  
+2. Моя личная страница в ВК - https://vk.ru/yoga.golik  
+3. Официальный ТГ канал ScanDream•Live - https://t.me/scandream  
+4. Личный ТГ канал Алексея - https://t.me/scandreamlife  
+5. Личный мой ТГ канал - https://t.me/yogagolik_dnevnik  
+6. Йога с Алексеем Бабенко в ВК (Петрозаводск) - https://vk.ru/kyogababenko  """,
+    "merch_choose": "🛍️ Выберите товар:",
+    "merch_action": "Выберите действие:",
+    "rate_limited": "⏳ Подожди немного перед следующим действием (защита от спама).",
+}
+# Inline-меню админ-панели: (текст кнопки, callback_data), по кнопке в строке
+ADMIN_MENU = [
+    ("📊 Статистика", "admin_stats"),
+    ("🛍 Заказы", "admin_orders"),
+    ("📬 Рассылка", "admin_broadcast"),
+    ("📢 Подписчики", "admin_subscribers"),
+    ("🔙 В главное меню", "admin_back"),
+]
+# Раскладки reply-клавиатур: каждый внутренний список — один вызов kb.add(...)
+KEYBOARD_LAYOUTS = {
+    "main": [["👥 Команда", "🌍 Путешествия", "🧘 Кундалини-йога", "📸 Медиа", "🛍 Мерч", "🎁 Доп. услуги"]],
+    "cabinet": [
+        ["📦 Мои заказы", "📜 История покупок", "🔗 Реферальная ссылка"],
+        ["📢 Подписаться на события", "🚫 Отписаться от событий"],
+        ["🔙 Назад в меню"],
+    ],
+    "back_to_cabinet": [["👤 Личный кабинет"]],
+    "travels": [["📂 Архив путешествий", "🌍 Где мы сейчас", "🔙 Назад к меню"]],
+    "yoga": [["🏢 Офлайн-мероприятия", "💻 Онлайн-йога", "📅 Ближайшие мероприятия", "🔙 Назад к меню"]],
+    "online_yoga": [["Да, хочу", "Приобрести подписку", "🔙 Назад к онлайн-йоге"]],
+    "online_yoga_trial": [["Приобрести подписку", "🔙 Назад к онлайн-йоге"]],
+    "back_to_online_yoga": [["🔙 Назад к онлайн-йоге"]],
+    "media": [["▶️ YouTube", "🔙 Назад к меню"]],
+    "services": [["👤 Личный кабинет", "🔙 Назад к меню"]],
+    "team": [["🏷 О бренде", "🌐 Официальные источники", "🔙 Назад к меню"]],
+    "merch_item": [["✅ Заказать", "🔙 Назад к Мерч"]],
+    "back_to_merch": [["🔙 Назад к Мерч"]],
+    "cart": [["✅ Оформить заказ", "🗑 Очистить корзину", "🔙 Назад к Мерч"]],
+}
+
+class FrozenMarkup(types.JsonSerializable):
+    """Клавиатура с заранее сериализованным JSON (telebot берёт to_json() как есть)"""
+    def __init__(self, markup):
+        self._json = markup.to_json()
+    def to_json(self):
+        return self._json
+def _reply_keyboard(rows):
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    for row in rows:
+        kb.add(*row)
+    return FrozenMarkup(kb)
+class ResponseCatalog:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        layouts = dict(KEYBOARD_LAYOUTS)
+        # меню мерча: по товару в строке + служебные кнопки
+        layouts["merch"] = [[name] for name in MERCH_ITEMS] + [["🛍️ Корзина", "🔙 Назад к меню", "📦 Мои заказы"]]
+        self.keyboards = {name: _reply_keyboard(rows) for name, rows in layouts.items()}
+        ikb = types.InlineKeyboardMarkup(row_width=1)
+        ikb.add(*[types.InlineKeyboardButton(label, callback_data=data) for label, data in ADMIN_MENU])
+        self.keyboards["admin"] = FrozenMarkup(ikb)
+def _catalog_fingerprint():
+    return hashlib.sha256(json.dumps(
+        [MERCH_ITEMS, TEXTS, KEYBOARD_LAYOUTS, ADMIN_MENU], ensure_ascii=False, sort_keys=True
+    ).encode()).hexdigest()
+catalog = None
+
+def refresh_response_catalog():
+    """Пересобирает каталог, если изменились товары, тексты или раскладки"""
+    global catalog
+    fingerprint = _catalog_fingerprint()
+    if catalog is None or catalog.fingerprint != fingerprint:
+        catalog = ResponseCatalog(fingerprint)
+    return catalog
+refresh_response_catalog()
+BOT_USERNAME = os.getenv("TELEGRAM_BOT_USERNAME")
+
+def get_bot_username():
+    """Username бота: из ENV или один запрос getMe за время жизни процесса"""
+    global BOT_USERNAME
+    if not BOT_USERNAME:
+        BOT_USERNAME = bot.get_me().username
+    return BOT_USERNAME
+# --- Многострочные INSERT ---
+BULK_CHUNK = 1000  # строк в одном запросе
+
+def bulk_values(rows):
+    """[(a, b), ...] -> ("(:p0_0, :p0_1), (:p1_0, :p1_1)", params) — один запрос вместо executemany"""
+    parts = []
+    params = {}
+    for i, row in enumerate(rows):
+        names = []
+        for j, value in enumerate(row):
+            key = f"p{i}_{j}"
+            params[key] = value
+            names.append(f":{key}")
+        parts.append(f"({', '.join(names)})")
+    return ", ".join(parts), params
+def bulk_insert(conn, head, rows, tail=""):
+    """Выполняет `head VALUES (...), (...) tail` пачками по BULK_CHUNK строк.
+    Если tail содержит RETURNING, возвращает строки всех пачек."""
+    returned = []
+    for i in range(0, len(rows), BULK_CHUNK):
+        values, params = bulk_values(rows[i:i + BULK_CHUNK])
+        result = conn.execute(sql_text(f"{head} VALUES {values} {tail}"), params)
+        if result.returns_rows:
+            returned.extend(result.fetchall())
+    return returned
+# --- Rate limiting (token bucket в памяти процесса) ---
 DEFAULT_LIMIT_SECONDS = 2  # минимальное время между действиями
+# Индивидуальные лимиты по действиям (секунд между действиями), остальные — DEFAULT_LIMIT_SECONDS
+ACTION_LIMITS = {
+    "start": 1,
+    "clear_cart": 1,
+    "send_merch_order": 3,
+}
+RATE_LIMIT_BURST = max(1, int(os.getenv("RATE_LIMIT_BURST", "1")))  # сколько действий подряд допускается
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()  # memory | redis
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+RATE_LIMIT_FLUSH_SECONDS = int(os.getenv("RATE_LIMIT_FLUSH_SECONDS", "30"))
+RATE_LIMIT_PERSIST = os.getenv("RATE_LIMIT_PERSIST", "1") == "1"  # сбрасывать last_ts в rate_limits пачками
+
+class MemoryRateLimiter:
+    """
+    Token bucket на ключ (user_id, action). Без блокировок: состояние корзины — неизменяемый кортеж,
+    который заменяется одной операцией над dict (атомарно под GIL). Гонка двух потоков по одному ключу
+    в худшем случае пропустит одно лишнее действие — для антиспама это допустимо.
+    """
+    def __init__(self, burst):
+        self.burst = burst
+        self._buckets = {}  # (user_id, action) -> (tokens, ts)
+    def consume(self, key, limit_seconds, now):
+        state = self._buckets.get(key)
+        if state is None:
+            tokens = self.burst
+        else:
+            tokens, ts = state
+            tokens = min(self.burst, tokens + (now - ts) / limit_seconds)
+        if tokens < 1:
+            return False
+        self._buckets[key] = (tokens - 1, now)
+        return True
+    def prune(self, now, max_limit_seconds):
+        """Удаляет корзины, которые уже полностью восстановились (экономия памяти)"""
+        horizon = max_limit_seconds * self.burst
+        for key, (tokens, ts) in list(self._buckets.items()):
+            if now - ts >= horizon:
+                self._buckets.pop(key, None)
+
+class RedisRateLimiter:
+    """Общий для всех воркеров лимит: ключ живёт limit_seconds, SET NX пропускает только первое действие"""
+    def __init__(self, url):
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+    def consume(self, key, limit_seconds, now):
+        user_id, action = key
+        return bool(self._client.set(f"rl:{user_id}:{action}", 1, nx=True, px=int(limit_seconds * 1000)))
+    def prune(self, now, max_limit_seconds):
+        pass  # ключи истекают сами
+
+_memory_limiter = MemoryRateLimiter(RATE_LIMIT_BURST)
+rate_limiter = _memory_limiter
+if RATE_LIMIT_BACKEND == "redis":
+    try:
+        import redis
+        if not RATE_LIMIT_REDIS_URL:
+            raise RuntimeError("RATE_LIMIT_REDIS_URL не установлен")
+        rate_limiter = RedisRateLimiter(RATE_LIMIT_REDIS_URL)
+        logger.info("Rate limiting: общий backend в Redis")
+    except Exception as e:
+        logger.warning(f"Redis для rate limiting недоступен, используем память процесса: {e}")
+# Счётчики пропущенных/отклонённых действий по типу действия
+rate_limit_hits = {}
+rate_limit_denies = {}
+_rate_limit_dirty = {}  # (user_id, action) -> last_ts, ещё не записанные в rate_limits
 
-def allowed_action(user_id: int, action: str, limit_seconds: int = DEFAULT_LIMIT_SECONDS) -> bool:
+def allowed_action(user_id: int, action: str, limit_seconds: int = None) -> bool:
+    if limit_seconds is None:
+        limit_seconds = ACTION_LIMITS.get(action, DEFAULT_LIMIT_SECONDS)
     now = time.time()
+    key = (user_id, action)
     try:
-        with engine.connect() as conn:
-            # Проверяем последнее время; если прошло недостаточно — отклоняем, иначе обновляем.
-            res = conn.execute(sql_text(
-                "SELECT last_ts FROM rate_limits WHERE user_id = :uid AND action = :act"
-            ), {"uid": user_id, "act": action}).fetchone()
-            if res:
-                last_ts = float(res[0])
-                if now - last_ts < limit_seconds:
-                    return False
-                conn.execute(sql_text(
-                    "UPDATE rate_limits SET last_ts = :now WHERE user_id = :uid AND action = :act"
-                ), {"now": now, "uid": user_id, "act": action})
-            else:
-                conn.execute(sql_text(
-                    "INSERT INTO rate_limits (user_id, action, last_ts) VALUES (:uid, :act, :now)"
-                ), {"uid": user_id, "act": action, "now": now})
-            conn.commit()
-            return True
+        allowed = rate_limiter.consume(key, limit_seconds, now)
     except Exception as e:
-        logger.warning(f"Rate limit fallback (DB недоступна): {e}")
-        # в случае проблем с БД — не блокируем пользователя
-        return True
+        logger.warning(f"Rate limit fallback (backend недоступен): {e}")
+        allowed = _memory_limiter.consume(key, limit_seconds, now)
+    if not allowed:
+        rate_limit_denies[action] = rate_limit_denies.get(action, 0) + 1
+        return False
+    rate_limit_hits[action] = rate_limit_hits.get(action, 0) + 1
+    if RATE_LIMIT_PERSIST:
+        _rate_limit_dirty[key] = now
+    return True
+def get_rate_limit_stats():
+    """Снимок счётчиков: {action: (пропущено, отклонено)}"""
+    actions = set(rate_limit_hits) | set(rate_limit_denies)
+    return {a: (rate_limit_hits.get(a, 0), rate_limit_denies.get(a, 0)) for a in sorted(actions)}
+def flush_rate_limits_job():
+    """Пачкой записывает last_ts в rate_limits и чистит восстановившиеся корзины"""
+    global _rate_limit_dirty
+    now = time.time()
+    rate_limiter.prune(now, max([DEFAULT_LIMIT_SECONDS, *ACTION_LIMITS.values()]))
+    if not _rate_limit_dirty:
+        return
+    dirty, _rate_limit_dirty = _rate_limit_dirty, {}
+    try:
+        with engine.begin() as conn:
+            bulk_insert(
+                conn,
+                "INSERT INTO rate_limits (user_id, action, last_ts)",
+                [(uid, act, ts) for (uid, act), ts in dirty.items()],
+                f"ON CONFLICT (user_id, action) DO UPDATE SET last_ts = {storage.greatest('rate_limits.last_ts', 'EXCLUDED.last_ts')}"
+            )
+    except Exception as e:
+        logger.error(f"Ошибка записи rate_limits: {e}")
 def send_rate_limited_message(chat_id):
     try:
-        bot.send_message(chat_id, "⏳ Подожди немного перед следующим действием (защита от спама).")
+        bot.send_message(chat_id, TEXTS["rate_limited"])
     except Exception as e:
         logger.debug(f"Не удалось отправить сообщение о лимите: {e}")
+# --- Агрегаты активности (daily_activity) ---
+# На каждый день хранится точное число активных пользователей и HyperLogLog-скетч их id;
+# недельная/месячная/общая аудитория считается объединением скетчей, без сканирования user_log.
+HLL_PRECISION = 12  # 4096 регистров по байту, стандартная ошибка ~1.6%
+_HLL_REGISTERS = 1 << HLL_PRECISION
+_MASK64 = (1 << 64) - 1
+_HLL_POW = [2.0 ** -r for r in range(65)]
+
+class HyperLogLog:
+    def __init__(self, registers=None):
+        self.registers = bytearray(registers) if registers else bytearray(_HLL_REGISTERS)
+    @staticmethod
+    def _hash(value):
+        # splitmix64: равномерный 64-битный хэш для целых id
+        z = (value + 0x9E3779B97F4A7C15) & _MASK64
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+        return z ^ (z >> 31)
+    def add(self, value):
+        h = self._hash(int(value))
+        idx = h >> (64 - HLL_PRECISION)
+        rest = (h << HLL_PRECISION) & _MASK64
+        rank = 64 - rest.bit_length() + 1 if rest else 64 - HLL_PRECISION + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+    def count(self):
+        m = _HLL_REGISTERS
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(_HLL_POW[r] for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # линейный счёт для малых множеств
+        return int(round(estimate))
+    def to_bytes(self):
+        return bytes(self.registers)
+
+def _merge_activity_row(conn, table, key_column, key, sketch, added=0, exact=None):
+    """Добавляет скетч (и прирост счётчика) к строке агрегата под блокировкой строки"""
+    key = str(key)  # day — TEXT, а user_log.date на PostgreSQL — DATE (приходит как datetime.date)
+    empty = HyperLogLog().to_bytes()
+    conn.execute(sql_text(
+        f"INSERT INTO {table} ({key_column}, hll) VALUES (:key, :hll) ON CONFLICT ({key_column}) DO NOTHING"
+    ), {"key": key, "hll": empty})
+    row = conn.execute(sql_text(
+        f"SELECT hll FROM {table} WHERE {key_column} = :key {storage.for_update()}"
+    ), {"key": key}).fetchone()
+    merged = HyperLogLog(row[0]).merge(sketch).to_bytes()
+    if table == "daily_activity":
+        conn.execute(sql_text(
+            "UPDATE daily_activity SET hll = :hll, "
+            "active_users = COALESCE(CAST(:exact AS INTEGER), active_users + :added) WHERE day = :key"
+        ), {"hll": merged, "exact": exact, "added": added, "key": key})
+    else:
+        conn.execute(sql_text(
+            f"UPDATE {table} SET hll = :hll, updated_at = :now WHERE {key_column} = :key"
+        ), {"hll": merged, "now": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "key": key})
+
+def update_activity_rollup(conn, rows):
+    """Учитывает новые строки user_log (user_id, date) в daily_activity и общем скетче"""
+    by_day = {}
+    for user_id, day in rows:
+        by_day.setdefault(str(day), []).append(user_id)
+    total = HyperLogLog()
+    for day in sorted(by_day):
+        sketch = HyperLogLog()
+        for user_id in by_day[day]:
+            sketch.add(user_id)
+        _merge_activity_row(conn, "daily_activity", "day", day, sketch, added=len(by_day[day]))
+        total.merge(sketch)
+    _merge_activity_row(conn, "activity_sketches", "scope", "all", total)
+
+def get_activity_summary():
+    """(сегодня, за 7 дней, за 30 дней, за всё время); всё, кроме «сегодня», — оценка по HLL"""
+    today = date.today()
+    with db_conn() as conn:
+        rows = conn.execute(sql_text(
+            "SELECT day, active_users, hll FROM daily_activity WHERE day > :since"
+        ), {"since": str(today - timedelta(days=30))}).fetchall()
+        all_row = conn.execute(sql_text(
+            "SELECT hll FROM activity_sketches WHERE scope = 'all'"
+        )).fetchone()
+    week_since = str(today - timedelta(days=7))
+    today_count = 0
+    week, month = HyperLogLog(), HyperLogLog()
+    for day, active_users, hll in rows:
+        sketch = HyperLogLog(hll)
+        month.merge(sketch)
+        if day > week_since:
+            week.merge(sketch)
+        if day == str(today):
+            today_count = active_users
+    total = HyperLogLog(all_row[0]).count() if all_row else 0
+    return today_count, week.count(), month.count(), total
+
+ACTIVITY_BACKFILL_LOCK_KEY = 987654323
+
+def backfill_activity_job():
+    """Однократно строит агрегаты по уже накопленному user_log (после обновления с версии без daily_activity)"""
+    try:
+        with engine.connect() as lock_conn:
+            if not storage.try_lock(lock_conn, ACTIVITY_BACKFILL_LOCK_KEY):
+                return
+            try:
+                done = lock_conn.execute(sql_text(
+                    "SELECT 1 FROM activity_sketches WHERE scope = 'backfill'"
+                )).fetchone()
+                if done:
+                    return
+                # daily_activity.day — TEXT: дни сравниваются и записываются строками 'YYYY-MM-DD'
+                days = [str(r[0]) for r in lock_conn.execute(sql_text(
+                    "SELECT DISTINCT date FROM user_log WHERE date IS NOT NULL ORDER BY date"
+                )).fetchall()]
+                lock_conn.commit()
+                for day in days:
+                    # строка дня блокируется до подсчёта: конкурентный flush_user_log либо уже виден в COUNT,
+                    # либо дождётся блокировки и добавит свой прирост после — точное число не задваивается
+                    with engine.begin() as conn:
+                        conn.execute(sql_text(
+                            "INSERT INTO daily_activity (day, hll) VALUES (:day, :hll) ON CONFLICT (day) DO NOTHING"
+                        ), {"day": day, "hll": HyperLogLog().to_bytes()})
+                        conn.execute(sql_text(f"SELECT 1 FROM daily_activity WHERE day = :day {storage.for_update()}"), {"day": day})
+                        sketch = HyperLogLog()
+                        count = 0
+                        for (user_id,) in conn.execute(sql_text(
+                            "SELECT user_id FROM user_log WHERE date = :day"
+                        ), {"day": day}):
+                            sketch.add(user_id)
+                            count += 1
+                        _merge_activity_row(conn, "daily_activity", "day", day, sketch, exact=count)
+                        _merge_activity_row(conn, "activity_sketches", "scope", "all", sketch)
+                with engine.begin() as conn:
+                    conn.execute(sql_text(
+                        "INSERT INTO activity_sketches (scope, hll, updated_at) VALUES ('backfill', :hll, :now) "
+                        "ON CONFLICT (scope) DO NOTHING"
+                    ), {"hll": b"", "now": datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+                logger.info(f"Агрегаты активности построены за {len(days)} дн.")
+            finally:
+                storage.unlock(lock_conn, ACTIVITY_BACKFILL_LOCK_KEY)
+                lock_conn.commit()
+    except Exception as e:
+        logger.error(f"Ошибка построения агрегатов активности: {e}")
 # --- Уникальные пользователи лог ---
+# Пользователь, уже отмеченный сегодня в этом процессе, не вызывает запросов к БД;
+# новые отметки копятся в памяти и пишутся одной пачкой (ON CONFLICT DO NOTHING убирает дубли между воркерами).
+USER_LOG_FLUSH_SECONDS = int(os.getenv("USER_LOG_FLUSH_SECONDS", "30"))
+_user_log_lock = threading.Lock()
+_user_log_day = None
+_user_log_seen = set()
+_user_log_pending = []  # (user_id, date)
+
 def log_user(user_id):
+    global _user_log_day, _user_log_seen
     today = str(date.today())
+    with _user_log_lock:
+        if _user_log_day != today:
+            _user_log_day = today
+            _user_log_seen = set()
+        if user_id in _user_log_seen:
+            return
+        _user_log_seen.add(user_id)
+        _user_log_pending.append((user_id, today))
+def flush_user_log():
+    """Записывает накопленные отметки в user_log одним запросом"""
+    global _user_log_pending
+    with _user_log_lock:
+        batch, _user_log_pending = _user_log_pending, []
+    if not batch:
+        return
     try:
-        with engine.connect() as conn:
-            result = conn.execute(sql_text(
-                "SELECT 1 FROM user_log WHERE user_id = :user_id AND date = :today"
-            ), {"user_id": user_id, "today": today})
-            if not result.fetchone():
-                conn.execute(sql_text(
-                    "INSERT INTO user_log (user_id, date) VALUES (:user_id, :today)"
-                ), {"user_id": user_id, "today": today})
-                conn.commit()
+        # своя транзакция: откат update, из которого вызван сброс, не должен терять чужие отметки
+        with engine.begin() as conn:
+            # RETURNING отдаёт только действительно новые строки — их и добавляем в дневные агрегаты
+            inserted = bulk_insert(conn, "INSERT INTO user_log (user_id, date)", batch,
+                                   "ON CONFLICT DO NOTHING RETURNING user_id, date")
+            if inserted:
+                update_activity_rollup(conn, inserted)
     except Exception as e:
         logger.error(f"Ошибка записи в БД: {e}")
+        # вернём пачку, чтобы не потерять отметки до следующей попытки
+        with _user_log_lock:
+            _user_log_pending = batch + _user_log_pending
 # --- Рассылка статистики владельцу (ежедневно в 23:59) ---
 def send_daily_stats_job():
-    """Ежедневная статистика с защитой через advisory lock (чтобы не было дублей)."""
+    """Ежедневная статистика; без дублей — задачу выполняет только ведущий (job_runner)"""
     today = str(date.today())
-    lock_key = 987654321  # произвольный ключ для блокировки
+    flush_user_log()
     try:
-        with engine.connect() as conn:
-            got = conn.execute(sql_text("SELECT pg_try_advisory_lock(:k)"), {"k": lock_key}).scalar()
-            if not got:
-                return
-            try:
-                result = conn.execute(sql_text(
-                    "SELECT COUNT(DISTINCT user_id) FROM user_log WHERE date = :today"
-                ), {"today": today})
-                count = result.fetchone()[0]
-            finally:
-                try:
-                    conn.execute(sql_text("SELECT pg_advisory_unlock(:k)"), {"k": lock_key})
-                except Exception:
-                    pass
+        with db_conn() as conn:
+            # точное число за день ведёт flush_user_log в daily_activity
+            row = conn.execute(sql_text(
+                "SELECT active_users FROM daily_activity WHERE day = :today"
+            ), {"today": today}).fetchone()
+            count = row[0] if row else 0
         try:
             bot.send_message(OWNER_ID, f"📊 Уникальных пользователей за {today}: {count}")
         except Exception as e:
@@ -369,53 +1826,176 @@ def send_daily_stats_job():
     except Exception as e:
         logger.error(f"Ошибка ежедневной статистики: {e}")
 
-# Запускаем планировщик для ежедневной статистики (23:59), автопинг остаётся через поток
-scheduler = BackgroundScheduler()
-scheduler.add_job(send_daily_stats_job, 'cron', hour=23, minute=59, id='daily_stats')
-scheduler.start()
+# Ежедневная статистика (23:59) и очистка — у ведущего; буферы процесса сбрасывает каждый воркер
+job_runner.add_job(send_daily_stats_job, 'cron', hour=23, minute=59, id='daily_stats')
+job_runner.add_job(conversations.prune_job, 'interval', minutes=10, id='prune_conversations')
+job_runner.add_job(backfill_activity_job, id='backfill_activity')  # один раз при старте ведущего
+job_runner.add_job(job_runner.prune_history, 'interval', hours=6, id='prune_job_runs')
+job_runner.add_local_job(flush_rate_limits_job, RATE_LIMIT_FLUSH_SECONDS)
+job_runner.add_local_job(flush_user_log, USER_LOG_FLUSH_SECONDS)
 # --- Автопинг ---
 def self_ping():
+    try:
+        requests.get(f"{RENDER_URL}/ping", timeout=5)
+        logger.info("Пинг выполнен")
+    except Exception as e:
+        logger.error(f"Ошибка пинга: {e}")
+job_runner.add_job(self_ping, 'interval', minutes=5, id='self_ping', run_at_start=True)
+# --- Хранение: партиции user_log и очистка устаревших строк ---
+# На PostgreSQL user_log разбит на помесячные партиции (миграция 20261018_11): задача заранее создаёт
+# партиции на USER_LOG_PARTITIONS_AHEAD месяцев вперёд и удаляет (или только отсоединяет) партиции старше
+# USER_LOG_RETENTION_MONTHS — это DDL, а не DELETE по миллионам строк. Статистика от этого не теряется:
+# агрегаты лежат в daily_activity и activity_sketches. Без партиций (SQLite, база до миграции) старые
+# строки удаляются пачками по индексу, как и устаревшие rate_limits и брошенные черновики рассылок.
+USER_LOG_RETENTION_MONTHS = int(os.getenv("USER_LOG_RETENTION_MONTHS", "13"))  # 0 — хранить всё
+USER_LOG_PARTITIONS_AHEAD = int(os.getenv("USER_LOG_PARTITIONS_AHEAD", "3"))
+USER_LOG_DETACH_ONLY = os.getenv("USER_LOG_DETACH_ONLY", "0") == "1"  # отсоединять старые партиции, не удаляя
+# строка rate_limits старше полного восстановления корзины состояния не несёт
+RATE_LIMIT_RETENTION_SECONDS = int(os.getenv("RATE_LIMIT_RETENTION_SECONDS", "3600"))
+BROADCAST_DRAFT_RETENTION_DAYS = int(os.getenv("BROADCAST_DRAFT_RETENTION_DAYS", "30"))
+RETENTION_BATCH = 5000  # строк в одной транзакции удаления
+PARTITION_LOCK_TIMEOUT_MS = 2000  # DDL партиций не должен надолго блокировать запись в user_log
+_USER_LOG_PARTITION_RE = re.compile(r"^user_log_p(\d{4})_(\d{2})$")
+
+def _add_months(month, n):
+    """Первое число месяца, отстоящего от month на n месяцев"""
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+def delete_in_batches(table, key, where, params):
+    """
+    DELETE по условию пачками по RETENTION_BATCH строк, каждая — в своей короткой транзакции.
+    key — столбец или список столбцов ключа через запятую ("user_id, action"): сравнивается как кортеж.
+    """
+    total = 0
     while True:
-        try:
-            requests.get(f"{RENDER_URL}/ping", timeout=5)
-            logger.info("Пинг выполнен")
-        except Exception as e:
-            logger.error(f"Ошибка пинга: {e}")
-        time.sleep(300)
-threading.Thread(target=self_ping, daemon=True).start()
+        with db_conn() as conn:
+            deleted = conn.execute(sql_text(
+                f"DELETE FROM {table} WHERE ({key}) IN (SELECT {key} FROM {table} WHERE {where} LIMIT :batch)"
+            ), dict(params, batch=RETENTION_BATCH)).rowcount
+        total += deleted
+        if deleted < RETENTION_BATCH:
+            return total
+def maintain_user_log_partitions():
+    this_month = date.today().replace(day=1)
+    cutoff = _add_months(this_month, -USER_LOG_RETENTION_MONTHS) if USER_LOG_RETENTION_MONTHS > 0 else None
+    with db_conn() as conn:
+        partitions = storage.list_partitions(conn, "user_log")
+    if partitions is None:
+        if cutoff:
+            deleted = delete_in_batches("user_log", "id", "date < :cutoff", {"cutoff": str(cutoff)})
+            if deleted:
+                logger.info(f"user_log: удалено строк до {cutoff}: {deleted}")
+        return
+    for n in range(USER_LOG_PARTITIONS_AHEAD + 1):
+        month = _add_months(this_month, n)
+        name = f"user_log_p{month:%Y_%m}"
+        if name in partitions:
+            continue
+        with db_conn() as conn:
+            conn.execute(sql_text(f"SET LOCAL lock_timeout = {PARTITION_LOCK_TIMEOUT_MS}"))
+            conn.execute(sql_text(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF user_log "
+                f"FOR VALUES FROM ('{month}') TO ('{_add_months(month, 1)}')"
+            ))
+        logger.info(f"Создана партиция {name}")
+    if not cutoff:
+        return
+    for name in sorted(partitions):
+        match = _USER_LOG_PARTITION_RE.match(name)
+        if not match or _add_months(date(int(match[1]), int(match[2]), 1), 1) > cutoff:
+            continue  # партиция по умолчанию или ещё в пределах хранения
+        with db_conn() as conn:
+            conn.execute(sql_text(f"SET LOCAL lock_timeout = {PARTITION_LOCK_TIMEOUT_MS}"))
+            conn.execute(sql_text(f"ALTER TABLE user_log DETACH PARTITION {name}"))
+            if not USER_LOG_DETACH_ONLY:
+                conn.execute(sql_text(f"DROP TABLE {name}"))
+        logger.info(f"Партиция {name} {'отсоединена' if USER_LOG_DETACH_ONLY else 'удалена'}")
+def retention_job():
+    """Партиции user_log, устаревшие rate_limits и старые черновики рассылок"""
+    try:
+        maintain_user_log_partitions()
+    except Exception as e:
+        logger.error(f"Ошибка обслуживания партиций user_log: {e}")
+    try:
+        deleted = delete_in_batches("rate_limits", "user_id, action", "last_ts < :cutoff",
+                                    {"cutoff": time.time() - RATE_LIMIT_RETENTION_SECONDS})
+        if deleted:
+            logger.info(f"rate_limits: удалено устаревших строк: {deleted}")
+    except Exception as e:
+        logger.error(f"Ошибка очистки rate_limits: {e}")
+    try:
+        cutoff = (datetime.now() - timedelta(days=BROADCAST_DRAFT_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        # неподтверждённые черновики; запущенные и завершённые рассылки остаются в истории
+        deleted = delete_in_batches("broadcasts", "id", "COALESCE(status, 'draft') = 'draft' AND created_at < :cutoff",
+                                    {"cutoff": cutoff})
+        if deleted:
+            logger.info(f"broadcasts: удалено старых черновиков: {deleted}")
+    except Exception as e:
+        logger.error(f"Ошибка очистки черновиков рассылок: {e}")
+job_runner.add_job(retention_job, 'interval', hours=6, id='retention', run_at_start=True)
 # --- Вспомогательные DB-функции ---
+# Корзина: одна строка на (user_id, item), повторное добавление увеличивает количество.
+# Содержимое корзины кэшируется на пользователя; запись обновляет кэш после коммита (write-through),
+# а другие воркеры выбрасывают ключ по уведомлению invalidation_bus.
+CART_CACHE_SIZE = int(os.getenv("CART_CACHE_SIZE", "10000"))
+cart_cache = LRUCache(CART_CACHE_SIZE)  # user_id -> ((item, quantity, price), ...)
+invalidation_bus.subscribe("cart", lambda key: cart_cache.pop(int(key)), cart_cache.clear)
+
+def _cart_apply(user_id, row):
+    """Подставляет обновлённую позицию в закэшированную корзину (если она в кэше)"""
+    cached = cart_cache.get(user_id)
+    if cached is _MISSING:
+        return
+    items = [r for r in cached if r[0] != row[0]]
+    position = next((i for i, r in enumerate(cached) if r[0] == row[0]), len(items))
+    items.insert(position, tuple(row))
+    cart_cache.put(user_id, tuple(items))
+def forget_cart(conn, user_id, emptied=False):
+    """Корзина пользователя изменена вне его собственного update: сбросить кэши всех воркеров"""
+    invalidation_bus.publish(conn, "cart", user_id)
+    if emptied:
+        after_commit(cart_cache.put, user_id, ())
+    else:
+        after_commit(cart_cache.pop, user_id)
 def add_to_cart_db(user_id, item, quantity, price):
     try:
-        with engine.connect() as conn:
-            conn.execute(sql_text(
-                "INSERT INTO merch_cart (user_id, item, quantity, price) VALUES (:user_id, :item, :quantity, :price)"
+        with db_savepoint() as conn:
+            row = conn.execute(sql_text(
+                "INSERT INTO merch_cart (user_id, item, quantity, price) VALUES (:user_id, :item, :quantity, :price) "
+                "ON CONFLICT (user_id, item) DO UPDATE SET quantity = merch_cart.quantity + EXCLUDED.quantity, price = EXCLUDED.price "
+                "RETURNING item, quantity, price"
             ), {
                 "user_id": user_id,
                 "item": item,
                 "quantity": quantity,
                 "price": price
-            })
-            conn.commit()
+            }).fetchone()
+            invalidation_bus.publish(conn, "cart", user_id)
+        after_commit(_cart_apply, user_id, row)
     except Exception as e:
         logger.error(f"Ошибка добавления в корзину: {e}")
 def get_cart_items(user_id):
+    cached = cart_cache.get(user_id)
+    if cached is not _MISSING:
+        return list(cached)
     try:
-        with engine.connect() as conn:
+        with db_savepoint() as conn:
             result = conn.execute(sql_text(
-                "SELECT item, quantity, price FROM merch_cart WHERE user_id = :user_id"
+                "SELECT item, quantity, price FROM merch_cart WHERE user_id = :user_id ORDER BY id"
             ), {"user_id": user_id})
-            rows = result.fetchall()
-            return rows
+            rows = [tuple(r) for r in result.fetchall()]
+        cart_cache.put(user_id, tuple(rows))
+        return rows
     except Exception as e:
         logger.error(f"Ошибка получения корзины: {e}")
         return []
 def clear_cart(user_id):
     try:
-        with engine.connect() as conn:
+        with db_savepoint() as conn:
             conn.execute(sql_text(
                 "DELETE FROM merch_cart WHERE user_id = :user_id"
             ), {"user_id": user_id})
-            conn.commit()
+            forget_cart(conn, user_id, emptied=True)
     except Exception as e:
         logger.error(f"Ошибка очистки корзины: {e}")
 def create_pending_from_cart(user_id, username):
@@ -435,9 +2015,9 @@ def create_pending_from_cart(user_id, username):
         items_list.append({"item": item, "quantity": qty, "price": price, "total": total})
     items_json = json.dumps(items_list, ensure_ascii=False)
     try:
-        with engine.connect() as conn:
+        with db_savepoint() as conn:
             result = conn.execute(sql_text(
-                "INSERT INTO merch_pending (user_id, username, items_json, total, date) VALUES (:user_id, :username, :items_json, :total, :date) RETURNING id"
+                f"INSERT INTO merch_pending (user_id, username, items_json, total, date) VALUES (:user_id, :username, {storage.json_param('items_json')}, :total, :date) RETURNING id"
             ), {
                 "user_id": user_id,
                 "username": username,
@@ -446,238 +2026,444 @@ def create_pending_from_cart(user_id, username):
                 "date": today
             })
             pid = result.fetchone()[0]
-            conn.commit()
             return pid, items_list, total_sum
     except Exception as e:
-        logger.error(f"Ошибка создания pending заказа: {e}")
+        logger.error(f"Ошибка создания pending заказа: {e}")
+        return None
+def _move_pending_steps(conn, pending_id, status):
+    """То же, что CTE в move_pending_to_orders, отдельными запросами (SQLite не умеет изменяющие CTE)"""
+    p = conn.execute(sql_text(
+        "DELETE FROM merch_pending WHERE id = :pending_id RETURNING user_id, username, items_json, date"
+    ), {"pending_id": pending_id}).fetchone()
+    if not p:
+        return []
+    user_id, username, items, order_date = p
+    conn.execute(sql_text("DELETE FROM merch_cart WHERE user_id = :user_id"), {"user_id": user_id})
+    if isinstance(items, str):
+        items = json.loads(items)
+    rows = [
+        (user_id, username, it["item"], int(it["quantity"]), int(it["price"]),
+         int(it.get("total") or int(it["quantity"]) * int(it["price"])), order_date, status)
+        for it in items
+    ]
+    orders = bulk_insert(conn, "INSERT INTO merch_orders (user_id, username, item, quantity, price, total, date, status)",
+                         rows, "RETURNING id, user_id, username, item, quantity, price, total, date, status")
+    return sorted(orders, key=lambda r: r[0])
+def move_pending_to_orders(pending_id):
+    """
+    Подтверждение pending одним запросом в одной транзакции: удаляет pending, очищает корзину
+    пользователя и создаёт по заказу на каждую позицию из items_json (JSONB).
+    Возвращает список созданных заказов (пустой, если pending не найден) или None при ошибке.
+    """
+    try:
+        with db_savepoint() as conn:
+            if not storage.writable_cte:
+                orders = _move_pending_steps(conn, pending_id, "В обработке")
+            else:
+                orders = conn.execute(sql_text(
+                    """
+                    WITH p AS (
+                        DELETE FROM merch_pending WHERE id = :pending_id
+                        RETURNING user_id, username, items_json::jsonb AS items, date
+                    ), cart AS (
+                        DELETE FROM merch_cart WHERE user_id IN (SELECT user_id FROM p)
+                    )
+                    INSERT INTO merch_orders (user_id, username, item, quantity, price, total, date, status)
+                    SELECT p.user_id, p.username, e.it->>'item', (e.it->>'quantity')::int, (e.it->>'price')::int,
+                           COALESCE((e.it->>'total')::int, (e.it->>'quantity')::int * (e.it->>'price')::int),
+                           p.date, :status
+                    FROM p CROSS JOIN LATERAL jsonb_array_elements(p.items) WITH ORDINALITY AS e(it, n)
+                    ORDER BY e.n
+                    RETURNING id, user_id, username, item, quantity, price, total, date, status
+                    """
+                ), {"pending_id": pending_id, "status": "В обработке"}).fetchall()
+            if orders:
+                forget_cart(conn, orders[0][1])
+                refresh_order_stats(conn, [orders[0][1]])
+            # строки для Google Sheets попадают в outbox в той же транзакции (после коммита их заберёт экспортёр)
+            if orders and GOOGLE_SHEETS_ENABLED:
+                log_orders_to_google_sheets(orders)
+            return orders
+    except Exception as e:
+        logger.error(f"Ошибка переноса pending в заказы: {e}")
         return None
-def get_pending(pending_id):
+def decline_pending(pending_id):
+    """Удаляет pending и очищает корзину пользователя одним запросом. Возвращает user_id или None."""
     try:
-        with engine.connect() as conn:
-            result = conn.execute(sql_text(
-                "SELECT id, user_id, username, items_json, total, date FROM merch_pending WHERE id = :pending_id"
-            ), {"pending_id": pending_id})
-            row = result.fetchone()
-            return row
+        with db_savepoint() as conn:
+            if not storage.writable_cte:
+                row = conn.execute(sql_text(
+                    "DELETE FROM merch_pending WHERE id = :pending_id RETURNING user_id"
+                ), {"pending_id": pending_id}).fetchone()
+                if row:
+                    conn.execute(sql_text("DELETE FROM merch_cart WHERE user_id = :user_id"), {"user_id": row[0]})
+                    forget_cart(conn, row[0])
+                return row[0] if row else None
+            row = conn.execute(sql_text(
+                """
+                WITH p AS (
+                    DELETE FROM merch_pending WHERE id = :pending_id RETURNING user_id
+                ), cart AS (
+                    DELETE FROM merch_cart WHERE user_id IN (SELECT user_id FROM p)
+                )
+                SELECT user_id FROM p
+                """
+            ), {"pending_id": pending_id}).fetchone()
+            if row:
+                forget_cart(conn, row[0])
+            return row[0] if row else None
     except Exception as e:
-        logger.error(f"Ошибка получения pending: {e}")
+        logger.error(f"Ошибка отклонения pending: {e}")
         return None
-def delete_pending(pending_id):
+def notify_user(chat_id, text):
     try:
-        with engine.connect() as conn:
-            conn.execute(sql_text(
-                "DELETE FROM merch_pending WHERE id = :pending_id"
-            ), {"pending_id": pending_id})
-            conn.commit()
+        bot.send_message(chat_id, text)
     except Exception as e:
-        logger.error(f"Ошибка удаления pending: {e}")
-def move_pending_to_orders(pending_id):
+        logger.error(f"Не удалось уведомить пользователя {chat_id}: {e}")
+# --- Постраничный вывод заказов (keyset) ---
+# Курсор — id последнего показанного заказа (в callback_data как "b<id>"), следующая страница — id < курсора.
+# С индексами (user_id, id DESC) и (status, id DESC) любая страница стоит столько же, сколько первая.
+ORDERS_PAGE_SIZE = 10
+ORDER_STATUSES = ["В обработке", "Отправлен", "Доставлен", "Отклонён"]
+
+def fetch_orders_page(user_id=None, status=None, before_id=None, limit=ORDERS_PAGE_SIZE):
     """
-    Переносит pending в merch_orders (по каждому item создаёт запись), очищает корзину пользователя.
+    Возвращает (rows, next_cursor): до limit заказов по убыванию id и курсор следующей страницы
+    (None, если это последняя страница — определяется по лишней (limit + 1) строке).
     """
-    row = get_pending(pending_id)
-    if not row:
-        return False
-    _, user_id, username, items_json, total, date_str = row
+    conditions = []
+    params = {"limit": limit + 1}
+    if user_id is not None:
+        conditions.append("user_id = :user_id")
+        params["user_id"] = user_id
+    if status:
+        conditions.append("status = :status")
+        params["status"] = status
+    if before_id:
+        conditions.append("id < :before_id")
+        params["before_id"] = before_id
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    with db_conn() as conn:
+        rows = conn.execute(sql_text(
+            f"SELECT id, user_id, username, item, quantity, price, total, date, status FROM merch_orders {where} ORDER BY id DESC LIMIT :limit"
+        ), params).fetchall()
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return rows[:limit], next_cursor
+def parse_orders_cursor(value):
+    """'b123' -> 123; пусто или старый формат с номером страницы — первая страница (None)"""
+    if value and value.startswith("b") and value[1:].isdigit():
+        return int(value[1:])
+    return None
+def format_user_order_lines(rows):
+    text_lines = []
+    for row in rows:
+        oid, _, _, item, qty, price, total, date_str, status = row
+        text_lines.append(f"#{oid} — {item} ×{qty} ({price}₽/шт) = {total}₽ | {status} | {date_str}")
+    return text_lines
+# --- Сводка покупок пользователя ---
+# Число заказов и сумма по статусам лежат в user_order_stats (строка на пару user_id + статус), поэтому
+# «История покупок» читает несколько строк по первичному ключу, а не агрегирует merch_orders. Итоги
+# пересчитываются в транзакции, которая меняет заказы пользователя, по покрывающему индексу
+# (user_id, status, total). Список заказов под сводкой — первая страница keyset-пагинации.
+def refresh_order_stats(conn, user_ids):
+    """Пересчитывает user_order_stats для пользователей, чьи заказы изменились в транзакции conn"""
+    user_ids = sorted({uid for uid in user_ids if uid is not None})
+    if not user_ids:
+        return
+    # DELETE блокирует строки итогов пользователя: параллельные пересчёты идут по очереди,
+    # и следующий запрос уже видит закоммиченные изменения другой транзакции
+    conn.execute(sql_text(
+        "DELETE FROM user_order_stats WHERE user_id IN :user_ids"
+    ).bindparams(sqlalchemy.bindparam("user_ids", expanding=True)), {"user_ids": user_ids})
+    conn.execute(sql_text(
+        "INSERT INTO user_order_stats (user_id, status, orders, spent) "
+        "SELECT user_id, COALESCE(status, ''), COUNT(*), COALESCE(SUM(total), 0) FROM merch_orders "
+        "WHERE user_id IN :user_ids GROUP BY user_id, COALESCE(status, '') "
+        "ON CONFLICT (user_id, status) DO UPDATE SET orders = EXCLUDED.orders, spent = EXCLUDED.spent"
+    ).bindparams(sqlalchemy.bindparam("user_ids", expanding=True)), {"user_ids": user_ids})
+def fetch_order_stats(user_id):
+    """[(status, orders, spent)] пользователя: сначала статусы в порядке ORDER_STATUSES, затем остальные"""
+    with db_conn() as conn:
+        rows = conn.execute(sql_text(
+            "SELECT status, orders, spent FROM user_order_stats WHERE user_id = :user_id AND orders > 0"
+        ), {"user_id": user_id}).fetchall()
+    order = {status: i for i, status in enumerate(ORDER_STATUSES)}
+    return sorted(rows, key=lambda r: (order.get(r[0], len(order)), r[0]))
+def format_order_stats(stats):
+    orders = sum(r[1] for r in stats)
+    spent = sum(r[2] for r in stats)
+    lines = [f"Заказов: {orders}, общая сумма покупок: {spent}₽"]
+    for status, count, amount in stats:
+        lines.append(f"• {status or 'Без статуса'}: {count} — {amount}₽")
+    return "\n".join(lines)
+# --- Массовая смена статуса заказов (админ) ---
+# Выбор заказов хранится в conversation_state владельца (шаг без обработчика сообщений — текст не
+# перехватывает): {"f": фильтр, "ids": [id], "all": все заказы с этим статусом}. Смена статуса — один
+# UPDATE ... RETURNING, уведомления группируются по пользователю и уходят в общем темпе отправки.
+BULK_ORDERS_STATE = "bulk_orders"
+
+def get_bulk_selection(chat_id):
+    entry = conversations.get(chat_id)
+    if entry is None or entry[0] != BULK_ORDERS_STATE:
+        return None
     try:
-        items = json.loads(items_json)
-    except:
-        items = []
+        return json.loads(entry[1])
+    except (TypeError, ValueError):
+        return None
+def save_bulk_selection(chat_id, selection):
+    conversations.set(chat_id, BULK_ORDERS_STATE, json.dumps(selection, ensure_ascii=False))
+def render_bulk_orders(selection, before_id=None):
+    """Текст и клавиатура страницы выбора: отметки заказов, «Ещё», выбор всех по фильтру и новый статус"""
+    status_filter = None if selection["f"] == "all" else selection["f"]
+    rows, next_cursor = fetch_orders_page(status=status_filter, before_id=before_id)
+    chosen = set(selection["ids"])
+    cursor = f"b{before_id}" if before_id else ""
+    ikb = types.InlineKeyboardMarkup(row_width=1)
+    for oid, uid, username, item, qty, price, total, date_str, status in rows:
+        mark = "☑️" if selection["all"] or oid in chosen else "⬜"
+        label = f"{mark} #{oid} | {username or f'ID:{uid}'} | {item}×{qty} | {total}₽ | {status}"
+        ikb.add(types.InlineKeyboardButton(label, callback_data=f"bulk_toggle:{oid}:{cursor}"))
+    if next_cursor:
+        ikb.add(types.InlineKeyboardButton("▶️ Ещё", callback_data=f"bulk_page:b{next_cursor}"))
+    if status_filter:
+        label = "↩️ Снять выбор всех" if selection["all"] else f"✅ Все со статусом «{status_filter}»"
+        ikb.add(types.InlineKeyboardButton(label, callback_data=f"bulk_all:{cursor}"))
+    ikb.row(*[types.InlineKeyboardButton(f"→ {st}", callback_data=f"bulk_apply:{i}")
+              for i, st in enumerate(ORDER_STATUSES) if st != status_filter])
+    ikb.add(types.InlineKeyboardButton("❌ Отмена", callback_data="bulk_cancel"))
+    chosen_text = f"все заказы со статусом «{status_filter}»" if selection["all"] else str(len(chosen))
+    text = (f"Массовое изменение — фильтр: {status_filter or 'Все'}\n"
+            f"Выбрано: {chosen_text}. Отметьте заказы и выберите новый статус.")
+    return text, ikb
+def bulk_update_order_status(selection, new_status):
+    """Меняет статус выбранных заказов одним запросом; возвращает [(id, user_id)] изменённых"""
+    with db_conn() as conn:
+        if selection["all"]:
+            result = conn.execute(sql_text(
+                "UPDATE merch_orders SET status = :new_status WHERE status = :status_filter RETURNING id, user_id"
+            ), {"new_status": new_status, "status_filter": selection["f"]})
+        else:
+            result = conn.execute(sql_text(
+                "UPDATE merch_orders SET status = :new_status "
+                "WHERE id IN :ids AND COALESCE(status, '') <> :new_status RETURNING id, user_id"
+            ).bindparams(sqlalchemy.bindparam("ids", expanding=True)),
+                {"new_status": new_status, "ids": selection["ids"]})
+        updated = result.fetchall()
+        refresh_order_stats(conn, [uid for _, uid in updated])
+        return updated
+def notify_order_status_change(updated, new_status):
+    """Одно сообщение на пользователя со всеми его заказами; отправка через общий SendPacer"""
+    by_user = {}
+    for oid, uid in sorted(updated):
+        by_user.setdefault(uid, []).append(oid)
+    def send(item):
+        uid, order_ids = item
+        if len(order_ids) == 1:
+            text = f"Обновление статуса вашего заказа #{order_ids[0]}: {new_status}"
+        else:
+            text = f"Обновление статуса ваших заказов {', '.join(f'#{oid}' for oid in order_ids)}: {new_status}"
+        return paced_send_message(uid, text)
+    with ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY) as pool:
+        sent = sum(pool.map(send, by_user.items()))
+    notify_user(OWNER_ID, f"Уведомления о статусе «{new_status}»: доставлено {sent} из {len(by_user)}")
+def handle_bulk_orders_callback(call, data):
+    chat_id = call.message.chat.id
+    action, _, arg = data.partition(":")
+    if action == "bulk_orders":
+        bot.answer_callback_query(call.id)
+        selection = {"f": arg or "all", "ids": [], "all": False}
+        save_bulk_selection(chat_id, selection)
+        text, ikb = render_bulk_orders(selection)
+        bot.send_message(chat_id, text, reply_markup=ikb)
+        return
+    selection = get_bulk_selection(chat_id)
+    if selection is None:
+        bot.answer_callback_query(call.id, "Выбор устарел — откройте список заказов заново.")
+        return
+    if action == "bulk_cancel":
+        bot.answer_callback_query(call.id, "Отменено")
+        conversations.clear(chat_id)
+        bot.edit_message_text("Массовое изменение отменено.", chat_id, call.message.message_id)
+        return
+    if action == "bulk_apply":
+        try:
+            new_status = ORDER_STATUSES[int(arg)]
+        except (ValueError, IndexError):
+            bot.answer_callback_query(call.id, "Неизвестный статус.")
+            return
+        if not selection["all"] and not selection["ids"]:
+            bot.answer_callback_query(call.id, "Сначала отметьте заказы.")
+            return
+        bot.answer_callback_query(call.id, "Меняю статус...")
+        updated = bulk_update_order_status(selection, new_status)
+        conversations.clear(chat_id)
+        users = len({uid for _, uid in updated})
+        bot.edit_message_text(f"Статус «{new_status}» установлен для заказов: {len(updated)} (пользователей: {users}).",
+                              chat_id, call.message.message_id)
+        if updated:
+            # уведомления — после коммита и в фоне: обработчик update не ждёт отправки
+            after_commit(lambda: threading.Thread(
+                target=notify_order_status_change, args=(updated, new_status), daemon=True
+            ).start())
+        return
+    before_id = None
+    if action == "bulk_toggle":
+        oid, _, cursor = arg.partition(":")
+        before_id = parse_orders_cursor(cursor)
+        if selection["all"]:
+            bot.answer_callback_query(call.id, "Снимите выбор всех, чтобы отмечать заказы по одному.")
+            return
+        oid = int(oid)
+        if oid in selection["ids"]:
+            selection["ids"].remove(oid)
+        else:
+            selection["ids"].append(oid)
+    elif action == "bulk_all":
+        before_id = parse_orders_cursor(arg)
+        selection["all"] = not selection["all"] and selection["f"] != "all"
+        selection["ids"] = []
+    elif action == "bulk_page":
+        before_id = parse_orders_cursor(arg)
+    bot.answer_callback_query(call.id)
+    save_bulk_selection(chat_id, selection)
+    text, ikb = render_bulk_orders(selection, before_id)
+    bot.edit_message_text(text, chat_id, call.message.message_id, reply_markup=ikb)
+# --- Регистрация пользователя и рефералы ---
+# Реферальный код — обратимая перестановка user_id по модулю 2^52 (нечётный множитель обратим),
+# поэтому коды не пересекаются и вставка не требует повторов. Префикс "r" отличает их от старых
+# случайных кодов из A-Z0-9, которые продолжают работать.
+_REF_MODULUS = 1 << 52
+_REF_MULTIPLIER = 0x5DEECE66D
+_REF_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def encode_referral_code(user_id):
+    n = (user_id * _REF_MULTIPLIER) % _REF_MODULUS
+    digits = []
+    while True:
+        n, r = divmod(n, len(_REF_ALPHABET))
+        digits.append(_REF_ALPHABET[r])
+        if n == 0:
+            break
+    return "r" + "".join(reversed(digits))
+def _register_user_steps(conn, params):
+    """То же, что CTE в register_user, отдельными запросами (SQLite)"""
+    referrer = conn.execute(sql_text(
+        "SELECT user_id FROM referrals WHERE referral_code = :ref_code AND user_id <> :user_id"
+    ), params).scalar()
+    ins = conn.execute(sql_text(
+        "INSERT INTO referrals (user_id, referral_code, referred_by, date_registered) "
+        "VALUES (:user_id, :referral_code, :referred_by, :date_registered) "
+        "ON CONFLICT (user_id) DO NOTHING RETURNING referred_by"
+    ), {**params, "referred_by": referrer}).fetchone()
+    referrals_count = None
+    if ins and ins[0] is not None:
+        referrals_count = conn.execute(sql_text(
+            "UPDATE referrals SET referrals_count = referrals_count + 1, bonus_points = bonus_points + 10 "
+            "WHERE user_id = :referrer RETURNING referrals_count"
+        ), {"referrer": ins[0]}).scalar()
+    return ins is not None, ins[0] if ins else None, referrals_count
+def register_user(user_id, ref_code=None):
+    """
+    Регистрирует пользователя и начисляет бонус рефереру одним запросом.
+    Возвращает (is_new_user, referral_code, referrer_id, referrals_count реферера).
+    """
+    referral_code = encode_referral_code(user_id)
+    params = {
+        "user_id": user_id,
+        "ref_code": ref_code,
+        "referral_code": referral_code,
+        "date_registered": str(date.today())
+    }
     try:
-        with engine.connect() as conn:
-            for it in items:
-                item = it.get("item")
-                qty = int(it.get("quantity", 0))
-                price = int(it.get("price", 0))
-                total_item = int(it.get("total", qty * price))
-                result = conn.execute(sql_text(
-                    """
-                    INSERT INTO merch_orders (user_id, username, item, quantity, price, total, date, status)
-                    VALUES (:user_id, :username, :item, :quantity, :price, :total, :date, :status)
-                    RETURNING id
+        with db_savepoint() as conn:
+            if not storage.writable_cte:
+                row = _register_user_steps(conn, params)
+            else:
+                row = conn.execute(sql_text(
                     """
-                ), {
-                    "user_id": user_id,
-                    "username": username,
-                    "item": item,
-                    "quantity": qty,
-                    "price": price,
-                    "total": total_item,
-                    "date": date_str,
-                    "status": "В обработке"
-                })
-                order_id = result.fetchone()[0]
-                # Логируем заказ в Google Sheets
-                if GOOGLE_SHEETS_ENABLED:
-                    log_order_to_google_sheets(
-                        order_id, user_id, username, item, qty, price, total_item, date_str, "В обработке"
+                    WITH ref AS (
+                        SELECT user_id FROM referrals WHERE referral_code = :ref_code AND user_id <> :user_id
+                    ), ins AS (
+                        INSERT INTO referrals (user_id, referral_code, referred_by, date_registered)
+                        VALUES (:user_id, :referral_code, (SELECT user_id FROM ref), :date_registered)
+                        ON CONFLICT (user_id) DO NOTHING
+                        RETURNING referred_by
+                    ), credit AS (
+                        UPDATE referrals SET referrals_count = referrals_count + 1, bonus_points = bonus_points + 10
+                        WHERE user_id = (SELECT referred_by FROM ins)
+                        RETURNING referrals_count
                     )
-            # очистить корзину пользователя
-            clear_cart(user_id)
-            # удалить pending
-            delete_pending(pending_id)
-            conn.commit()
-            return True
+                    SELECT EXISTS (SELECT 1 FROM ins), (SELECT referred_by FROM ins), (SELECT referrals_count FROM credit)
+                    """
+                ), params).fetchone()
+        is_new_user, referrer_id, referrals_count = row
+        return bool(is_new_user), referral_code, referrer_id, referrals_count
     except Exception as e:
-        logger.error(f"Ошибка переноса pending в заказы: {e}")
-        return False
+        logger.error(f"Ошибка регистрации пользователя {user_id}: {e}")
+        return False, None, None, None
+def notify_referrer(referrer_id, referrals_count):
+    try:
+        bot.send_message(referrer_id, f"🎉 Пользователь перешел по вашей реферальной ссылке! Вы получили 10 бонусных баллов. Всего приглашено: {referrals_count}")
+    except Exception as e:
+        logger.error(f"Не удалось уведомить реферера {referrer_id}: {e}")
 # --- Главное меню ---
 @bot.message_handler(commands=["start"])
 def start(message):
     # rate limit for main /start
-    if not allowed_action(message.chat.id, "start", limit_seconds=1):
+    if not allowed_action(message.chat.id, "start"):
         send_rate_limited_message(message.chat.id)
         return
     log_user(message.chat.id)
-    # Получаем username пользователя
-    username = f"@{message.from_user.username}" if message.from_user.username else None
-    # Проверяем, новый ли пользователь
-    try:
-        with engine.connect() as conn:
-            result = conn.execute(sql_text(
-                "SELECT 1 FROM referrals WHERE user_id = :user_id"
-            ), {"user_id": message.chat.id})
-            is_new_user = not bool(result.fetchone())
-    except Exception as e:
-        logger.error(f"Ошибка проверки пользователя: {e}")
-        is_new_user = True
-    # Если это реферальный запуск (есть параметр в /start)
-    referrer_id = None
-    if len(message.text.split()) > 1:
-        ref_code = message.text.split()[1]
-        try:
-            with engine.connect() as conn:
-                result = conn.execute(sql_text(
-                    "SELECT user_id FROM referrals WHERE referral_code = :ref_code"
-                ), {"ref_code": ref_code})
-                referrer = result.fetchone()
-                if referrer:
-                    referrer_id = referrer[0]
-        except Exception as e:
-            logger.error(f"Ошибка проверки реферального кода: {e}")
-    # Если пользователь новый, добавляем его в БД
-    if is_new_user:
-        # Генерируем уникальный реферальный код с ретраями на случай коллизии UNIQUE
-        import random
-        import string
-        max_attempts = 5
-        date_registered = str(date.today())
-        inserted = False
-        for _ in range(max_attempts):
-            referral_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-            try:
-                with engine.connect() as conn:
-                    conn.execute(sql_text(
-                        "INSERT INTO referrals (user_id, referral_code, referred_by, date_registered) VALUES (:user_id, :referral_code, :referred_by, :date_registered)"
-                    ), {
-                        "user_id": message.chat.id,
-                        "referral_code": referral_code,
-                        "referred_by": referrer_id,
-                        "date_registered": date_registered
-                    })
-                    conn.commit()
-                inserted = True
-                break
-            except IntegrityError:
-                # Конфликт кода — пробуем другой
-                continue
-            except Exception as e:
-                logger.error(f"Ошибка добавления пользователя в referrals: {e}")
-                break
-        # Если есть реферер, увеличиваем его счетчик
-        if inserted and referrer_id:
-            try:
-                with engine.connect() as conn:
-                    conn.execute(sql_text(
-                        "UPDATE referrals SET referrals_count = referrals_count + 1, bonus_points = bonus_points + 10 WHERE user_id = :referrer_id"
-                    ), {"referrer_id": referrer_id})
-                    conn.commit()
-                try:
-                    with engine.connect() as conn2:
-                        result = conn2.execute(sql_text(
-                            "SELECT referrals_count FROM referrals WHERE user_id = :referrer_id"
-                        ), {"referrer_id": referrer_id})
-                        referrals_count = result.fetchone()[0]
-                    bot.send_message(referrer_id, f"🎉 Пользователь перешел по вашей реферальной ссылке! Вы получили 10 бонусных баллов. Всего приглашено: {referrals_count}")
-                except Exception as e:
-                    logger.error(f"Не удалось уведомить реферера {referrer_id}: {e}")
-            except Exception as e:
-                logger.error(f"Ошибка обновления счетчика реферала: {e}")
-        # Логируем пользователя в Google Sheets
-        if GOOGLE_SHEETS_ENABLED:
-            log_user_to_google_sheets(message.chat.id, date_registered, username)
-        # Если есть реферер, логируем реферальную связь
-        if referrer_id:
-            log_referral_to_google_sheets(
-                message.chat.id, 
-                referrer_id, 
-                referral_code, 
-                date_registered,
-                username
-            )
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(
-        types.KeyboardButton("👥 Команда"),
-        types.KeyboardButton("🌍 Путешествия"),
-        types.KeyboardButton("🧘 Кундалини-йога"),
-        types.KeyboardButton("📸 Медиа"),
-        types.KeyboardButton("🛍 Мерч"),
-        types.KeyboardButton("🎁 Доп. услуги")
-    )
+    # Регистрация — только для настоящей команды /start (start() вызывают и кнопки «Назад к меню»)
+    if message.text and message.text.startswith("/start"):
+        parts = message.text.split()
+        ref_code = parts[1] if len(parts) > 1 else None
+        # Получаем username пользователя
+        username = f"@{message.from_user.username}" if message.from_user.username else None
+        is_new_user, referral_code, referrer_id, referrals_count = register_user(message.chat.id, ref_code)
+        if is_new_user:
+            date_registered = str(date.today())
+            # Логируем пользователя в Google Sheets
+            if GOOGLE_SHEETS_ENABLED:
+                log_user_to_google_sheets(message.chat.id, date_registered, username)
+            # Если есть реферер, логируем реферальную связь и уведомляем его после коммита
+            if referrer_id:
+                log_referral_to_google_sheets(
+                    message.chat.id,
+                    referrer_id,
+                    referral_code,
+                    date_registered,
+                    username
+                )
+                after_commit(notify_referrer, referrer_id, referrals_count)
     # --- ИЗМЕНЕНО: обновлено описание разделов ---
-    bot.send_message(message.chat.id, "👋 Добро пожаловать!\n"
-                "👥 Команда — узнайте о наших преподавателях и их опыте\n"
-                "🌍 Путешествия — эксклюзивные туры и духовные ретриты\n"
-                "🧘 Кундалини-йога — онлайн и офлайн занятия для трансформации\n"
-                "📸 Медиа — фото и видео с наших мероприятий и путешествий\n"
-                "🛍 Мерч — одежда и аксессуары для поддержки ScanDream\n"
-                "🎁 Доп. услуги — можете подписаться на события, что бы узнать первыми о наших будущих поездках!", reply_markup=kb)
+    # Приветствие — после коммита регистрации: вызов Bot API не должен держать транзакцию update
+    after_commit(bot.send_message, message.chat.id, TEXTS["welcome"], reply_markup=catalog.keyboards["main"])
 # --- Личный кабинет ---
-@bot.message_handler(func=lambda m: m.text == "👤 Личный кабинет")
+@bot.text_handler("👤 Личный кабинет")
 def personal_cabinet(message):
     if not allowed_action(message.chat.id, "personal_cabinet"):
         send_rate_limited_message(message.chat.id)
         return
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("📦 Мои заказы", "📜 История покупок", "🔗 Реферальная ссылка")
-    kb.add("📢 Подписаться на события", "🚫 Отписаться от событий")
-    kb.add("🔙 Назад в меню")
-    bot.send_message(message.chat.id, "👤 Ваш личный кабинет", reply_markup=kb)
+    bot.send_message(message.chat.id, TEXTS["cabinet"], reply_markup=catalog.keyboards["cabinet"])
 # Обновляем обработчик "Мои заказы"
-@bot.message_handler(func=lambda m: m.text == "📦 Мои заказы")
+@bot.text_handler("📦 Мои заказы")
 def my_orders(message):
     if not allowed_action(message.chat.id, "my_orders"):
         send_rate_limited_message(message.chat.id)
         return
     try:
-        # Параметры пагинации: page (1..), status фильтр (опц.)
-        # Предлагаем управлять через команды: /my_orders <page> [status]
-        page = 1
-        status_filter = None
-        # Если последнее сообщение формата "+Ещё" придёт callback — можно расширить позже
-        with engine.connect() as conn:
-            params = {"user_id": message.chat.id}
-            where = "WHERE user_id = :user_id"
-            if status_filter:
-                where += " AND status = :status"
-                params["status"] = status_filter
-            limit = 10
-            offset = (page - 1) * limit
-            result = conn.execute(sql_text(
-                f"SELECT id, item, quantity, price, total, date, status FROM merch_orders {where} ORDER BY id DESC LIMIT :limit OFFSET :offset"
-            ), {**params, "limit": limit, "offset": offset})
-            rows = result.fetchall()
+        rows, next_cursor = fetch_orders_page(user_id=message.chat.id)
         if not rows:
             bot.send_message(message.chat.id, "У вас нет заказов.")
             personal_cabinet(message)
             return
-        text_lines = []
-        for row in rows:
-            oid, item, qty, price, total, date_str, status = row
-            text_lines.append(f"#{oid} — {item} ×{qty} ({price}₽/шт) = {total}₽ | {status} | {date_str}")
-        # Кнопки пагинации (примитив, всегда показываем 'Ещё')
-        ikb = types.InlineKeyboardMarkup()
-        ikb.add(types.InlineKeyboardButton("▶️ Ещё", callback_data="user_orders_more:2"))
+        text_lines = format_user_order_lines(rows)
+        # Кнопка 'Ещё' — только если есть следующая страница
+        ikb = None
+        if next_cursor:
+            ikb = types.InlineKeyboardMarkup()
+            ikb.add(types.InlineKeyboardButton("▶️ Ещё", callback_data=f"user_orders_more:b{next_cursor}"))
         bot.send_message(message.chat.id, "Ваши заказы:\n" + "\n".join(text_lines), reply_markup=ikb)
     except Exception as e:
         logger.error(f"Ошибка получения заказов: {e}")
@@ -686,78 +2472,58 @@ def my_orders(message):
 # Пагинация для заказов пользователя (inline)
 @bot.callback_query_handler(func=lambda call: call.data.startswith("user_orders_more:"))
 def user_orders_more(call: types.CallbackQuery):
-    page_str = call.data.split(":", 1)[1]
-    try:
-        page = int(page_str)
-        if page < 1:
-            page = 1
-    except:
-        page = 1
+    before_id = parse_orders_cursor(call.data.split(":", 1)[1])
     user_id = call.from_user.id
     try:
-        with engine.connect() as conn:
-            limit = 10
-            offset = (page - 1) * limit
-            result = conn.execute(sql_text(
-                "SELECT id, item, quantity, price, total, date, status FROM merch_orders WHERE user_id = :user_id ORDER BY id DESC LIMIT :limit OFFSET :offset"
-            ), {"user_id": user_id, "limit": limit, "offset": offset})
-            rows = result.fetchall()
+        rows, next_cursor = fetch_orders_page(user_id=user_id, before_id=before_id)
         if not rows:
             bot.answer_callback_query(call.id, "Больше заказов нет")
             return
-        text_lines = []
-        for row in rows:
-            oid, item, qty, price, total, date_str, status = row
-            text_lines.append(f"#{oid} — {item} ×{qty} ({price}₽/шт) = {total}₽ | {status} | {date_str}")
-        next_page = page + 1
-        ikb = types.InlineKeyboardMarkup()
-        ikb.add(types.InlineKeyboardButton("▶️ Ещё", callback_data=f"user_orders_more:{next_page}"))
+        text_lines = format_user_order_lines(rows)
+        ikb = None
+        if next_cursor:
+            ikb = types.InlineKeyboardMarkup()
+            ikb.add(types.InlineKeyboardButton("▶️ Ещё", callback_data=f"user_orders_more:b{next_cursor}"))
         bot.send_message(user_id, "Ещё заказы:\n" + "\n".join(text_lines), reply_markup=ikb)
         bot.answer_callback_query(call.id)
     except Exception as e:
         logger.error(f"Ошибка пагинации заказов пользователя: {e}")
         bot.answer_callback_query(call.id, "Ошибка")
 # Добавляем обработчик для истории покупок
-@bot.message_handler(func=lambda m: m.text == "📜 История покупок")
+@bot.text_handler("📜 История покупок")
 def purchase_history(message):
     if not allowed_action(message.chat.id, "purchase_history"):
         send_rate_limited_message(message.chat.id)
         return
     try:
-        with engine.connect() as conn:
-            result = conn.execute(sql_text(
-                "SELECT id, item, quantity, price, total, date, status FROM merch_orders WHERE user_id = :user_id ORDER BY id DESC"
-            ), {"user_id": message.chat.id})
-            rows = result.fetchall()
-        if not rows:
+        stats = fetch_order_stats(message.chat.id)
+        if not stats:
             bot.send_message(message.chat.id, "История покупок пуста.")
             personal_cabinet(message)
             return
-        # Формируем сообщение
-        text = "История ваших покупок:\n"
-        total_spent = 0
-        for row in rows:
-            oid, item, qty, price, total, date_str, status = row
-            text += f"#{oid} — {item} ×{qty} ({price}₽/шт) = {total}₽ | {status} | {date_str}\n"
-            total_spent += total
-        if total_spent > 0:
-            text += f"\nОбщая сумма покупок: {total_spent}₽"
-        bot.send_message(message.chat.id, text)
+        # Сводка из user_order_stats + одна страница последних заказов; остальные — по кнопке «Ещё»
+        rows, next_cursor = fetch_orders_page(user_id=message.chat.id)
+        text = "История ваших покупок:\n" + format_order_stats(stats)
+        if rows:
+            text += "\n\nПоследние заказы:\n" + "\n".join(format_user_order_lines(rows))
+        ikb = None
+        if next_cursor:
+            ikb = types.InlineKeyboardMarkup()
+            ikb.add(types.InlineKeyboardButton("▶️ Ещё", callback_data=f"user_orders_more:b{next_cursor}"))
+        bot.send_message(message.chat.id, text, reply_markup=ikb)
         # Кнопка для возврата в личный кабинет
-        kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        kb.add("👤 Личный кабинет")
-        bot.send_message(message.chat.id, "Нажмите 'Личный кабинет' для возврата", reply_markup=kb)
+        bot.send_message(message.chat.id, TEXTS["back_to_cabinet"], reply_markup=catalog.keyboards["back_to_cabinet"])
     except Exception as e:
         logger.error(f"Ошибка получения истории покупок: {e}")
         bot.send_message(message.chat.id, "Произошла ошибка при получении истории покупок. Попробуйте позже.")
 # Добавляем обработчик для реферальной ссылки
-@bot.message_handler(func=lambda m: m.text == "🔗 Реферальная ссылка")
+@bot.text_handler("🔗 Реферальная ссылка")
 def referral_link(message):
     if not allowed_action(message.chat.id, "referral_link"):
         send_rate_limited_message(message.chat.id)
         return
     try:
-        with engine.connect() as conn:
+        with db_conn() as conn:
             result = conn.execute(sql_text(
                 "SELECT referral_code, referrals_count, bonus_points FROM referrals WHERE user_id = :user_id"
             ), {"user_id": message.chat.id})
@@ -766,7 +2532,7 @@ def referral_link(message):
             bot.send_message(message.chat.id, "Ошибка: ваша реферальная информация не найдена.")
             return
         referral_code, referrals_count, bonus_points = referral_info
-        referral_link = f"https://t.me/{bot.get_me().username}?start={referral_code}"
+        referral_link = f"https://t.me/{get_bot_username()}?start={referral_code}"
         response = f"Ваша реферальная ссылка:\n`{referral_link}`\n"
         response += f"Вы пригласили: {referrals_count} человек\n"
         response += f"Ваши бонусные баллы: {bonus_points}\n"
@@ -777,51 +2543,38 @@ def referral_link(message):
         response += "3. 50 баллов = скидка 500₽ на мерч или путешествия"
         bot.send_message(message.chat.id, response, parse_mode="Markdown")
         # Кнопка для возврата в личный кабинет
-        kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        kb.add("👤 Личный кабинет")
-        bot.send_message(message.chat.id, "Нажмите 'Личный кабинет' для возврата", reply_markup=kb)
+        bot.send_message(message.chat.id, TEXTS["back_to_cabinet"], reply_markup=catalog.keyboards["back_to_cabinet"])
     except Exception as e:
         logger.error(f"Ошибка получения реферальной информации: {e}")
         bot.send_message(message.chat.id, "Произошла ошибка при получении реферальной информации. Попробуйте позже.")
 # --- Разделы (сохранена логика) ---
-@bot.message_handler(func=lambda m: m.text == "🌍 Путешествия")
+@bot.text_handler("🌍 Путешествия")
 def travels_menu(message):
     if not allowed_action(message.chat.id, "travels_menu"):
         send_rate_limited_message(message.chat.id)
         return
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("📂 Архив путешествий", "🌍 Где мы сейчас", "🔙 Назад к меню")
-    bot.send_message(message.chat.id, "✈️ Путешествия: архив и текущее местоположение.", reply_markup=kb)
-@bot.message_handler(func=lambda m: m.text == "🧘 Кундалини-йога")
+    bot.send_message(message.chat.id, TEXTS["travels"], reply_markup=catalog.keyboards["travels"])
+@bot.text_handler("🧘 Кундалини-йога")
 def yoga_menu(message):
     if not allowed_action(message.chat.id, "yoga_menu"):
         send_rate_limited_message(message.chat.id)
         return
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("🏢 Офлайн-мероприятия", "💻 Онлайн-йога", "📅 Ближайшие мероприятия", "🔙 Назад к меню")
-    bot.send_message(message.chat.id, "🧘 Кундалини-йога: офлайн, онлайн и ближайшие события.", reply_markup=kb)
+    bot.send_message(message.chat.id, TEXTS["yoga"], reply_markup=catalog.keyboards["yoga"])
 # --- Онлайн-йога (оставлено как есть, с rate limit где логично) ---
-@bot.message_handler(func=lambda m: m.text == "💻 Онлайн-йога")
+@bot.text_handler("💻 Онлайн-йога")
 def online_yoga(message):
     if not allowed_action(message.chat.id, "online_yoga"):
         send_rate_limited_message(message.chat.id)
         return
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("Да, хочу", "Приобрести подписку", "🔙 Назад к онлайн-йоге")
-    bot.send_message(message.chat.id, """Это уникальная возможность быть в поле мастера онлайн. Практики диктуемые эпохой Водолея. Медитации. Работа в малых группах.
-Занятия проходят каждый вт и чт в 05:00 по мск. Все записи хранятся в канале группы.
-Ценность: 2500 рублей месяц, продление - 2300 руб.
-Хотите посмотреть пробный класс?""", reply_markup=kb)
-@bot.message_handler(func=lambda m: m.text == "Да, хочу")
+    bot.send_message(message.chat.id, TEXTS["online_yoga"], reply_markup=catalog.keyboards["online_yoga"])
+@bot.text_handler("Да, хочу")
 def try_online_yoga(message):
     if not allowed_action(message.chat.id, "try_online_yoga"):
         send_rate_limited_message(message.chat.id)
         return
-    bot.send_message(message.chat.id, "https://disk.yandex.ru/i/nCQFa8edIspzNA  ")
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("Приобрести подписку", "🔙 Назад к онлайн-йоге")
-    bot.send_message(message.chat.id, "Если вам понравилось и вы хотели бы дополнительно узнать больше о онлайн занятии, нажмите кнопку приобрести подписку и мы обязательно свяжемся с вами!", reply_markup=kb)
-@bot.message_handler(func=lambda m: m.text == "Приобрести подписку")
+    bot.send_message(message.chat.id, TEXTS["online_yoga_trial_link"])
+    bot.send_message(message.chat.id, TEXTS["online_yoga_trial"], reply_markup=catalog.keyboards["online_yoga_trial"])
+@bot.text_handler("Приобрести подписку")
 def buy_subscription(message):
     if not allowed_action(message.chat.id, "buy_subscription"):
         send_rate_limited_message(message.chat.id)
@@ -830,52 +2583,40 @@ def buy_subscription(message):
     user_info = f"Пользователь @{message.from_user.username or message.chat.id} хочет приобрести подписку на онлайн-йогу."
     bot.send_message(OWNER_ID, user_info)
     # Сообщаем пользователю
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("🔙 Назад к онлайн-йоге")
-    bot.send_message(message.chat.id, "Спасибо, что выбрали нас, мы скоро свяжемся с вами! 😊", reply_markup=kb)
-@bot.message_handler(func=lambda m: m.text == "🔙 Назад к онлайн-йоге")
+    bot.send_message(message.chat.id, TEXTS["subscription_thanks"], reply_markup=catalog.keyboards["back_to_online_yoga"])
+@bot.text_handler("🔙 Назад к онлайн-йоге")
 def back_to_online_yoga_menu(message):
     if not allowed_action(message.chat.id, "back_to_online_yoga"):
         send_rate_limited_message(message.chat.id)
         return
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("🏢 Офлайн-мероприятия", "💻 Онлайн-йога", "📅 Ближайшие мероприятия", "🔙 Назад к меню")
-    bot.send_message(message.chat.id, "🧘 Кундалини-йога: офлайн, онлайн и ближайшие события.", reply_markup=kb)
+    bot.send_message(message.chat.id, TEXTS["yoga"], reply_markup=catalog.keyboards["yoga"])
 # --- Новые обработчики (как были) ---
-@bot.message_handler(func=lambda m: m.text == "📅 Ближайшие мероприятия")
+@bot.text_handler("📅 Ближайшие мероприятия")
 def upcoming_events(message):
     if not allowed_action(message.chat.id, "upcoming_events"):
         send_rate_limited_message(message.chat.id)
         return
-    bot.send_message(message.chat.id, """- 10 августа мы отправляемся в «Большой Волжский Путь», путешествие на автодоме из Карелии на фестиваль кундалини-йоги в Волгоград:
-7 августа - Тольятти - <a href="https://t.me/+PosQ9pcHMIk4NjQ6  ">Большой класс и саундхидинг</a>
-9 августа - Волгоград - <a href="https://t.me/+ii8MpmrGhMo2YTVi  ">Большой класс и саундхилинг</a>
-10 августа - площадка 17 фестиваля кундалини-йоги - Большой класс.
-11 - 19 августа фестиваль кундалини-йоги (Волгоград)""", parse_mode="HTML")
-@bot.message_handler(func=lambda m: m.text == "▶️ YouTube")
+    bot.send_message(message.chat.id, TEXTS["upcoming_events"], parse_mode="HTML")
+@bot.text_handler("▶️ YouTube")
 def youtube_channel(message):
     if not allowed_action(message.chat.id, "youtube_channel"):
         send_rate_limited_message(message.chat.id)
         return
-    bot.send_message(message.chat.id, "https://www.youtube.com/@ScanDreamChannel  ")
-@bot.message_handler(func=lambda m: m.text == "📸 Медиа")
+    bot.send_message(message.chat.id, TEXTS["youtube"])
+@bot.text_handler("📸 Медиа")
 def media_menu(message):
     if not allowed_action(message.chat.id, "media_menu"):
         send_rate_limited_message(message.chat.id)
         return
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("▶️ YouTube", "🔙 Назад к меню")
-    bot.send_message(message.chat.id, "🎥 Медиа: наши видео на YouTube.", reply_markup=kb)
+    bot.send_message(message.chat.id, TEXTS["media"], reply_markup=catalog.keyboards["media"])
 # --- Доп. услуги: теперь здесь личный кабинет ---
-@bot.message_handler(func=lambda m: m.text == "🎁 Доп. услуги")
+@bot.text_handler("🎁 Доп. услуги")
 def services_menu(message):
     if not allowed_action(message.chat.id, "services_menu"):
         send_rate_limited_message(message.chat.id)
         return
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("👤 Личный кабинет", "🔙 Назад к меню")
-    bot.send_message(message.chat.id, "🔧 Дополнительные услуги: детали по запросу.", reply_markup=kb)
-@bot.message_handler(func=lambda m: m.text == "📢 Подписаться на события")
+    bot.send_message(message.chat.id, TEXTS["services"], reply_markup=catalog.keyboards["services"])
+@bot.text_handler("📢 Подписаться на события")
 def subscribe_events(message):
     if not allowed_action(message.chat.id, "subscribe_events"):
         send_rate_limited_message(message.chat.id)
@@ -884,7 +2625,7 @@ def subscribe_events(message):
         # Получаем username пользователя
         username = f"@{message.from_user.username}" if message.from_user.username else None
         date_subscribed = str(date.today())
-        with engine.connect() as conn:
+        with db_conn() as conn:
             # Проверяем, не отписывался ли пользователь ранее
             result = conn.execute(sql_text(
                 "SELECT 1 FROM unsubscriptions WHERE user_id = :user_id"
@@ -904,7 +2645,6 @@ def subscribe_events(message):
                 "date_subscribed": date_subscribed,
                 "username": username
             })
-            conn.commit()
         bot.send_message(message.chat.id, "Вы успешно подписались на события. Будем отправлять уведомления о новых ретритах и мероприятиях.")
         # Логируем подписку в Google Sheets
         if GOOGLE_SHEETS_ENABLED:
@@ -912,7 +2652,7 @@ def subscribe_events(message):
     except Exception as e:
         logger.error(f"Ошибка подписки: {e}")
         bot.send_message(message.chat.id, "Ошибка при подписке. Попробуйте позже.")
-@bot.message_handler(func=lambda m: m.text == "🚫 Отписаться от событий")
+@bot.text_handler("🚫 Отписаться от событий")
 def unsubscribe_events(message):
     if not allowed_action(message.chat.id, "unsubscribe_events"):
         send_rate_limited_message(message.chat.id)
@@ -921,7 +2661,7 @@ def unsubscribe_events(message):
         # Получаем username пользователя
         username = f"@{message.from_user.username}" if message.from_user.username else None
         date_unsubscribed = str(date.today())
-        with engine.connect() as conn:
+        with db_conn() as conn:
             # Удаляем из подписчиков
             conn.execute(sql_text(
                 "DELETE FROM subscriptions WHERE user_id = :user_id"
@@ -934,7 +2674,6 @@ def unsubscribe_events(message):
                 "date_unsubscribed": date_unsubscribed,
                 "username": username
             })
-            conn.commit()
         bot.send_message(message.chat.id, "Вы отписаны от рассылки событий.")
         # Логируем отписку в Google Sheets
         if GOOGLE_SHEETS_ENABLED:
@@ -942,61 +2681,45 @@ def unsubscribe_events(message):
     except Exception as e:
         logger.error(f"Ошибка отписки: {e}")
         bot.send_message(message.chat.id, "Ошибка при отписке. Попробуйте позже.")
-@bot.message_handler(func=lambda m: m.text == "👥 Команда")
+@bot.text_handler("👥 Команда")
 def team_menu(message):
     if not allowed_action(message.chat.id, "team_menu"):
         send_rate_limited_message(message.chat.id)
         return
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("🏷 О бренде", "🌐 Официальные источники", "🔙 Назад к меню")
-    bot.send_message(message.chat.id, """Нас зовут Алексей Бабенко — учитель кундалини-йоги, визионер, путешественник, кинематографист, медиа-продюсер.
-Более 20 лет личной практики, 18 лет преподавания. Преподаватель тренинга школы Амрит Нам Саровар (Франция) в России.
-Создатель йога-кемпа и ретритов по Карелии, Северной Осетии, Грузии, Армении и Турции.
-И Анастасия Голик — сертифицированный инструктор хатха-йоги, аромапрактик, вдохновитель и заботливая спутница ретритов.""", reply_markup=kb)
-@bot.message_handler(func=lambda m: m.text == "🏷 О бренде")
+    bot.send_message(message.chat.id, TEXTS["team"], reply_markup=catalog.keyboards["team"])
+@bot.text_handler("🏷 О бренде")
 def about_brand(message):
     if not allowed_action(message.chat.id, "about_brand"):
         send_rate_limited_message(message.chat.id)
         return
-    bot.send_message(message.chat.id, """ScanDream - https://t.me/scandream   - зарегистрированный товарный знак, основная идея которого осознанные творческие коммуникации. ScanDream - это место, где мы пересобираем конструкт Мира, рассматривая и восхищаясь его строением. Быть #scandream - это сканировать свое жизненное предназначение действием и мечтой. В реальности оставаться активным, осознанным и логичным, а мечтать широко, мощно, свободно и не ощущая предела. 
-Проект йога-кемп - это творческая интеграция опыта и пользы. Пользы через новые знания и умения. Умения через новые формы.""")
-@bot.message_handler(func=lambda m: m.text == "🌐 Официальные источники")
+    bot.send_message(message.chat.id, TEXTS["about_brand"])
+@bot.text_handler("🌐 Официальные источники")
 def official_sources(message):
     if not allowed_action(message.chat.id, "official_sources"):
         send_rate_limited_message(message.chat.id)
         return
-    bot.send_message(message.chat.id, """ОФИЦИАЛЬНЫЕ ИСТОЧНИКИ взаимодействия с командой ScanDream:
-1. Личная страница в ВК Алексея - https://vk.ru/scandream  
-2. Моя личная страница в ВК - https://vk.ru/yoga.golik  
-3. Официальный ТГ канал ScanDream•Live - https://t.me/scandream  
-4. Личный ТГ канал Алексея - https://t.me/scandreamlife  
-5. Личный мой ТГ канал - https://t.me/yogagolik_dnevnik  
-6. Йога с Алексеем Бабенко в ВК (Петрозаводск) - https://vk.ru/kyogababenko  """)
+    bot.send_message(message.chat.id, TEXTS["official_sources"])
 # Назад
-@bot.message_handler(func=lambda m: m.text == "🔙 Назад в меню")
+@bot.text_handler("🔙 Назад в меню")
 def back_to_menu_from_cabinet(message):
     if not allowed_action(message.chat.id, "back_to_menu"):
         send_rate_limited_message(message.chat.id)
         return
     start(message)
-@bot.message_handler(func=lambda m: m.text == "🔙 Назад к меню")
+@bot.text_handler("🔙 Назад к меню")
 def back_to_menu(message):
     if not allowed_action(message.chat.id, "back_to_menu"):
         send_rate_limited_message(message.chat.id)
         return
     start(message)
 # --- Мерч: меню (добавлены кнопки "Мои заказы") ---
-@bot.message_handler(func=lambda m: m.text == "🛍 Мерч")
+@bot.text_handler("🛍 Мерч")
 def merch_menu(message):
     if not allowed_action(message.chat.id, "merch_menu"):
         send_rate_limited_message(message.chat.id)
         return
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    for name in MERCH_ITEMS:
-        kb.add(types.KeyboardButton(name))
-    kb.add("🛍️ Корзина", "🔙 Назад к меню", "📦 Мои заказы")
-    bot.send_message(message.chat.id, "🛍️ Выберите товар:", reply_markup=kb)
-@bot.message_handler(func=lambda m: m.text in MERCH_ITEMS)
+    bot.send_message(message.chat.id, TEXTS["merch_choose"], reply_markup=catalog.keyboards["merch"])
+@bot.text_handler(*MERCH_ITEMS)
 def show_merch_item(message):
     if not allowed_action(message.chat.id, "show_merch_item"):
         send_rate_limited_message(message.chat.id)
@@ -1007,69 +2730,43 @@ def show_merch_item(message):
     if not os.path.exists("photos"):
         logger.error("Папка photos не найдена")
         bot.send_message(message.chat.id, "Ошибка: папка с изображениями не найдена")
-        kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        kb.add("✅ Заказать", "🔙 Назад к Мерч")
-        msg = bot.send_message(message.chat.id, "Выберите действие:", reply_markup=kb)
-        bot.register_next_step_handler(msg, lambda m: merch_order_choice(m, name))
+        bot.send_message(message.chat.id, TEXTS["merch_action"], reply_markup=catalog.keyboards["merch_item"])
+        conversations.set(message.chat.id, "merch_order_choice", name)
         return
-    # Если это список фото (для Сумка Шоппер)
-    if isinstance(photo_file, list):
-        media = []
-        found_valid_photo = False
-        for i, file in enumerate(photo_file):
-            file_path = f"photos/{file}"
-            if os.path.exists(file_path):
-                try:
-                    with open(file_path, "rb") as f:
-                        photo_data = f.read()
-                    photo = BytesIO(photo_data)
-                    photo.name = file
-                    if i == 0:  # Для первого фото добавляем описание и цену
-                        media.append(types.InputMediaPhoto(photo, caption=f"{name[2:]} — {price}₽"))
-                    else:
-                        media.append(types.InputMediaPhoto(photo))
-                    found_valid_photo = True
-                    logger.info(f"Фото найдено: {file_path}")
-                except Exception as e:
-                    logger.error(f"Ошибка при загрузке фото {file}: {e}")
-            else:
-                logger.warning(f"Файл не найден: {file_path}")
-        if media and found_valid_photo:
-            try:
-                bot.send_media_group(message.chat.id, media)
-            except Exception as e:
-                logger.error(f"Ошибка при отправке медиа-группы: {e}")
-                bot.send_message(message.chat.id, "Ошибка при отправке фото. Проверьте наличие файлов на сервере.")
-        else:
-            bot.send_message(message.chat.id, f"{name[2:]} — {price}₽")
-    # Если это одиночное фото (для других товаров)
-    else:
-        file_path = f"photos/{photo_file}"
+    caption = f"{name[2:]} — {price}₽"
+    # Список фото (для Сумка Шоппер) отправляется альбомом, одиночное фото — через send_photo
+    files = photo_file if isinstance(photo_file, list) else [photo_file]
+    file_paths = []
+    for file in files:
+        file_path = f"photos/{file}"
         if os.path.exists(file_path):
-            try:
-                with open(file_path, "rb") as photo:
-                    bot.send_photo(message.chat.id, photo, caption=f"{name[2:]} — {price}₽")
-            except Exception as e:
-                logger.error(f"Ошибка при загрузке фото: {e}")
-                bot.send_message(message.chat.id, f"{name[2:]} — {price}₽")
+            file_paths.append(file_path)
         else:
-            logger.error(f"Файл не найден: {file_path}")
-            bot.send_message(message.chat.id, f"{name[2:]} — {price}₽")
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("✅ Заказать", "🔙 Назад к Мерч")
-    msg = bot.send_message(message.chat.id, "Выберите действие:", reply_markup=kb)
-    bot.register_next_step_handler(msg, lambda m: merch_order_choice(m, name))
+            logger.warning(f"Файл не найден: {file_path}")
+    if file_paths:
+        try:
+            if not send_merch_photos(message.chat.id, file_paths, caption):
+                bot.send_message(message.chat.id, caption)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке фото: {e}")
+            bot.send_message(message.chat.id, caption)
+    else:
+        bot.send_message(message.chat.id, caption)
+    bot.send_message(message.chat.id, TEXTS["merch_action"], reply_markup=catalog.keyboards["merch_item"])
+    conversations.set(message.chat.id, "merch_order_choice", name)
+@bot.state_handler("merch_order_choice")
 def merch_order_choice(message, item_name):
     if not allowed_action(message.chat.id, "merch_order_choice"):
         send_rate_limited_message(message.chat.id)
         return
     if message.text == "✅ Заказать":
-        msg = bot.send_message(message.chat.id, "Сколько штук добавить?")
-        bot.register_next_step_handler(msg, lambda m: add_merch_quantity(m, item_name))
+        bot.send_message(message.chat.id, "Сколько штук добавить?")
+        conversations.set(message.chat.id, "add_merch_quantity", item_name)
     else:
         merch_menu(message)
+@bot.state_handler("add_merch_quantity")
 def add_merch_quantity(message, item_name):
-    if not allowed_action(message.chat.id, "add_merch_quantity", limit_seconds=2):
+    if not allowed_action(message.chat.id, "add_merch_quantity"):
         send_rate_limited_message(message.chat.id)
         return
     try:
@@ -1077,8 +2774,8 @@ def add_merch_quantity(message, item_name):
         if qty < 1:
             raise ValueError
     except:
-        msg = bot.send_message(message.chat.id, "Введите корректное число (>0):")
-        bot.register_next_step_handler(msg, lambda m: add_merch_quantity(m, item_name))
+        bot.send_message(message.chat.id, "Введите корректное число (>0):")
+        conversations.set(message.chat.id, "add_merch_quantity", item_name)
         return
     # цена из словаря
     price = MERCH_ITEMS[item_name][0]
@@ -1086,16 +2783,14 @@ def add_merch_quantity(message, item_name):
     add_to_cart_db(message.chat.id, item_name[2:], qty, price)
     bot.send_message(message.chat.id, f"✔️ Добавлено: {item_name[2:]} ×{qty} ({price}₽/шт)")
     merch_menu(message)
-@bot.message_handler(func=lambda m: m.text == "🛍️ Корзина")
+@bot.text_handler("🛍️ Корзина")
 def show_merch_cart(message):
-    if not allowed_action(message.chat.id, "show_merch_cart", limit_seconds=2):
+    if not allowed_action(message.chat.id, "show_merch_cart"):
         send_rate_limited_message(message.chat.id)
         return
     rows = get_cart_items(message.chat.id)
     if not rows:
-        kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        kb.add("🔙 Назад к Мерч")
-        bot.send_message(message.chat.id, "Корзина пуста.", reply_markup=kb)
+        bot.send_message(message.chat.id, "Корзина пуста.", reply_markup=catalog.keyboards["back_to_merch"])
         return
     lines = []
     total = 0
@@ -1104,21 +2799,19 @@ def show_merch_cart(message):
         lines.append(f"- {item}: {qty} × {price}₽ = {line_sum}₽")
         total += line_sum
     text = "\n".join(lines) + f"\nИтого: {total}₽"
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("✅ Оформить заказ", "🗑 Очистить корзину", "🔙 Назад к Мерч")
-    bot.send_message(message.chat.id, f"🛒 Корзина:\n{text}", reply_markup=kb)
-@bot.message_handler(func=lambda m: m.text == "🗑 Очистить корзину")
+    bot.send_message(message.chat.id, f"🛒 Корзина:\n{text}", reply_markup=catalog.keyboards["cart"])
+@bot.text_handler("🗑 Очистить корзину")
 def clear_cart_handler(message):
-    if not allowed_action(message.chat.id, "clear_cart", limit_seconds=1):
+    if not allowed_action(message.chat.id, "clear_cart"):
         send_rate_limited_message(message.chat.id)
         return
     clear_cart(message.chat.id)
     bot.send_message(message.chat.id, "Корзина очищена.")
     merch_menu(message)
-@bot.message_handler(func=lambda m: m.text == "✅ Оформить заказ")
+@bot.text_handler("✅ Оформить заказ")
 def send_merch_order(message):
     # rate limit for sending order
-    if not allowed_action(message.chat.id, "send_merch_order", limit_seconds=3):
+    if not allowed_action(message.chat.id, "send_merch_order"):
         send_rate_limited_message(message.chat.id)
         return
     # Создаём pending заказ и отправляем владельцу для подтверждения
@@ -1143,27 +2836,183 @@ def send_merch_order(message):
     except Exception as e:
         logger.error(f"Ошибка при отправке заказа владельцу: {e}")
         bot.send_message(message.chat.id, "Не удалось отправить заказ владельцу. Попробуйте позже.")
-@bot.message_handler(func=lambda m: m.text == "🔙 Назад к Мерч")
+@bot.text_handler("🔙 Назад к Мерч")
 def back_to_merch(message):
     if not allowed_action(message.chat.id, "back_to_merch"):
         send_rate_limited_message(message.chat.id)
         return
     merch_menu(message)
 # (Удален дублирующийся обработчик '📦 Мои заказы')
+# --- Потоковая выгрузка в файл ---
+# Строки читаются server-side курсором (yield_per) пачками по EXPORT_CHUNK и сразу пишутся в сжатый CSV;
+# файл держится в памяти до EXPORT_SPOOL_BYTES, дальше — во временном файле. Память не растёт с объёмом.
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "1000"))
+EXPORT_SPOOL_BYTES = 1 << 20
+SUBSCRIBERS_PREVIEW = int(os.getenv("SUBSCRIBERS_PREVIEW", "20"))  # подписчиков в подписи к файлу
+PARQUET_ROW_GROUP = int(os.getenv("EXPORT_PARQUET_ROW_GROUP", "50000"))
+
+def stream_rows(query, params=None):
+    """Строки запроса пачками через server-side cursor; соединение своё, вне единицы работы"""
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=EXPORT_CHUNK).execute(sql_text(query), params or {})
+        for chunk in result.partitions():
+            yield from chunk
+def write_gzip_csv(header, rows, fileobj=None):
+    """
+    CSV (UTF-8 с BOM — открывается в Excel) в gzip. Без fileobj пишет во временный файл
+    и возвращает его перемотанным на начало.
+    """
+    target = fileobj if fileobj is not None else tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    with gzip.open(target, "wt", encoding="utf-8-sig", newline="") as out:
+        writer = csv.writer(out)
+        writer.writerow(header)
+        writer.writerows(rows)
+    if fileobj is None:
+        target.seek(0)
+    return target
+def write_parquet(schema, rows, fileobj):
+    """
+    Parquet по группам строк: в памяти не больше PARQUET_ROW_GROUP строк.
+    schema — [(колонка, "int64" | "string" | "date")]. pyarrow тяжёлый, поэтому импортируется при первой выгрузке.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Для выгрузки в Parquet нужен pyarrow (pip install pyarrow)")
+    types_map = {"int64": pa.int64(), "string": pa.string(), "date": pa.date32()}
+    arrow_schema = pa.schema([(name, types_map[kind]) for name, kind in schema])
+    # SQLite отдаёт даты строками, PostgreSQL — объектами date
+    convert = [(lambda v: v if v is None or isinstance(v, date) else date.fromisoformat(str(v)[:10]))
+               if kind == "date" else None for _, kind in schema]
+    def table(batch):
+        columns = list(zip(*batch)) if batch else [()] * len(schema)
+        return pa.Table.from_arrays([
+            pa.array([conv(v) for v in column] if conv else list(column), type=field.type)
+            for column, conv, field in zip(columns, convert, arrow_schema)
+        ], schema=arrow_schema)
+    with pq.ParquetWriter(fileobj, arrow_schema, compression="snappy") as writer:
+        batch = []
+        written = False
+        for row in rows:
+            batch.append(tuple(row))
+            if len(batch) >= PARQUET_ROW_GROUP:
+                writer.write_table(table(batch))
+                batch = []
+                written = True
+        if batch or not written:
+            writer.write_table(table(batch))
+def export_subscribers(chat_id):
+    """Отправляет всех подписчиков файлом subscribers_<дата>.csv.gz, в подписи — число и первые записи"""
+    count = 0
+    preview = []
+    def rows():
+        nonlocal count
+        for user_id, username, date_subscribed in stream_rows(
+                "SELECT user_id, username, date_subscribed FROM subscriptions ORDER BY user_id"):
+            count += 1
+            if len(preview) < SUBSCRIBERS_PREVIEW:
+                preview.append(username or f"ID:{user_id}")
+            yield user_id, username or "", date_subscribed or ""
+    try:
+        with write_gzip_csv(["user_id", "username", "date_subscribed"], rows()) as document:
+            if not count:
+                bot.send_message(chat_id, "Нет подписчиков.")
+                return
+            more = f" и ещё {count - len(preview)}" if count > len(preview) else ""
+            caption = f"Подписчиков всего: {count}\n{', '.join(preview)}{more}"
+            if len(caption) > 1024:  # лимит подписи к файлу
+                caption = caption[:1021] + "..."
+            bot.send_document(chat_id, document, caption=caption,
+                              visible_file_name=f"subscribers_{date.today()}.csv.gz")
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки подписчиков: {e}")
+        bot.send_message(chat_id, "Ошибка при получении списка подписчиков.")
+# Выгрузка заказов для бухгалтерии: /export_orders в боте или python main.py export-orders
+EXPORT_FORMATS = ("csv", "parquet")
+ORDER_EXPORT_SCHEMA = [
+    ("id", "int64"), ("user_id", "int64"), ("username", "string"), ("item", "string"), ("quantity", "int64"),
+    ("price", "int64"), ("total", "int64"), ("date", "date"), ("status", "string"),
+]
+
+def export_orders(fileobj, fmt="csv", status=None, date_from=None, date_to=None):
+    """Пишет заказы (фильтр по статусу и датам включительно) в fileobj; возвращает число строк"""
+    conditions = []
+    params = {}
+    if status:
+        conditions.append("status = :status")
+        params["status"] = status
+    if date_from:
+        conditions.append("date >= :date_from")
+        params["date_from"] = date_from
+    if date_to:
+        conditions.append("date <= :date_to")
+        params["date_to"] = date_to
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    columns = [name for name, _ in ORDER_EXPORT_SCHEMA]
+    count = 0
+    def rows():
+        nonlocal count
+        for row in stream_rows(f"SELECT {', '.join(columns)} FROM merch_orders {where} ORDER BY id", params):
+            count += 1
+            yield row
+    if fmt == "parquet":
+        write_parquet(ORDER_EXPORT_SCHEMA, rows(), fileobj)
+    else:
+        write_gzip_csv(columns, rows(), fileobj)
+    return count
+def orders_export_filename(fmt):
+    return f"orders_{date.today()}.{'parquet' if fmt == 'parquet' else 'csv.gz'}"
+def parse_export_orders_args(text):
+    """'/export_orders parquet 2026-01-01 2026-03-31 Отправлен' -> (формат, статус, с, по); порядок свободный"""
+    fmt, dates, words = "csv", [], []
+    for token in text.split()[1:]:
+        if token.lower() in EXPORT_FORMATS:
+            fmt = token.lower()
+        elif re.fullmatch(r"\d{4}-\d{2}-\d{2}", token):
+            dates.append(str(date.fromisoformat(token)))
+        else:
+            words.append(token)
+    status = " ".join(words) or None
+    if status and status not in ORDER_STATUSES:
+        raise ValueError(f"Неизвестный статус: {status}")
+    if len(dates) > 2:
+        raise ValueError("Укажите не больше двух дат: начало и конец периода")
+    date_from = dates[0] if dates else None
+    date_to = dates[1] if len(dates) > 1 else None
+    return fmt, status, date_from, date_to
+def send_orders_export(chat_id, fmt="csv", status=None, date_from=None, date_to=None):
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as document:
+            count = export_orders(document, fmt, status, date_from, date_to)
+            if not count:
+                bot.send_message(chat_id, "Заказов по этому фильтру нет.")
+                return
+            document.seek(0)
+            period = f", период: {date_from or '…'} — {date_to or '…'}" if date_from or date_to else ""
+            bot.send_document(chat_id, document, caption=f"Заказов: {count}, статус: {status or 'все'}{period}",
+                              visible_file_name=orders_export_filename(fmt))
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки заказов: {e}")
+        bot.send_message(chat_id, f"Ошибка при выгрузке заказов: {e}")
 # --- Админ-панель (inline) и команды владельца ---
 @bot.message_handler(commands=['admin'])
 def admin_command(message):
     if message.chat.id != OWNER_ID:
         return
-    ikb = types.InlineKeyboardMarkup(row_width=1)
-    ikb.add(
-        types.InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
-        types.InlineKeyboardButton("🛍 Заказы", callback_data="admin_orders"),
-        types.InlineKeyboardButton("📬 Рассылка", callback_data="admin_broadcast"),
-        types.InlineKeyboardButton("📢 Подписчики", callback_data="admin_subscribers"),
-        types.InlineKeyboardButton("🔙 В главное меню", callback_data="admin_back")
-    )
-    bot.send_message(OWNER_ID, "Админ-панель (inline):", reply_markup=ikb)
+    bot.send_message(OWNER_ID, "Админ-панель (inline):", reply_markup=catalog.keyboards["admin"])
+@bot.message_handler(commands=['export_orders'])
+def export_orders_command(message):
+    if message.chat.id != OWNER_ID:
+        return
+    try:
+        fmt, status, date_from, date_to = parse_export_orders_args(message.text or "")
+    except ValueError as e:
+        bot.send_message(OWNER_ID, f"{e}\nФормат: /export_orders [csv|parquet] [ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]] [статус]")
+        return
+    bot.send_message(OWNER_ID, "Готовлю выгрузку заказов...")
+    threading.Thread(target=send_orders_export, args=(OWNER_ID, fmt, status, date_from, date_to),
+                     name="export-orders", daemon=True).start()
 # --- ОСНОВНЫЕ ИЗМЕНЕНИЯ: Исправлены ошибки в админ-панели ---
 # --- Обработчик callback'ов (inline кнопки) ---
 @bot.callback_query_handler(func=lambda call: True)
@@ -1178,46 +3027,28 @@ def callback_query_handler(call: types.CallbackQuery):
     # ИСПРАВЛЕНО: добавлена обработка None значений для статистики
     if data == "admin_stats" and user_id == OWNER_ID:
         bot.answer_callback_query(call.id)
+        flush_user_log()
         try:
-            with engine.connect() as conn:
-                today = str(date.today())
-                result = conn.execute(sql_text(
-                    "SELECT COUNT(DISTINCT user_id) FROM user_log WHERE date = :today"
-                ), {"today": today})
-                today_count = result.fetchone()[0] or 0
-                result = conn.execute(sql_text(
-                    "SELECT COUNT(DISTINCT user_id) FROM user_log"
-                ))
-                total_count = result.fetchone()[0] or 0
-            bot.send_message(OWNER_ID, f"📊 Статистика\nСегодня: {today_count}\nЗа всё время: {total_count}")
+            today_count, week_count, month_count, total_count = get_activity_summary()
+            stats_text = (
+                f"📊 Статистика\nСегодня: {today_count}\nЗа 7 дней: ≈{week_count}\n"
+                f"За 30 дней: ≈{month_count}\nЗа всё время: ≈{total_count}"
+            )
+            rl_stats = get_rate_limit_stats()
+            if rl_stats:
+                hits = sum(h for h, _ in rl_stats.values())
+                denies = sum(d for _, d in rl_stats.values())
+                stats_text += f"\nАнтиспам (с запуска воркера): пропущено {hits}, отклонено {denies}"
+            bot.send_message(OWNER_ID, stats_text)
         except Exception as e:
             logger.error(f"Ошибка получения статистики: {e}")
             bot.send_message(OWNER_ID, "Ошибка при получении статистики.")
         return
     # ИСПРАВЛЕНО: улучшена обработка подписчиков
     if data == "admin_subscribers" and user_id == OWNER_ID:
-        bot.answer_callback_query(call.id)
-        try:
-            with engine.connect() as conn:
-                result = conn.execute(sql_text(
-                    "SELECT user_id, username FROM subscriptions"
-                ))
-                rows = result.fetchall()
-            if not rows:
-                bot.send_message(OWNER_ID, "Нет подписчиков.")
-            else:
-                lst = []
-                for user_id, username in rows:
-                    if username:
-                        lst.append(username)
-                    else:
-                        lst.append(f"ID:{user_id}")
-                subscribers_list = ", ".join(lst)
-                # Добавляем информацию о количестве
-                bot.send_message(OWNER_ID, f"Подписчиков всего: {len(rows)}\n{subscribers_list}")
-        except Exception as e:
-            logger.error(f"Ошибка получения подписчиков: {e}")
-            bot.send_message(OWNER_ID, "Ошибка при получении списка подписчиков.")
+        bot.answer_callback_query(call.id, "Готовлю файл...")
+        # выгрузка в фоне: поток обработки update не ждёт чтения и загрузки файла
+        threading.Thread(target=export_subscribers, args=(OWNER_ID,), name="export-subscribers", daemon=True).start()
         return
     # Подтверждение/отмена рассылки (владелец)
     if data and data.startswith("confirm_broadcast:") and user_id == OWNER_ID:
@@ -1227,24 +3058,25 @@ def callback_query_handler(call: types.CallbackQuery):
         except Exception:
             bot.answer_callback_query(call.id, "Некорректные данные.")
             return
+        # Переводим черновик в статус running атомарно — повторное нажатие не запустит рассылку дважды
         try:
-            with engine.connect() as conn:
-                result = conn.execute(sql_text("SELECT text FROM broadcasts WHERE id = :id"), {"id": b_id})
-                row = result.fetchone()
+            with db_conn() as conn:
+                row = conn.execute(sql_text(
+                    "UPDATE broadcasts SET status = 'running', started_at = :now WHERE id = :id AND COALESCE(status, 'draft') = 'draft' RETURNING id"
+                ), {"id": b_id, "now": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}).fetchone()
         except Exception as e:
-            logger.error(f"Ошибка получения текста рассылки: {e}")
+            logger.error(f"Ошибка запуска рассылки: {e}")
             row = None
         if not row:
-            bot.answer_callback_query(call.id, "Черновик рассылки не найден.")
+            bot.answer_callback_query(call.id, "Черновик рассылки не найден или уже отправлен.")
             return
-        broadcast_text = row[0]
         bot.answer_callback_query(call.id, "Начинаем рассылку...")
         try:
             bot.delete_message(call.message.chat.id, call.message.message_id)
         except:
             pass
-        bot.send_message(OWNER_ID, "📤 Рассылка началась...")
-        confirm_broadcast(broadcast_text)
+        # поток рассылки стартует только после коммита статуса running
+        after_commit(confirm_broadcast, b_id)
         return
     if data == "cancel_broadcast" and user_id == OWNER_ID:
         bot.answer_callback_query(call.id, "Рассылка отменена")
@@ -1258,56 +3090,61 @@ def callback_query_handler(call: types.CallbackQuery):
     if data == "admin_broadcast" and user_id == OWNER_ID:
         bot.answer_callback_query(call.id)
         # Просим владельца отправить текст
-        msg = bot.send_message(OWNER_ID, "Отправьте текст рассылки (будет отправлено всем подписчикам).")
-        bot.register_next_step_handler(msg, prepare_broadcast)
+        bot.send_message(OWNER_ID, "Отправьте текст рассылки (будет отправлено всем подписчикам).")
+        conversations.set(OWNER_ID, "prepare_broadcast")
         return
     # ИСПРАВЛЕНО: Обновлен запрос к заказам, учитывающий структуру таблицы
     if data.startswith("admin_orders") and user_id == OWNER_ID:
         bot.answer_callback_query(call.id)
         try:
-            # Параметры: admin_orders[:status][:page]
+            # Параметры: admin_orders[:status][:b<id последнего показанного заказа>]
             parts = data.split(":")
             status_filter = parts[1] if len(parts) > 1 and parts[1] else None
-            page = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 1
-            with engine.connect() as conn:
-                where = "WHERE 1=1"
-                params = {}
-                if status_filter and status_filter != "all":
-                    where += " AND status = :status"
-                    params["status"] = status_filter
-                limit = 10
-                offset = (page - 1) * limit
-                result = conn.execute(sql_text(
-                    f"SELECT id, user_id, username, item, quantity, price, total, date, status FROM merch_orders {where} ORDER BY id DESC LIMIT :limit OFFSET :offset"
-                ), {**params, "limit": limit, "offset": offset})
-                rows = result.fetchall()
+            before_id = parse_orders_cursor(parts[2]) if len(parts) > 2 else None
+            rows, next_cursor = fetch_orders_page(
+                status=status_filter if status_filter != "all" else None,
+                before_id=before_id
+            )
             if not rows:
                 bot.send_message(OWNER_ID, "Заказов нет.")
                 return
             # Для компактности покажем кнопки-переключатели на отдельные заказы
             ikb = types.InlineKeyboardMarkup(row_width=1)
             # Фильтры по статусам
-            filter_row = [
-                types.InlineKeyboardButton("Все", callback_data="admin_orders:all:1"),
-                types.InlineKeyboardButton("В обработке", callback_data="admin_orders:В обработке:1"),
-                types.InlineKeyboardButton("Отправлен", callback_data="admin_orders:Отправлен:1"),
-                types.InlineKeyboardButton("Доставлен", callback_data="admin_orders:Доставлен:1"),
-                types.InlineKeyboardButton("Отклонён", callback_data="admin_orders:Отклонён:1"),
-            ]
+            filter_row = [types.InlineKeyboardButton("Все", callback_data="admin_orders:all:")]
+            filter_row += [types.InlineKeyboardButton(st, callback_data=f"admin_orders:{st}:") for st in ORDER_STATUSES]
             ikb.row(*filter_row)
             for row in rows:
                 oid, uid, username, item, qty, price, total, date_str, status = row
                 # Добавлено поле price в отображение
                 label = f"#{oid} | {username or f'ID:{uid}'} | {item}×{qty} | {price}₽ | {total}₽ | {status}"
                 ikb.add(types.InlineKeyboardButton(label, callback_data=f"open_order:{oid}"))
-            next_page = page + 1
-            ikb.add(types.InlineKeyboardButton("▶️ Ещё", callback_data=f"admin_orders:{status_filter or 'all'}:{next_page}"))
+            if next_cursor:
+                ikb.add(types.InlineKeyboardButton("▶️ Ещё", callback_data=f"admin_orders:{status_filter or 'all'}:b{next_cursor}"))
+            ikb.add(types.InlineKeyboardButton("☑️ Изменить несколько", callback_data=f"bulk_orders:{status_filter or 'all'}"))
+            ikb.add(types.InlineKeyboardButton("📥 Выгрузить в CSV", callback_data=f"export_orders:{status_filter or 'all'}"))
             ikb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="admin_back"))
-            bot.send_message(OWNER_ID, f"Заказы (стр. {page}) — фильтр: {status_filter or 'Все'}", reply_markup=ikb)
+            title = "Заказы (продолжение)" if before_id else "Заказы"
+            bot.send_message(OWNER_ID, f"{title} — фильтр: {status_filter if status_filter and status_filter != 'all' else 'Все'}", reply_markup=ikb)
         except Exception as e:
             logger.error(f"Ошибка получения заказов: {e}")
             bot.send_message(OWNER_ID, "Ошибка при получении списка заказов.")
         return
+    # Выгрузка всех заказов по текущему фильтру файлом
+    if data.startswith("export_orders:") and user_id == OWNER_ID:
+        bot.answer_callback_query(call.id, "Готовлю файл...")
+        status_filter = data.split(":", 1)[1]
+        threading.Thread(target=send_orders_export, args=(OWNER_ID, "csv", None if status_filter == "all" else status_filter),
+                         name="export-orders", daemon=True).start()
+        return
+    # Массовое изменение статуса заказов
+    if data.startswith("bulk_") and user_id == OWNER_ID:
+        try:
+            handle_bulk_orders_callback(call, data)
+        except Exception as e:
+            logger.error(f"Ошибка массового изменения заказов: {e}")
+            bot.send_message(OWNER_ID, "Ошибка при массовом изменении заказов.")
+        return
     # Открыть конкретный заказ (показать детали + кнопки изменения статуса)
     if data and data.startswith("open_order:") and user_id == OWNER_ID:
         bot.answer_callback_query(call.id)
@@ -1317,7 +3154,7 @@ def callback_query_handler(call: types.CallbackQuery):
             bot.send_message(OWNER_ID, "Неправильный id заказа.")
             return
         try:
-            with engine.connect() as conn:
+            with db_conn() as conn:
                 # Исправленный запрос с учетом всех полей
                 result = conn.execute(sql_text(
                     "SELECT id, user_id, username, item, quantity, price, total, date, status FROM merch_orders WHERE id = :oid"
@@ -1355,24 +3192,19 @@ def callback_query_handler(call: types.CallbackQuery):
             bot.send_message(OWNER_ID, "Неправильный формат данных.")
             return
         try:
-            with engine.connect() as conn:
-                result = conn.execute(sql_text(
-                    "SELECT user_id FROM merch_orders WHERE id = :oid"
-                ), {"oid": oid})
-                row = result.fetchone()
-                if not row:
-                    bot.send_message(OWNER_ID, f"Заказ #{oid} не найден.")
-                    return
-                user_for_notify = row[0]
-                conn.execute(sql_text(
-                    "UPDATE merch_orders SET status = :new_status WHERE id = :oid"
-                ), {"new_status": new_status, "oid": oid})
-                conn.commit()
-            bot.send_message(OWNER_ID, f"Статус заказа #{oid} изменён на: {new_status}")
-            try:
-                bot.send_message(user_for_notify, f"Обновление статуса вашего заказа #{oid}: {new_status}")
-            except Exception as e:
-                logger.error(f"Не удалось уведомить пользователя {user_for_notify}: {e}")
+            with db_conn() as conn:
+                row = conn.execute(sql_text(
+                    "UPDATE merch_orders SET status = :new_status WHERE id = :oid RETURNING user_id"
+                ), {"new_status": new_status, "oid": oid}).fetchone()
+                if row:
+                    refresh_order_stats(conn, [row[0]])
+            if not row:
+                bot.send_message(OWNER_ID, f"Заказ #{oid} не найден.")
+                return
+            # сообщения — после коммита: блокировка строки не держится на время запросов к Telegram,
+            # а при откате транзакции пользователь не узнает о несостоявшейся смене статуса
+            after_commit(notify_user, OWNER_ID, f"Статус заказа #{oid} изменён на: {new_status}")
+            after_commit(notify_user, row[0], f"Обновление статуса вашего заказа #{oid}: {new_status}")
         except Exception as e:
             logger.error(f"Ошибка изменения статуса заказа: {e}")
             bot.send_message(OWNER_ID, f"Ошибка при изменении статуса заказа #{oid}.")
@@ -1386,21 +3218,15 @@ def callback_query_handler(call: types.CallbackQuery):
             bot.send_message(OWNER_ID, "Неправильный id.")
             return
         try:
-            with engine.connect() as conn:
-                result = conn.execute(sql_text(
-                    "SELECT user_id FROM merch_orders WHERE id = :oid"
-                ), {"oid": oid})
-                row = result.fetchone()
-                conn.execute(sql_text(
-                    "DELETE FROM merch_orders WHERE id = :oid"
-                ), {"oid": oid})
-                conn.commit()
-            bot.send_message(OWNER_ID, f"Заказ #{oid} удалён.")
+            with db_conn() as conn:
+                row = conn.execute(sql_text(
+                    "DELETE FROM merch_orders WHERE id = :oid RETURNING user_id"
+                ), {"oid": oid}).fetchone()
+                if row:
+                    refresh_order_stats(conn, [row[0]])
+            after_commit(notify_user, OWNER_ID, f"Заказ #{oid} удалён.")
             if row:
-                try:
-                    bot.send_message(row[0], f"Ваш заказ #{oid} удалён администратором.")
-                except Exception:
-                    pass
+                after_commit(notify_user, row[0], f"Ваш заказ #{oid} удалён администратором.")
         except Exception as e:
             logger.error(f"Ошибка удаления заказа: {e}")
             bot.send_message(OWNER_ID, f"Ошибка при удалении заказа #{oid}.")
@@ -1413,28 +3239,16 @@ def callback_query_handler(call: types.CallbackQuery):
         except:
             bot.send_message(OWNER_ID, "Неправильный id pending.")
             return
-        try:
-            # ИСПРАВЛЕНО: сначала получаем информацию о заказе, сохраняем ID пользователя, потом обрабатываем заказ
-            pending = get_pending(pid)
-            if not pending:
-                bot.send_message(OWNER_ID, f"Ожидающий заказ #{pid} не найден.")
-                return
-            _, uid, username, items_json, total, date_str = pending
-            
-            # Переносим pending -> orders, очищаем корзину пользователя
-            ok = move_pending_to_orders(pid)
-            if ok:
-                bot.send_message(OWNER_ID, f"Заказ #{pid} подтверждён и перенесён в заказы.")
-                # Отправляем уведомление клиенту
-                try:
-                    bot.send_message(uid, f"Ваш заказ #{pid} подтвержден. Мы скоро свяжемся с вами! Все детали в личном кабинете.")
-                except Exception as e:
-                    logger.error(f"Не удалось уведомить пользователя {uid}: {e}")
-            else:
-                bot.send_message(OWNER_ID, "Ошибка при подтверждении заказа.")
-        except Exception as e:
-            logger.error(f"Ошибка подтверждения pending: {e}")
+        # Перенос pending -> orders одним запросом; уведомления уходят только после коммита
+        orders = move_pending_to_orders(pid)
+        if orders is None:
             bot.send_message(OWNER_ID, "Ошибка при подтверждении заказа.")
+        elif not orders:
+            bot.send_message(OWNER_ID, f"Ожидающий заказ #{pid} не найден.")
+        else:
+            uid = orders[0][1]
+            after_commit(notify_user, OWNER_ID, f"Заказ #{pid} подтверждён и перенесён в заказы.")
+            after_commit(notify_user, uid, f"Ваш заказ #{pid} подтвержден. Мы скоро свяжемся с вами! Все детали в личном кабинете.")
         return
     if data and data.startswith("decline_pending:") and user_id == OWNER_ID:
         bot.answer_callback_query(call.id, "Отклоняю заказ")
@@ -1443,26 +3257,13 @@ def callback_query_handler(call: types.CallbackQuery):
         except:
             bot.send_message(OWNER_ID, "Неправильный id pending.")
             return
-        try:
-            # ИСПРАВЛЕНО: сначала получаем информацию о заказе, сохраняем ID пользователя, потом обрабатываем заказ
-            pending = get_pending(pid)
-            if not pending:
-                bot.send_message(OWNER_ID, f"Ожидающий заказ #{pid} не найден.")
-                return
-            _, uid, username, items_json, total, date_str = pending
-            
-            # Удаляем pending и очищаем корзину пользователя
-            delete_pending(pid)
-            clear_cart(uid)
-            bot.send_message(OWNER_ID, f"Заказ #{pid} отклонён и удалён.")
-            # Отправляем уведомление клиенту
-            try:
-                bot.send_message(uid, f"Ваш заказ #{pid} отменен. Мы скоро свяжемся с вами! Все детали в личном кабинете.")
-            except Exception as e:
-                logger.error(f"Не удалось уведомить пользователя {uid}: {e}")
-        except Exception as e:
-            logger.error(f"Ошибка отклонения pending: {e}")
-            bot.send_message(OWNER_ID, "Ошибка при отклонении заказа.")
+        # Удаляем pending и очищаем корзину пользователя
+        uid = decline_pending(pid)
+        if uid is None:
+            bot.send_message(OWNER_ID, f"Ожидающий заказ #{pid} не найден.")
+            return
+        after_commit(notify_user, OWNER_ID, f"Заказ #{pid} отклонён и удалён.")
+        after_commit(notify_user, uid, f"Ваш заказ #{pid} отменен. Мы скоро свяжемся с вами! Все детали в личном кабинете.")
         return
     # fallback: неопознанный callback — просто ack
     try:
@@ -1470,6 +3271,7 @@ def callback_query_handler(call: types.CallbackQuery):
     except:
         pass
 # --- ИСПРАВЛЕНО: Добавлено подтверждение для рассылки ---
+@bot.state_handler("prepare_broadcast")
 def prepare_broadcast(message):
     """Подготовка рассылки - запрос подтверждения"""
     # Разрешаем только владельцу инициировать рассылку
@@ -1481,12 +3283,11 @@ def prepare_broadcast(message):
     broadcast_text = message.text
     # Сохраняем текст в БД и используем ID в callback_data (безопасно и короче)
     try:
-        with engine.connect() as conn:
+        with db_conn() as conn:
             result = conn.execute(sql_text(
                 "INSERT INTO broadcasts (text, created_at) VALUES (:text, :created_at) RETURNING id"
             ), {"text": broadcast_text, "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
             b_id = result.fetchone()[0]
-            conn.commit()
     except Exception as e:
         logger.error(f"Ошибка сохранения текста рассылки: {e}")
         bot.send_message(OWNER_ID, "Не удалось подготовить рассылку.")
@@ -1503,30 +3304,154 @@ def prepare_broadcast(message):
         f"Вы собираетесь отправить следующее сообщение всем подписчикам:\n{broadcast_text}\nОтправить рассылку?",
         reply_markup=ikb
     )
-def confirm_broadcast(broadcast_text):
-    """Фактическая отправка рассылки"""
-    try:
-        with engine.connect() as conn:
-            result = conn.execute(sql_text(
-                "SELECT user_id FROM subscriptions"
-            ))
-            rows = result.fetchall()
-        if not rows:
-            bot.send_message(OWNER_ID, "Нет подписчиков для рассылки.")
+# --- Фоновая рассылка с учётом flood control Telegram ---
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "30"))  # сообщений в секунду на весь процесс
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "200"))  # размер пачки между чекпоинтами
+BROADCAST_PROGRESS_SECONDS = 5
+BROADCAST_LOCK_KEY = 987654322  # advisory lock (BROADCAST_LOCK_KEY, id рассылки) — один исполнитель на рассылку
+
+class SendPacer:
+    """Общий темп отправки: не больше rate сообщений в секунду; пауза по retry_after действует на всех отправителей"""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next = 0.0
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    def pause(self, seconds):
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+telegram_pacer = SendPacer(BROADCAST_RATE)
+
+def paced_send_message(chat_id, text, attempts=3, **kwargs):
+    """Отправляет сообщение в общем темпе; на 429 ждёт retry_after и повторяет. Возвращает True при успехе."""
+    for _ in range(attempts):
+        telegram_pacer.wait()
+        try:
+            bot.send_message(chat_id, text, **kwargs)
+            return True
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = ((e.result_json or {}).get("parameters") or {}).get("retry_after", 1)
+                logger.warning(f"Flood control Telegram: пауза {retry_after} с")
+                telegram_pacer.pause(retry_after)
+                continue
+            logger.error(f"Ошибка при отправке сообщения {chat_id}: {e}")
+            return False
+        except Exception as e:
+            logger.error(f"Ошибка при отправке сообщения {chat_id}: {e}")
+            return False
+    return False
+_active_broadcasts = set()
+_active_broadcasts_lock = threading.Lock()
+
+def confirm_broadcast(b_id):
+    """Запускает рассылку в фоновом потоке (обработчик callback не блокируется)"""
+    with _active_broadcasts_lock:
+        if b_id in _active_broadcasts:
             return
-        sent = 0
-        failed = 0
-        for (user_id,) in rows:
+        _active_broadcasts.add(b_id)
+    threading.Thread(target=_broadcast_worker, args=(b_id,), daemon=True).start()
+def _broadcast_worker(b_id):
+    try:
+        run_broadcast(b_id)
+    except Exception as e:
+        logger.error(f"Ошибка рассылки #{b_id}: {e}")
+        try:
+            bot.send_message(OWNER_ID, f"Ошибка при выполнении рассылки #{b_id}. Она продолжится автоматически.")
+        except Exception:
+            pass
+    finally:
+        with _active_broadcasts_lock:
+            _active_broadcasts.discard(b_id)
+def _report_broadcast_progress(b_id, message_id, sent, failed, total, done=False):
+    title = "Рассылка завершена" if done else "📤 Рассылка идёт"
+    text = f"{title} (#{b_id})\nОбработано: {sent + failed} из ~{total}\nУспешно: {sent}\nОшибок: {failed}"
+    try:
+        if message_id:
+            bot.edit_message_text(text, OWNER_ID, message_id)
+            return message_id
+        return bot.send_message(OWNER_ID, text).message_id
+    except Exception as e:
+        logger.debug(f"Не удалось обновить прогресс рассылки: {e}")
+        return message_id
+def run_broadcast(b_id):
+    """
+    Отправляет рассылку всем подписчикам. Получатели читаются пачками по возрастанию user_id (keyset, каждая
+    пачка — своя короткая транзакция: на время отправки соединение возвращается в пул и транзакция не держится),
+    после каждой пачки в broadcasts сохраняется чекпоинт, поэтому прерванная рассылка продолжается с места остановки.
+    """
+    with engine.connect() as lock_conn:
+        got = storage.try_lock(lock_conn, BROADCAST_LOCK_KEY, b_id)
+        if not got:
+            return  # рассылку уже выполняет другой воркер
+        try:
+            row = lock_conn.execute(sql_text(
+                "SELECT text, status, COALESCE(last_user_id, 0), COALESCE(sent, 0), COALESCE(failed, 0), progress_message_id FROM broadcasts WHERE id = :id"
+            ), {"id": b_id}).fetchone()
+            lock_conn.commit()
+            if not row or row[1] != "running":
+                return
+            broadcast_text, _, last_user_id, sent, failed, progress_id = row
+            with db_conn() as conn:
+                total = conn.execute(sql_text("SELECT COUNT(*) FROM subscriptions")).scalar() or 0
+            if total == 0 and sent + failed == 0:
+                bot.send_message(OWNER_ID, "Нет подписчиков для рассылки.")
+            else:
+                progress_id = _report_broadcast_progress(b_id, progress_id, sent, failed, total)
+            last_report = time.monotonic()
+            with ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY) as pool:
+                while True:
+                    with db_conn() as conn:
+                        ids = [r[0] for r in conn.execute(sql_text(
+                            "SELECT user_id FROM subscriptions WHERE user_id > :last ORDER BY user_id LIMIT :limit"
+                        ), {"last": last_user_id, "limit": BROADCAST_CHUNK})]
+                    if not ids:
+                        break
+                    ok = sum(pool.map(lambda uid: paced_send_message(uid, broadcast_text), ids))
+                    sent += ok
+                    failed += len(ids) - ok
+                    last_user_id = ids[-1]
+                    lock_conn.execute(sql_text(
+                        "UPDATE broadcasts SET last_user_id = :last, sent = :sent, failed = :failed, progress_message_id = :pmid WHERE id = :id"
+                    ), {"last": last_user_id, "sent": sent, "failed": failed, "pmid": progress_id, "id": b_id})
+                    lock_conn.commit()
+                    if time.monotonic() - last_report >= BROADCAST_PROGRESS_SECONDS:
+                        progress_id = _report_broadcast_progress(b_id, progress_id, sent, failed, total)
+                        last_report = time.monotonic()
+                    if len(ids) < BROADCAST_CHUNK:
+                        break
+            lock_conn.execute(sql_text(
+                "UPDATE broadcasts SET status = 'done', finished_at = :now WHERE id = :id"
+            ), {"now": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "id": b_id})
+            lock_conn.commit()
+            if total or sent or failed:
+                _report_broadcast_progress(b_id, progress_id, sent, failed, total, done=True)
+        finally:
             try:
-                bot.send_message(user_id, broadcast_text)
-                sent += 1
-            except Exception as e:
-                logger.error(f"Ошибка при отправке рассылки {user_id}: {e}")
-                failed += 1
-        bot.send_message(OWNER_ID, f"Рассылка завершена.\nУспешно: {sent}\nОшибок: {failed}")
+                storage.unlock(lock_conn, BROADCAST_LOCK_KEY, b_id)
+                lock_conn.commit()
+            except Exception:
+                pass
+def resume_broadcasts_job():
+    """Подхватывает рассылки, прерванные рестартом (статус running без живого исполнителя)"""
+    try:
+        with db_conn() as conn:
+            rows = conn.execute(sql_text("SELECT id FROM broadcasts WHERE status = 'running'")).fetchall()
     except Exception as e:
-        logger.error(f"Ошибка рассылки: {e}")
-        bot.send_message(OWNER_ID, "Ошибка при выполнении рассылки.")
+        logger.error(f"Ошибка поиска незавершённых рассылок: {e}")
+        return
+    for (b_id,) in rows:
+        confirm_broadcast(b_id)
+job_runner.add_job(resume_broadcasts_job, 'interval', minutes=1, id='resume_broadcasts', run_at_start=True)
 # --- Остальной webhook и запуск Flask ---
 @app.route("/")
 def index():
@@ -1535,6 +3460,75 @@ def index():
 @app.route("/ping")
 def ping():
     return "pong", 200
+# --- Очередь входящих обновлений ---
+# Вебхук только кладёт update в очередь и сразу отвечает 200; обработка идёт в пуле потоков.
+# Обновления одного чата всегда попадают в одну и ту же очередь, поэтому обрабатываются по порядку.
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))  # общая ёмкость на процесс
+
+def _update_chat_id(payload):
+    """Ключ упорядочивания: id чата (или отправителя) из сырого update"""
+    for value in payload.values():
+        if isinstance(value, dict):
+            chat = value.get("chat") or (value.get("message") or {}).get("chat")
+            if chat:
+                return chat.get("id")
+            sender = value.get("from")
+            if sender:
+                return sender.get("id")
+    return payload.get("update_id")
+class UpdateQueue:
+    """Ограниченная очередь, разбитая на шарды по чату; на каждый шард — один поток-обработчик"""
+    def __init__(self, workers, capacity, handler):
+        self._handler = handler
+        self._shards = [queue.Queue(maxsize=max(1, capacity // workers)) for _ in range(workers)]
+        self._stats_lock = threading.Lock()
+        self.capacity = sum(q.maxsize for q in self._shards)
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+    def start(self):
+        for i, shard in enumerate(self._shards):
+            threading.Thread(target=self._run, args=(shard,), name=f"update-worker-{i}", daemon=True).start()
+    def submit(self, payload):
+        """Возвращает False, если очередь заполнена"""
+        shard = self._shards[hash(_update_chat_id(payload)) % len(self._shards)]
+        try:
+            shard.put_nowait((time.monotonic(), payload))
+        except queue.Full:
+            with self._stats_lock:
+                self.rejected += 1
+            return False
+        with self._stats_lock:
+            self.accepted += 1
+        return True
+    def depth(self):
+        return sum(q.qsize() for q in self._shards)
+    def _run(self, shard):
+        while True:
+            enqueued_at, payload = shard.get()
+            wait = time.monotonic() - enqueued_at
+            try:
+                self._handler(payload)
+            except Exception as e:
+                logger.error(f"Ошибка обработки update: {e}")
+            finally:
+                with self._stats_lock:
+                    self.processed += 1
+                    self.wait_sum += wait
+                    self.wait_max = max(self.wait_max, wait)
+                shard.task_done()
+def process_update_payload(payload):
+    update = types.Update.de_json(payload)
+    if not storage.transaction_per_update:
+        bot.process_new_updates([update])
+        return
+    # все обращения к БД в обработчиках идут через одно соединение и коммитятся один раз
+    with unit_of_work():
+        bot.process_new_updates([update])
+update_queue = UpdateQueue(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, process_update_payload)
+
 @app.route(f"/{TOKEN}", methods=["POST"])
 def webhook():
     # Проверка секретного токена вебхука (если задан)
@@ -1542,8 +3536,85 @@ def webhook():
         header_token = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
         if header_token != WEBHOOK_SECRET:
             return "", 403
-    update = types.Update.de_json(request.get_json(force=True))
-    bot.process_new_updates([update])
+    payload = request.get_json(force=True, silent=True)
+    if not isinstance(payload, dict):
+        return "", 400
+    # Очередь заполнена — 503, Telegram повторит доставку позже
+    if not update_queue.submit(payload):
+        return "", 503
     return "", 200
+@app.before_request
+def _start_request_timer():
+    request.environ["metrics.started"] = time.perf_counter()
+@app.after_request
+def _observe_request(response):
+    started = request.environ.get("metrics.started")
+    if started is not None:
+        # путь вебхука содержит токен — в метках только имя endpoint
+        http_request_latency.observe(time.perf_counter() - started, request.endpoint or "unknown", response.status_code)
+    return response
+@app.route("/metrics")
+def metrics():
+    q = update_queue
+    pool = engine.pool
+    lines = [
+        "# TYPE webhook_queue_depth gauge",
+        f"webhook_queue_depth {q.depth()}",
+        "# TYPE webhook_queue_capacity gauge",
+        f"webhook_queue_capacity {q.capacity}",
+        "# TYPE webhook_updates_accepted_total counter",
+        f"webhook_updates_accepted_total {q.accepted}",
+        "# TYPE webhook_updates_rejected_total counter",
+        f"webhook_updates_rejected_total {q.rejected}",
+        "# TYPE webhook_queue_wait_seconds summary",
+        f"webhook_queue_wait_seconds_sum {q.wait_sum:.6f}",
+        f"webhook_queue_wait_seconds_count {q.processed}",
+        "# TYPE webhook_queue_wait_seconds_max gauge",
+        f"webhook_queue_wait_seconds_max {q.wait_max:.6f}",
+        "# TYPE db_pool_checked_out gauge",
+        f"db_pool_checked_out {pool.checkedout()}",
+        "# TYPE db_pool_size gauge",
+        f"db_pool_size {pool.size()}",
+        "# HELP process_boot_seconds Время от начала импорта main.py до готовности воркера",
+        "# TYPE process_boot_seconds gauge",
+        f"process_boot_seconds {BOOT_SECONDS:.3f}",
+        "# TYPE job_runner_leader gauge",
+        f"job_runner_leader {int(job_runner.is_leader)}",
+        "# HELP rate_limit_rejections_total Отказы allowed_action по действию",
+        "# TYPE rate_limit_rejections_total counter",
+    ]
+    for action, (_, denies) in get_rate_limit_stats().items():
+        lines.append(f"rate_limit_rejections_total{_format_labels(('action',), (action,))} {denies}")
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n", 200, {"Content-Type": "text/plain; version=0.0.4"}
+# Фоновые потоки (слушатель инвалидаций, обработчики update, планировщик) стартуют после регистрации
+# всех задач и подписок; ведущий выбирается в фоне и не задерживает старт. Разовой команде они не нужны
+if not CLI_MODE:
+    invalidation_bus.start()
+    update_queue.start()
+    job_runner.start()
+BOOT_SECONDS = time.perf_counter() - _BOOT_STARTED
+logger.info(f"Воркер {os.getpid()} готов за {BOOT_SECONDS:.2f} с")
+# --- Командная строка ---
+def cli(argv):
+    parser = argparse.ArgumentParser(prog="main.py", description="Разовые команды бота")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export-orders", help="выгрузить merch_orders в CSV (gzip) или Parquet")
+    export.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    export.add_argument("--status", choices=ORDER_STATUSES)
+    export.add_argument("--from", dest="date_from", type=date.fromisoformat, help="ГГГГ-ММ-ДД, включительно")
+    export.add_argument("--to", dest="date_to", type=date.fromisoformat, help="ГГГГ-ММ-ДД, включительно")
+    export.add_argument("-o", "--output", help="файл (по умолчанию orders_<дата>.csv.gz или .parquet)")
+    args = parser.parse_args(argv)
+    if args.command == "export-orders":
+        output = args.output or orders_export_filename(args.format)
+        with open(output, "wb") as f:
+            count = export_orders(f, args.format, args.status,
+                                  args.date_from and str(args.date_from), args.date_to and str(args.date_to))
+        print(f"{output}: заказов {count}")
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
+    if CLI_MODE:
+        cli(sys.argv[1:])
+    else:
+        app.run(host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
@@ -0,0 +1,48 @@
+"""
+Общие фикстуры: main.py импортируется один раз на сессию с временной SQLite-базой и заглушкой
+Telegram Bot API из bench/fake_telegram.py (как в бенчмарках).
+"""
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "bench"))
+sys.path.insert(0, REPO_DIR)
+
+from fake_telegram import FakeTelegram  # noqa: E402
+
+TEST_TOKEN = "123456:test-token"
+OWNER_ID = 1
+
+
+@pytest.fixture(scope="session")
+def fake_telegram():
+    fake = FakeTelegram().start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture(scope="session")
+def bot_main(fake_telegram):
+    db_dir = tempfile.mkdtemp(prefix="bot-tests-")
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": TEST_TOKEN,
+        "OWNER_TELEGRAM_ID": str(OWNER_ID),
+        "DATABASE_URL": f"sqlite:///{os.path.join(db_dir, 'test.db')}",
+        "TELEGRAM_API_URL": fake_telegram.url,
+        "RENDER_URL": "http://127.0.0.1:9",
+    })
+    os.environ.pop("GOOGLE_SHEETS_CREDENTIALS_PATH", None)
+    os.chdir(REPO_DIR)  # photos/ ищется относительно рабочего каталога
+    import main
+    # ждём, пока воркер станет ведущим: иначе остановка может прийтись на середину запуска задач
+    deadline = time.monotonic() + 30
+    while not main.job_runner.is_leader and time.monotonic() < deadline:
+        time.sleep(0.01)
+    yield main
+    main.job_runner.stop()
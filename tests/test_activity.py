@@ -0,0 +1,85 @@
+from datetime import date, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def clean_activity(bot_main, monkeypatch):
+    with bot_main.engine.begin() as conn:
+        for table in ("user_log", "daily_activity", "activity_sketches"):
+            conn.execute(bot_main.sql_text(f"DELETE FROM {table}"))
+    monkeypatch.setattr(bot_main, "_user_log_day", None)
+    monkeypatch.setattr(bot_main, "_user_log_seen", set())
+    monkeypatch.setattr(bot_main, "_user_log_pending", [])
+
+
+def _day(days_ago):
+    return str(date.today() - timedelta(days=days_ago))
+
+
+def _active_users(bot_main, day):
+    with bot_main.engine.connect() as conn:
+        return conn.execute(bot_main.sql_text(
+            "SELECT active_users FROM daily_activity WHERE day = :day"
+        ), {"day": day}).scalar()
+
+
+def test_hyperloglog_estimates_distinct_count(bot_main):
+    sketch = bot_main.HyperLogLog()
+    for user_id in range(20000):
+        sketch.add(user_id % 10000)  # каждый id дважды
+
+    assert sketch.count() == pytest.approx(10000, rel=0.05)  # ~3 стандартные ошибки
+    assert bot_main.HyperLogLog(sketch.to_bytes()).count() == sketch.count()
+
+
+def test_hyperloglog_small_sets_and_merge(bot_main):
+    left, right = bot_main.HyperLogLog(), bot_main.HyperLogLog()
+    for user_id in range(100):
+        left.add(user_id)
+    for user_id in range(50, 200):
+        right.add(user_id)
+
+    assert bot_main.HyperLogLog().count() == 0
+    assert left.count() == pytest.approx(100, rel=0.05)
+    assert left.merge(right).count() == pytest.approx(200, rel=0.05)
+
+
+def test_flush_user_log_updates_daily_activity(bot_main, clean_activity):
+    for user_id in (1001, 1002, 1003, 1001):
+        bot_main.log_user(user_id)
+    bot_main.flush_user_log()
+
+    assert _active_users(bot_main, _day(0)) == 3
+
+    # отметка уже записана другим воркером: ON CONFLICT её отбрасывает, счётчик не растёт
+    with bot_main.engine.begin() as conn:
+        conn.execute(bot_main.sql_text(
+            "INSERT INTO user_log (user_id, date) VALUES (1004, :day)"
+        ), {"day": _day(0)})
+    bot_main.log_user(1004)
+    bot_main.log_user(1005)
+    bot_main.flush_user_log()
+
+    assert _active_users(bot_main, _day(0)) == 4
+    assert bot_main.get_activity_summary()[0] == 4
+
+
+def test_activity_summary_windows(bot_main, clean_activity):
+    visits = {
+        0: range(1, 11),         # сегодня: 10
+        3: range(5, 26),         # за 7 дней: 1..25
+        20: range(100, 150),     # за 30 дней: ещё 50
+        40: range(1000, 1200),   # за всё время: ещё 200
+    }
+    with bot_main.engine.begin() as conn:
+        for days_ago, users in visits.items():
+            bot_main.update_activity_rollup(conn, [(user_id, _day(days_ago)) for user_id in users])
+
+    today, week, month, total = bot_main.get_activity_summary()
+
+    assert today == 10
+    assert week == pytest.approx(25, rel=0.05)
+    assert month == pytest.approx(75, rel=0.05)
+    assert total == pytest.approx(275, rel=0.05)
+    assert _active_users(bot_main, _day(3)) == 21
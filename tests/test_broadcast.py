@@ -0,0 +1,44 @@
+def _seed_broadcast(bot_main, subscribers, last_user_id=0):
+    with bot_main.engine.begin() as conn:
+        conn.execute(bot_main.sql_text("DELETE FROM subscriptions"))
+        for user_id in subscribers:
+            conn.execute(bot_main.sql_text(
+                "INSERT INTO subscriptions (user_id, date_subscribed) VALUES (:user_id, '2026-10-18')"
+            ), {"user_id": user_id})
+        return conn.execute(bot_main.sql_text(
+            "INSERT INTO broadcasts (text, created_at, status, last_user_id, sent, failed) "
+            "VALUES ('hello', '2026-10-18 00:00:00', 'running', :last, 0, 0) RETURNING id"
+        ), {"last": last_user_id}).scalar()
+
+
+def _broadcast_row(bot_main, b_id):
+    with bot_main.engine.connect() as conn:
+        return conn.execute(bot_main.sql_text(
+            "SELECT status, last_user_id, sent, failed FROM broadcasts WHERE id = :id"
+        ), {"id": b_id}).fetchone()
+
+
+def test_broadcast_pages_recipients_in_keyset_batches(bot_main, monkeypatch):
+    subscribers = [1001, 1002, 1003, 1004, 1005]
+    b_id = _seed_broadcast(bot_main, subscribers)
+    monkeypatch.setattr(bot_main, "BROADCAST_CHUNK", 2)
+    monkeypatch.setattr(bot_main, "BROADCAST_CONCURRENCY", 1)
+    received = []
+    monkeypatch.setattr(bot_main, "paced_send_message", lambda uid, text: received.append(uid) or uid != 1003)
+
+    bot_main.run_broadcast(b_id)
+
+    assert received == subscribers
+    assert tuple(_broadcast_row(bot_main, b_id)) == ("done", 1005, 4, 1)
+
+
+def test_broadcast_resumes_after_checkpoint(bot_main, monkeypatch):
+    b_id = _seed_broadcast(bot_main, [2001, 2002, 2003, 2004], last_user_id=2002)
+    monkeypatch.setattr(bot_main, "BROADCAST_CHUNK", 2)
+    received = []
+    monkeypatch.setattr(bot_main, "paced_send_message", lambda uid, text: received.append(uid) or True)
+
+    bot_main.run_broadcast(b_id)
+
+    assert received == [2003, 2004]
+    assert _broadcast_row(bot_main, b_id)[0] == "done"
@@ -0,0 +1,31 @@
+import gzip
+import json
+import os
+import subprocess
+import sys
+
+from conftest import REPO_DIR, TEST_TOKEN
+
+# python main.py export-orders ... , после команды — имена живых потоков
+CLI_SCRIPT = """
+import json, runpy, sys, threading
+sys.argv = ["main.py"] + sys.argv[1:]
+runpy.run_path("main.py", run_name="__main__")
+print(json.dumps([t.name for t in threading.enumerate()]))
+"""
+
+
+def test_export_orders_cli_starts_no_background_threads(tmp_path):
+    output = tmp_path / "orders.csv.gz"
+    env = dict(os.environ, TELEGRAM_BOT_TOKEN=TEST_TOKEN, OWNER_TELEGRAM_ID="1",
+               DATABASE_URL=f"sqlite:///{tmp_path / 'cli.db'}",
+               TELEGRAM_API_URL="http://127.0.0.1:9", RENDER_URL="http://127.0.0.1:9")
+    env.pop("GOOGLE_SHEETS_CREDENTIALS_PATH", None)
+
+    proc = subprocess.run([sys.executable, "-c", CLI_SCRIPT, "export-orders", "-o", str(output)],
+                          cwd=REPO_DIR, env=env, capture_output=True, text=True, timeout=120)
+
+    assert proc.returncode == 0, proc.stderr
+    assert json.loads(proc.stdout.strip().splitlines()[-1]) == ["MainThread"]
+    with gzip.open(output, "rt", encoding="utf-8-sig") as f:
+        assert f.readline().startswith("id,")
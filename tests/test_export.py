@@ -0,0 +1,21 @@
+import io
+from datetime import date
+
+import pyarrow.parquet as pq
+
+
+def test_export_orders_parquet(bot_main):
+    with bot_main.engine.begin() as conn:
+        conn.execute(bot_main.sql_text(
+            "INSERT INTO merch_orders (user_id, username, item, quantity, price, total, date, status) "
+            "VALUES (950, 'buyer', 'Футболка', 2, 150, 300, '2026-10-17', 'Отправлен')"
+        ))
+    buffer = io.BytesIO()
+
+    count = bot_main.export_orders(buffer, "parquet", "Отправлен", "2026-10-17", "2026-10-17")
+
+    table = pq.read_table(io.BytesIO(buffer.getvalue()))
+    assert table.column_names == [name for name, _ in bot_main.ORDER_EXPORT_SCHEMA]
+    assert count == table.num_rows
+    rows = [row for row in table.to_pylist() if row["user_id"] == 950]
+    assert [(row["item"], row["total"], row["date"]) for row in rows] == [("Футболка", 300, date(2026, 10, 17))]
@@ -0,0 +1,20 @@
+import os
+
+
+def test_peer_with_same_pid_is_not_treated_as_own(bot_main):
+    bus = bot_main.invalidation_bus
+    bot_main.cart_cache.put(42, (("Кружка", 1, 100),))
+
+    # другой контейнер: тот же PID (и даже тот же hostname), но другой процесс
+    bus._dispatch(f"{bot_main.socket.gethostname()}-{os.getpid()}-peer:cart:42")
+
+    assert bot_main.cart_cache.get(42) is bot_main._MISSING
+
+
+def test_own_notifications_are_skipped(bot_main):
+    bus = bot_main.invalidation_bus
+    bot_main.cart_cache.put(43, (("Кружка", 1, 100),))
+
+    bus._dispatch(f"{bus._source}:cart:43")
+
+    assert bot_main.cart_cache.get(43) == (("Кружка", 1, 100),)
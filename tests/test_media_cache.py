@@ -0,0 +1,53 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+from telebot.apihelper import ApiTelegramException
+
+
+def _api_error(code, description):
+    return ApiTelegramException("sendPhoto", None, {"error_code": code, "description": description})
+
+
+@pytest.fixture
+def cached_photo(bot_main):
+    path = os.path.join("photos", "mug.jpg")
+    digest = bot_main._media_digest(path)
+    bot_main.remember_file_id(path, digest, "cached-file-id")
+    yield path, digest
+    bot_main.forget_file_id(path, digest)
+
+
+def test_transient_error_keeps_cached_file_id(bot_main, cached_photo, monkeypatch):
+    path, digest = cached_photo
+    sent = []
+
+    def send_photo(chat_id, photo, caption=None):
+        sent.append(photo)
+        raise _api_error(429, "Too Many Requests: retry after 5")
+    monkeypatch.setattr(bot_main.bot, "send_photo", send_photo)
+
+    with pytest.raises(ApiTelegramException):
+        bot_main.send_merch_photos(1, [path], "caption")
+
+    assert sent == ["cached-file-id"]  # без повторной загрузки
+    bot_main._media_cache.clear()
+    assert bot_main.get_cached_file_id(path, digest) == "cached-file-id"
+
+
+def test_invalid_file_id_is_forgotten_and_photo_uploaded(bot_main, cached_photo, monkeypatch):
+    path, digest = cached_photo
+    sent = []
+
+    def send_photo(chat_id, photo, caption=None):
+        sent.append(photo)
+        if photo == "cached-file-id":
+            raise _api_error(400, "Bad Request: wrong file identifier/HTTP URL specified")
+        return SimpleNamespace(photo=[SimpleNamespace(file_id="fresh-file-id")])
+    monkeypatch.setattr(bot_main.bot, "send_photo", send_photo)
+
+    assert bot_main.send_merch_photos(1, [path], "caption") is True
+
+    assert sent[0] == "cached-file-id" and len(sent) == 2
+    bot_main._media_cache.clear()
+    assert bot_main.get_cached_file_id(path, digest) == "fresh-file-id"
@@ -0,0 +1,17 @@
+def _checkouts(bot_main):
+    series = bot_main.db_checkout_latency._series.get(())
+    return series[2] if series else 0
+
+
+def test_checkout_latency_covers_direct_engine_connections(bot_main):
+    before = _checkouts(bot_main)
+
+    with bot_main.engine.connect() as conn:
+        conn.execute(bot_main.sql_text("SELECT 1"))
+    with bot_main.engine.begin() as conn:
+        conn.execute(bot_main.sql_text("SELECT 1"))
+    with bot_main.db_conn() as conn:
+        conn.execute(bot_main.sql_text("SELECT 1"))
+
+    # фоновые задачи могут добавить свои замеры — но не меньше трёх наших
+    assert _checkouts(bot_main) - before >= 3
@@ -0,0 +1,80 @@
+import pytest
+from telebot import types
+
+from conftest import OWNER_ID
+
+CUSTOMER_ID = 700
+
+
+def _create_order(bot_main, user_id=CUSTOMER_ID):
+    with bot_main.engine.begin() as conn:
+        return conn.execute(bot_main.sql_text(
+            "INSERT INTO merch_orders (user_id, username, item, quantity, price, total, date, status) "
+            "VALUES (:user_id, 'buyer', 'Кружка', 1, 100, 100, '2026-10-18', 'В обработке') RETURNING id"
+        ), {"user_id": user_id}).scalar()
+
+
+def _callback_update(data):
+    return types.Update.de_json({"update_id": 1, "callback_query": {
+        "id": "1", "chat_instance": "test", "data": data,
+        "from": {"id": OWNER_ID, "is_bot": False, "first_name": "Owner"},
+        "message": {"message_id": 1, "date": 0, "text": "test", "chat": {"id": OWNER_ID, "type": "private"}},
+    }})
+
+
+@pytest.fixture
+def sent_messages(bot_main, monkeypatch):
+    """(chat_id, text, открыта ли ещё транзакция update) для каждого send_message"""
+    sent = []
+
+    def send_message(chat_id, text, *args, **kwargs):
+        sent.append((chat_id, text, bot_main._db_local.uow is not None))
+    monkeypatch.setattr(bot_main.bot, "send_message", send_message)
+    return sent
+
+
+@pytest.mark.parametrize("action", ["change_status:{oid}:Отправлен", "delete_order:{oid}"])
+def test_order_notifications_are_sent_after_commit(bot_main, sent_messages, action):
+    oid = _create_order(bot_main)
+
+    with bot_main.unit_of_work():  # как process_update_payload на PostgreSQL
+        bot_main.bot.process_new_updates([_callback_update(action.format(oid=oid))])
+
+    assert {chat_id for chat_id, _, _ in sent_messages} == {OWNER_ID, CUSTOMER_ID}
+    assert not any(in_transaction for _, _, in_transaction in sent_messages)
+    assert any(f"#{oid}" in text for chat_id, text, _ in sent_messages if chat_id == CUSTOMER_ID)
+
+
+def _confirm_cart(bot_main, user_id, items):
+    for item, quantity, price in items:
+        bot_main.add_to_cart_db(user_id, item, quantity, price)
+    pending_id, _, _ = bot_main.create_pending_from_cart(user_id, "buyer")
+    return [order[0] for order in bot_main.move_pending_to_orders(pending_id)]
+
+
+def _stats(bot_main, user_id):
+    return [tuple(row) for row in bot_main.fetch_order_stats(user_id)]
+
+
+def test_order_stats_follow_status_changes_and_deletes(bot_main, sent_messages):
+    user_id = 710
+    mug, shirt = _confirm_cart(bot_main, user_id, [("Кружка", 2, 100), ("Футболка", 1, 150)])
+    assert _stats(bot_main, user_id) == [("В обработке", 2, 350)]
+
+    with bot_main.unit_of_work():
+        bot_main.bot.process_new_updates([_callback_update(f"change_status:{shirt}:Отправлен")])
+    assert _stats(bot_main, user_id) == [("В обработке", 1, 200), ("Отправлен", 1, 150)]
+
+    with bot_main.unit_of_work():
+        bot_main.bot.process_new_updates([_callback_update(f"delete_order:{mug}")])
+    assert _stats(bot_main, user_id) == [("Отправлен", 1, 150)]
+
+
+def test_order_stats_follow_bulk_status_change(bot_main):
+    user_id = 711
+    order_ids = _confirm_cart(bot_main, user_id, [("Кружка", 1, 100), ("Значок", 3, 20)])
+
+    updated = bot_main.bulk_update_order_status({"f": "В обработке", "ids": order_ids, "all": False}, "Отправлен")
+
+    assert sorted(updated) == sorted((oid, user_id) for oid in order_ids)
+    assert _stats(bot_main, user_id) == [("Отправлен", 2, 160)]
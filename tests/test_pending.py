@@ -0,0 +1,64 @@
+import pytest
+
+
+def _pending_count(bot_main, pending_id):
+    with bot_main.engine.connect() as conn:
+        return conn.execute(bot_main.sql_text(
+            "SELECT COUNT(*) FROM merch_pending WHERE id = :id"
+        ), {"id": pending_id}).scalar()
+
+
+def _cart_rows(bot_main, user_id):
+    with bot_main.engine.connect() as conn:
+        return conn.execute(bot_main.sql_text(
+            "SELECT COUNT(*) FROM merch_cart WHERE user_id = :user_id"
+        ), {"user_id": user_id}).scalar()
+
+
+@pytest.fixture
+def pending(bot_main):
+    """Корзина из двух позиций, оформленная в pending: (user_id, pending_id)"""
+    def make(user_id):
+        bot_main.add_to_cart_db(user_id, "Кружка", 2, 100)
+        bot_main.add_to_cart_db(user_id, "Футболка", 1, 150)
+        pending_id, _, total = bot_main.create_pending_from_cart(user_id, "buyer")
+        assert total == 350
+        return pending_id
+    return make
+
+
+def test_move_pending_creates_orders_and_clears_cart(bot_main, pending):
+    pending_id = pending(960)
+
+    with bot_main.unit_of_work():
+        orders = bot_main.move_pending_to_orders(pending_id)
+
+    assert [(o[1], o[3], o[4], o[5], o[6], o[8]) for o in orders] == [
+        (960, "Кружка", 2, 100, 200, "В обработке"),
+        (960, "Футболка", 1, 150, 150, "В обработке"),
+    ]
+    assert _pending_count(bot_main, pending_id) == 0
+    assert _cart_rows(bot_main, 960) == 0
+    assert bot_main.get_cart_items(960) == []
+
+
+def test_move_missing_pending_creates_nothing(bot_main, pending):
+    pending_id = pending(961)
+    bot_main.move_pending_to_orders(pending_id)
+
+    assert bot_main.move_pending_to_orders(pending_id) == []
+
+
+def test_decline_pending_removes_pending_and_cart(bot_main, pending):
+    pending_id = pending(962)
+
+    with bot_main.unit_of_work():
+        assert bot_main.decline_pending(pending_id) == 962
+
+    assert _pending_count(bot_main, pending_id) == 0
+    assert _cart_rows(bot_main, 962) == 0
+    assert bot_main.get_cart_items(962) == []
+    with bot_main.engine.connect() as conn:
+        assert conn.execute(bot_main.sql_text(
+            "SELECT COUNT(*) FROM merch_orders WHERE user_id = 962"
+        )).scalar() == 0
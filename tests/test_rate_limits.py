@@ -0,0 +1,36 @@
+import pytest
+from sqlalchemy import event
+
+
+@pytest.fixture
+def fresh_limiter(bot_main, monkeypatch):
+    monkeypatch.setattr(bot_main, "_memory_limiter", bot_main.MemoryRateLimiter(1))
+    monkeypatch.setattr(bot_main, "rate_limiter", bot_main._memory_limiter)
+    monkeypatch.setattr(bot_main, "_rate_limit_dirty", {})
+
+
+def test_allowed_action_does_not_query_db(bot_main, fresh_limiter):
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(bot_main.engine, "before_cursor_execute", record)
+    try:
+        assert bot_main.allowed_action(802, "my_orders") is True
+        assert bot_main.allowed_action(802, "my_orders") is False
+    finally:
+        event.remove(bot_main.engine, "before_cursor_execute", record)
+
+    # rate_limits только пишется пачками из flush_rate_limits_job, на горячем пути — одна память
+    assert not [s for s in statements if "rate_limits" in s]
+
+
+def test_flush_persists_last_ts(bot_main, fresh_limiter):
+    bot_main.allowed_action(803, "my_orders")
+    bot_main.flush_rate_limits_job()
+
+    with bot_main.engine.connect() as conn:
+        assert conn.execute(bot_main.sql_text(
+            "SELECT COUNT(*) FROM rate_limits WHERE user_id = 803 AND action = 'my_orders'"
+        )).scalar() == 1
@@ -0,0 +1,40 @@
+import time
+
+
+def _seed_rate_limits(bot_main, rows):
+    with bot_main.engine.begin() as conn:
+        conn.execute(bot_main.sql_text("DELETE FROM rate_limits"))
+        for user_id, action, last_ts in rows:
+            conn.execute(bot_main.sql_text(
+                "INSERT INTO rate_limits (user_id, action, last_ts) VALUES (:user_id, :action, :last_ts)"
+            ), {"user_id": user_id, "action": action, "last_ts": last_ts})
+
+
+def _rate_limit_keys(bot_main):
+    with bot_main.engine.connect() as conn:
+        return set(conn.execute(bot_main.sql_text("SELECT user_id, action FROM rate_limits")).fetchall())
+
+
+def test_retention_job_purges_expired_rate_limits(bot_main, monkeypatch):
+    now = time.time()
+    expired = now - bot_main.RATE_LIMIT_RETENTION_SECONDS - 60
+    rows = [(100 + i, action, expired) for i in range(5) for action in ("merch", "start")]
+    rows += [(200, "merch", now), (201, "start", now - 10)]
+    _seed_rate_limits(bot_main, rows)
+    # несколько пачек, последняя — неполная
+    monkeypatch.setattr(bot_main, "RETENTION_BATCH", 3)
+
+    bot_main.retention_job()
+
+    assert _rate_limit_keys(bot_main) == {(200, "merch"), (201, "start")}
+
+
+def test_delete_in_batches_returns_deleted_count(bot_main, monkeypatch):
+    expired = time.time() - bot_main.RATE_LIMIT_RETENTION_SECONDS - 60
+    _seed_rate_limits(bot_main, [(300 + i, "merch", expired) for i in range(4)])
+    monkeypatch.setattr(bot_main, "RETENTION_BATCH", 2)
+
+    deleted = bot_main.delete_in_batches("rate_limits", "user_id, action", "last_ts < :cutoff", {"cutoff": expired + 1})
+
+    assert deleted == 4
+    assert _rate_limit_keys(bot_main) == set()
@@ -0,0 +1,70 @@
+import pytest
+from telebot import types
+
+REFERRER_ID = 900
+
+
+def _start_update(user_id, text="/start"):
+    return types.Update.de_json({"update_id": 1, "message": {
+        "message_id": 1, "date": 0, "text": text,
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        "from": {"id": user_id, "is_bot": False, "first_name": "User", "username": f"user{user_id}"},
+        "chat": {"id": user_id, "type": "private"},
+    }})
+
+
+def _referral(bot_main, user_id):
+    with bot_main.engine.connect() as conn:
+        return conn.execute(bot_main.sql_text(
+            "SELECT referred_by, referrals_count, bonus_points FROM referrals WHERE user_id = :user_id"
+        ), {"user_id": user_id}).fetchone()
+
+
+@pytest.fixture
+def referrer(bot_main):
+    bot_main.register_user(REFERRER_ID)
+    return bot_main.encode_referral_code(REFERRER_ID)
+
+
+@pytest.fixture
+def sent_messages(bot_main, monkeypatch):
+    """(chat_id, text, открыта ли ещё транзакция update) для каждого send_message"""
+    sent = []
+
+    def send_message(chat_id, text, *args, **kwargs):
+        sent.append((chat_id, text, bot_main._db_local.uow is not None))
+    monkeypatch.setattr(bot_main.bot, "send_message", send_message)
+    return sent
+
+
+def test_start_sends_messages_after_commit(bot_main, referrer, sent_messages):
+    with bot_main.unit_of_work():  # как process_update_payload на PostgreSQL
+        bot_main.bot.process_new_updates([_start_update(901, f"/start {referrer}")])
+
+    assert {chat_id for chat_id, _, _ in sent_messages} == {901, REFERRER_ID}
+    assert not any(in_transaction for _, _, in_transaction in sent_messages)
+    assert _referral(bot_main, 901)[0] == REFERRER_ID
+
+
+def test_register_user_credits_referrer(bot_main, referrer):
+    before = _referral(bot_main, REFERRER_ID)
+
+    assert bot_main.register_user(902, referrer) == (True, bot_main.encode_referral_code(902), REFERRER_ID, before[1] + 1)
+
+    after = _referral(bot_main, REFERRER_ID)
+    assert (after[1], after[2]) == (before[1] + 1, before[2] + 10)
+
+
+def test_repeated_registration_does_not_credit_again(bot_main, referrer):
+    bot_main.register_user(903, referrer)
+    before = _referral(bot_main, REFERRER_ID)
+
+    assert bot_main.register_user(903, referrer) == (False, bot_main.encode_referral_code(903), None, None)
+    assert _referral(bot_main, REFERRER_ID) == before
+
+
+def test_self_referral_is_ignored(bot_main):
+    is_new_user, _, referrer_id, _ = bot_main.register_user(904, bot_main.encode_referral_code(904))
+
+    assert (is_new_user, referrer_id) == (True, None)
+    assert tuple(_referral(bot_main, 904)) == (None, 0, 0)
@@ -0,0 +1,45 @@
+import pytest
+
+
+def _rate_limit_actions(bot_main, user_id):
+    with bot_main.engine.connect() as conn:
+        return {r[0] for r in conn.execute(bot_main.sql_text(
+            "SELECT action FROM rate_limits WHERE user_id = :user_id"
+        ), {"user_id": user_id})}
+
+
+def _insert_rate_limit(conn, bot_main, user_id, action):
+    conn.execute(bot_main.sql_text(
+        "INSERT INTO rate_limits (user_id, action, last_ts) VALUES (:user_id, :action, 0)"
+    ), {"user_id": user_id, "action": action})
+
+
+def test_failed_savepoint_keeps_outer_unit(bot_main):
+    with bot_main.unit_of_work():
+        with bot_main.db_conn() as conn:
+            _insert_rate_limit(conn, bot_main, 500, "outer")
+        with pytest.raises(Exception):
+            with bot_main.db_savepoint() as conn:
+                _insert_rate_limit(conn, bot_main, 500, "inner")
+                conn.execute(bot_main.sql_text("SELECT * FROM no_such_table"))
+        with bot_main.db_conn() as conn:
+            _insert_rate_limit(conn, bot_main, 500, "after")
+
+    assert _rate_limit_actions(bot_main, 500) == {"outer", "after"}
+
+
+def test_helper_error_does_not_roll_back_update(bot_main, monkeypatch):
+    def broken_publish(conn, topic, key):
+        raise RuntimeError("publish failed")
+    monkeypatch.setattr(bot_main.invalidation_bus, "publish", broken_publish)
+
+    with bot_main.unit_of_work():
+        with bot_main.db_conn() as conn:
+            _insert_rate_limit(conn, bot_main, 501, "outer")
+        bot_main.add_to_cart_db(501, "Кружка", 1, 100)  # ошибка логируется, позиция не добавляется
+
+    assert _rate_limit_actions(bot_main, 501) == {"outer"}
+    with bot_main.engine.connect() as conn:
+        assert conn.execute(bot_main.sql_text(
+            "SELECT COUNT(*) FROM merch_cart WHERE user_id = 501"
+        )).scalar() == 0